@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+##  The contents of this file are subject to the Mozilla Public License
+##  Version 1.1 (the "License"); you may not use this file except in
+##  compliance with the License. You may obtain a copy of the License
+##  at https://www.mozilla.org/MPL/
+##
+##  Software distributed under the License is distributed on an "AS IS"
+##  basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+##  the License for the specific language governing rights and
+##  limitations under the License.
+##
+##  The Original Code is RabbitMQ.
+##
+##  The Initial Developer of the Original Code is Pivotal Software, Inc.
+##  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
+##
+
+"""Summarises captured AMQP traffic.
+
+    PYTHONPATH=$CODEGEN_DIR analyze_frames.py [--jobs=N] [--json] \\
+        SPEC.json[,SPEC.json...] CAPTURE...
+
+Each capture file holds the raw bytes one peer sent on one connection,
+optionally starting with the protocol header. Files are memory-mapped
+and parsed frame by frame as rabbit_command_assembler:analyze_frame/3
+splits them, one connection per task of a process pool, and the
+statistics of all of them are added up:
+
+  - frames and bytes per frame type,
+  - calls and bytes per method,
+  - content headers per class and how often each property is present,
+  - the keys of table fields (method arguments and properties such as
+    headers) with their number of occurrences,
+  - truncated captures, bad frame ends and unknown methods.
+
+The method and property layouts come from the same spec model, and the
+same spec files, as codegen.py. Needs Python 3."""
+
+from __future__ import print_function
+
+import sys
+import os
+import json
+import mmap
+import struct
+import multiprocessing
+from collections import Counter
+
+from codegen import AmqpSpec, erlangize, methodProfileKey, fixedWidthTypes
+
+FRAME_TYPES = {1: 'method', 2: 'header', 3: 'body', 8: 'heartbeat'}
+FRAME_END = 206
+
+FRAME_HEADER = struct.Struct('>BHI')
+METHOD_ID = struct.Struct('>HH')
+CONTENT_HEADER = struct.Struct('>HHQH')
+LONG = struct.Struct('>I')
+
+# Sizes of the field table values that are not length-prefixed, by
+# type tag; see rabbit_binary_parser:parse_table/1.
+TABLE_VALUE_SIZES = dict([(ord(tag), size) for (tag, size) in [
+    ('b', 1), ('B', 1), ('s', 2), ('u', 2), ('I', 4), ('i', 4),
+    ('l', 8), ('L', 8), ('d', 8), ('f', 4), ('T', 8), ('t', 1),
+    ('D', 5), ('V', 0)]])
+TABLE_LONG_VALUES = set([ord(tag) for tag in 'SxFA'])
+
+STATS = ['frames', 'frame_bytes', 'methods', 'method_bytes',
+         'content_headers', 'properties', 'table_keys', 'errors']
+
+# Set in each pool worker by initWorker: the spec layouts, the names of
+# the methods with table fields and, by class id, the property flags
+# of table properties.
+layouts = None
+tableMethods = None
+tableProperties = None
+
+def specLayouts(spec):
+    """The parts of the spec the workers need, as plain (picklable)
+    data: method names and field types by {ClassId, MethodId}, and
+    property names and types by class id."""
+    methods = {}
+    for m in spec.allMethods():
+        methods[(m.klass.index, m.index)] = \
+            (methodProfileKey(m),
+             [(erlangize(f.name), spec.resolveDomain(f.domain)) for f in m.arguments])
+    properties = {}
+    for c in spec.allClasses():
+        properties[c.index] = \
+            (erlangize(c.name),
+             [(erlangize(f.name), spec.resolveDomain(f.domain)) for f in c.fields])
+    return (methods, properties)
+
+def initWorker(specLayouts):
+    global layouts, tableMethods, tableProperties
+    layouts = specLayouts
+    (methods, properties) = layouts
+    tableMethods = set([name for (name, fields) in methods.values()
+                        if 'table' in [type for (_, type) in fields]])
+    tableProperties = {}
+    for (classId, (_, fields)) in properties.items():
+        for (index, (_, type)) in enumerate(fields):
+            if type == 'table':
+                tableProperties[classId] = \
+                    tableProperties.get(classId, 0) | (1 << (15 - index))
+
+def countTableKeys(table, field, count, stats):
+    """Counts the keys of an encoded table. A table that does not
+    parse counts as a bad table, its keys up to there still count."""
+    buf = memoryview(table)
+    o = 0
+    end = len(buf)
+    try:
+        while o < end:
+            n = buf[o]
+            if o + 1 + n >= end:
+                raise IndexError("table key past the end of the table")
+            key = buf[o + 1:o + 1 + n].tobytes().decode('utf-8', 'replace')
+            o += 1 + n
+            tag = buf[o]
+            o += 1
+            if tag in TABLE_LONG_VALUES:
+                o += 4 + LONG.unpack_from(buf, o)[0]
+            elif tag in TABLE_VALUE_SIZES:
+                o += TABLE_VALUE_SIZES[tag]
+            else:
+                raise IndexError("unknown table value type")
+            if o > end:
+                raise IndexError("table value past the end of the table")
+            stats['table_keys'][(field, key)] += count
+    except (struct.error, IndexError):
+        stats['errors']['bad_table'] += count
+
+def fieldTables(buf, o, end, fields, present = None):
+    """Returns the (field name, encoded table) of the table fields,
+    walking the fields of the payload ending at end up to the last
+    table. Consecutive bits share an octet as in
+    codegen.packMethodFields; for properties, present holds the
+    property flags, and a bit property is its flag. Fields running past
+    end raise IndexError."""
+    tables = []
+    bits = 0
+    for (index, (fieldName, type)) in enumerate(fields):
+        if present is not None:
+            if not present & (1 << (15 - index)) or type == 'bit':
+                continue
+        elif type == 'bit':
+            if bits % 8 == 0:
+                o += 1
+            bits += 1
+            continue
+        bits = 0
+        if o >= end:
+            raise IndexError("field past the end of the payload")
+        if type == 'shortstr':
+            o += 1 + buf[o]
+        elif type in fixedWidthTypes:
+            o += fixedWidthTypes[type] // 8
+        else:
+            n = LONG.unpack_from(buf, o)[0]
+            if type == 'table':
+                tables.append((fieldName, buf[o + 4:o + 4 + n]))
+            o += 4 + n
+        if o > end:
+            raise IndexError("field past the end of the payload")
+    return tables
+
+def analyzeCapture(path):
+    stats = dict([(name, Counter()) for name in STATS])
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return stats
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        analyzeBuffer(buf, stats)
+    finally:
+        buf.close()
+    return stats
+
+def analyzeBuffer(buf, stats):
+    # The loop over the frames only counts raw keys: method ids,
+    # property flags and encoded tables, which repeat a lot in real
+    # traffic. They are turned into names once, at the end.
+    (methods, properties) = layouts
+    frameCounts = [0] * 256
+    frameBytes = [0] * 256
+    methodCounts = Counter()
+    methodBytes = Counter()
+    headers = Counter()
+    tables = Counter()
+    errors = stats['errors']
+    unpackFrame = FRAME_HEADER.unpack_from
+    unpackMethod = METHOD_ID.unpack_from
+    unpackHeader = CONTENT_HEADER.unpack_from
+    size = len(buf)
+    o = 0
+    if buf[:4] == b'AMQP':
+        o = 8
+    while o < size:
+        if size - o < 7:
+            errors['truncated'] += 1
+            break
+        (type, _channel, length) = unpackFrame(buf, o)
+        payload = o + 7
+        o = payload + length + 1
+        if o > size:
+            errors['truncated'] += 1
+            break
+        if buf[o - 1] != FRAME_END:
+            errors['bad_frame_end'] += 1
+            break
+        frameCounts[type] += 1
+        frameBytes[type] += length + 8
+        try:
+            if type == 1:
+                methodId = unpackMethod(buf, payload)
+                methodCounts[methodId] += 1
+                methodBytes[methodId] += length
+                if methodId in methods:
+                    (name, fields) = methods[methodId]
+                    if name in tableMethods:
+                        for (fieldName, table) in fieldTables(buf, payload + 4, o - 1, fields):
+                            tables[(name + '.' + fieldName, table)] += 1
+            elif type == 2:
+                (classId, _weight, _bodySize, flags) = unpackHeader(buf, payload)
+                headers[(classId, flags)] += 1
+                if classId in properties and flags & tableProperties.get(classId, 0):
+                    (className, fields) = properties[classId]
+                    for (fieldName, table) in fieldTables(buf, payload + 14, o - 1, fields, flags):
+                        tables[(className + '.' + fieldName, table)] += 1
+        except (struct.error, IndexError):
+            errors['malformed_' + FRAME_TYPES.get(type, 'unknown')] += 1
+
+    for type in range(256):
+        if frameCounts[type]:
+            typeName = FRAME_TYPES.get(type, 'unknown')
+            stats['frames'][typeName] += frameCounts[type]
+            stats['frame_bytes'][typeName] += frameBytes[type]
+    for (methodId, count) in methodCounts.items():
+        if methodId in methods:
+            name = methods[methodId][0]
+            stats['methods'][name] += count
+            stats['method_bytes'][name] += methodBytes[methodId]
+        else:
+            errors['unknown_method'] += count
+    for ((classId, flags), count) in headers.items():
+        (className, fields) = properties.get(classId, (str(classId), []))
+        stats['content_headers'][className] += count
+        for (index, (fieldName, _type)) in enumerate(fields):
+            if flags & (1 << (15 - index)):
+                stats['properties'][className + '.' + fieldName] += count
+    for ((field, table), count) in tables.items():
+        countTableKeys(table, field, count, stats)
+
+def mergeStats(total, stats):
+    for name in STATS:
+        total[name].update(stats[name])
+
+def analyze(specPaths, captures, jobs):
+    spec = AmqpSpec(specPaths)
+    total = dict([(name, Counter()) for name in STATS])
+    # Largest captures first, so that one big connection does not
+    # start last and leave the other workers idle.
+    captures = sorted(captures, key = os.path.getsize, reverse = True)
+    pool = multiprocessing.Pool(jobs, initWorker, (specLayouts(spec),))
+    try:
+        for stats in pool.imap_unordered(analyzeCapture, captures):
+            mergeStats(total, stats)
+    finally:
+        pool.close()
+        pool.join()
+    total['table_keys'] = Counter(dict([('%s: %s' % k, v)
+                                        for (k, v) in total['table_keys'].items()]))
+    return total
+
+def printReport(total, captures):
+    print("%d capture(s)" % (captures,))
+    for name in STATS:
+        counts = total[name]
+        if not counts:
+            continue
+        print()
+        print(name)
+        for (key, count) in counts.most_common():
+            print("  %-56s %14d" % (key, count))
+
+def main(args):
+    jobs = None
+    asJson = False
+    while args and args[0].startswith('--'):
+        opt = args.pop(0)
+        if opt.startswith('--jobs='):
+            jobs = int(opt[len('--jobs='):])
+        elif opt == '--json':
+            asJson = True
+        else:
+            raise Exception("Unknown option " + opt)
+    if len(args) < 2:
+        raise Exception("Usage: analyze_frames.py [--jobs=N] [--json] "
+                        "<spec.json>[,<spec.json>...] <capture>...")
+    total = analyze(args[0].split(','), args[1:], jobs)
+    if asJson:
+        json.dump(total, sys.stdout, indent = 2, sort_keys = True)
+        print()
+    else:
+        printReport(total, len(args) - 1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
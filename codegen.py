@@ -20,11 +20,80 @@ from __future__ import nested_scopes
 from __future__ import print_function
 
 import sys
+import os
+import hashlib
+import keyword
+import struct
 
 from amqp_codegen import *
+import json
 import string
 import re
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# Options understood by this script rather than by amqp_codegen's
+# do_main_dict, which only knows about --ignore-conflicts. They are
+# given as --name=value and stripped from sys.argv before the latter
+# parses it.
+codegenOptions = {
+    # JSON method-frequency profile used to order generated clauses.
+    "profile": None,
+    # Share of the profiled traffic covered by the hot clause group.
+    "hot-share": "0.99",
+    # "single-pass" builds encoded content properties with one binary
+    # construction; "list" is the previous accumulate-and-reverse
+    # encoder, kept for comparison.
+    "properties-encoder": "single-pass",
+    # Comma-separated methods ("queue.declare,basic.consume"), or
+    # "all", whose table fields are decoded lazily: the record holds
+    # {lazy_table, Bin} and table_field/2 parses it when asked, on
+    # every call: callers keep the parsed table rather than the record.
+    "lazy-tables": None,
+    # Comma-separated methods ("queue.declare") or method fields
+    # ("basic.consume.consumer_tag") whose string and table values are
+    # decoded with binary:copy/1, so that long-lived values do not keep
+    # the whole frame they were read from alive.
+    "copy-fields": None,
+    # JSON overlay with per-method and per-field hints, see loadOverlay.
+    "overlay": None,
+    # Overrides the generated module name, e.g. to build a baseline
+    # module for the profile comparison benchmark.
+    "module": None,
+    # "on" counts calls and bytes per method and content class in the
+    # generated decoders and encoders (needs OTP 21.3 or later), see
+    # codec_counters/0.
+    "codec-counters": "off",
+    # "on" makes the method encoders of methods with table fields
+    # return iodata: the tables are not flattened into a binary, their
+    # length prefix being computed from the table instead.
+    "iodata-tables": "off",
+    # JSON schema of known table keys and their types, see
+    # loadTableSchema; replaces the default queue and exchange
+    # arguments schema.
+    "table-schema": None,
+    # Comma-separated classes ("connection") and methods
+    # ("basic.publish") to generate the framing modules with. The
+    # others are left out of them, see loadSpec.
+    "methods": None,
+    # File holding the content hash of the last "all" run; while it
+    # matches, the generated files are left untouched.
+    "stamp": None
+}
+
+def extractCodegenOptions(argv):
+    rest = []
+    for arg in argv:
+        m = re.match(r'^--([a-z-]+)=(.*)$', arg)
+        if m and m.group(1) in codegenOptions:
+            codegenOptions[m.group(1)] = m.group(2)
+        else:
+            rest.append(arg)
+    return rest
+
 # Coming up with a proper encoding of AMQP tables in JSON is too much
 # hassle at this stage. Given that the only default value we are
 # interested in is for the empty table, we only support that.
@@ -61,6 +130,278 @@ AmqpClass.erlangName = lambda c: "'" + erlangize(c.name) + "'"
 def erlangConstantName(s):
     return '_'.join(re.split('[- ]', s.upper()))
 
+def methodProfileKey(m):
+    return erlangize(m.klass.name) + '.' + erlangize(m.name)
+
+def loadMethodProfile(path):
+    """Load a method-frequency profile: a JSON object mapping method
+    names such as "basic.publish" to call counts."""
+    f = open(path)
+    try:
+        profile = json.load(f)
+    finally:
+        f.close()
+    return dict([(erlangize(k), v) for (k, v) in profile.items()])
+
+# Version of the overlay format understood by this script.
+overlayVersion = 1
+
+overlayMethodHints = {
+    "placement": ["hot", "cold"],
+    "tables": ["lazy", "eager"],
+    "copy": [True, False],
+    "fields": None
+}
+
+overlayFieldHints = {
+    "copy": [True, False],
+    "assert-utf8": [True, False]
+}
+
+loadedOverlay = None
+
+# Types accepted for the values of table schema keys, besides the
+# field table types themselves.
+tableSchemaTypeAliases = {
+    "integer": ["byte", "unsignedbyte", "short", "unsignedshort",
+                "signedint", "unsignedint", "long"],
+    "string": ["longstr"]
+}
+
+tableFieldTypes = ["longstr", "signedint", "decimal", "timestamp",
+                   "unsignedbyte", "unsignedshort", "unsignedint",
+                   "table", "byte", "double", "float", "long",
+                   "short", "bool", "binary", "void", "array"]
+
+# Properties usually set to a new value on every message: properties
+# records with any of them set are not worth caching the encoding of.
+perMessageProperties = ["message_id", "timestamp"]
+
+# The queue and exchange arguments RabbitMQ knows about. Replaced by
+# the schema given with --table-schema.
+defaultTableSchema = {
+    "queue_arguments": {
+        "x-expires": ["integer"],
+        "x-message-ttl": ["integer"],
+        "x-dead-letter-exchange": ["string"],
+        "x-dead-letter-routing-key": ["string"],
+        "x-max-length": ["integer"],
+        "x-max-length-bytes": ["integer"],
+        "x-max-priority": ["integer"],
+        "x-overflow": ["string"],
+        "x-queue-mode": ["string"],
+        "x-queue-type": ["string"],
+        "x-quorum-initial-group-size": ["integer"],
+        "x-single-active-consumer": ["bool"]
+    },
+    "exchange_arguments": {
+        "alternate-exchange": ["string"]
+    }
+}
+
+def loadTableSchema():
+    """Load the table schema: a JSON object naming tables, each an
+    object mapping the known keys to their accepted types, e.g.
+
+      {"queue_arguments": {"x-message-ttl": ["integer"],
+                           "x-queue-type": ["string"]}}
+
+    Types are field table types ("long", "longstr", ...) or one of
+    tableSchemaTypeAliases. Each table gets a generated
+    decode_schema_<name>/1, so names must make atoms as they are.
+    Repeated tables or keys are refused."""
+    def uniquePairs(pairs):
+        names = [n for (n, _) in pairs]
+        repeated = sorted(set([n for n in names if names.count(n) > 1]))
+        if repeated:
+            raise Exception('Repeated entries in table schema: %s' % \
+                            (', '.join(repeated),))
+        return dict(pairs)
+
+    schema = defaultTableSchema
+    if codegenOptions["table-schema"] is not None:
+        f = open(codegenOptions["table-schema"])
+        try:
+            schema = json.load(f, object_pairs_hook = uniquePairs)
+        finally:
+            f.close()
+    tables = {}
+    for (name, keys) in schema.items():
+        if not re.match('^[a-z][a-zA-Z0-9_]*$', name):
+            raise Exception('Bad table schema name %s, it must be an '
+                            'unquoted Erlang atom' % (name,))
+        tables[name] = {}
+        for (key, types) in keys.items():
+            if not re.match('^[\x20-\x7e]+$', key) or '"' in key or '\\' in key:
+                raise Exception('Bad key %s in table schema %s' % (key, name))
+            expanded = []
+            for t in types:
+                for t1 in tableSchemaTypeAliases.get(t, [t]):
+                    if t1 not in tableFieldTypes:
+                        raise Exception('Unknown type %s of %s in table schema %s' % \
+                                        (t, key, name))
+                    if t1 not in expanded:
+                        expanded.append(t1)
+            tables[name][key] = expanded
+    return tables
+
+def loadOverlay(path):
+    """Load a codegen overlay: per-deployment hints kept apart from the
+    AMQP specs, e.g.
+
+      {"overlay-version": 1,
+       "methods": {
+         "basic.publish": {"placement": "hot"},
+         "queue.declare": {"tables": "lazy",
+                           "fields": {"queue": {"copy": true}}},
+         "connection.start-ok": {"fields": {"mechanism":
+                                            {"assert-utf8": false}}}}}
+
+    Methods missing from the spec being generated are ignored, so one
+    overlay can serve both protocol versions. Hints override the
+    equivalent command line options."""
+    f = open(path)
+    try:
+        overlay = json.load(f)
+    finally:
+        f.close()
+    if overlay.get("overlay-version") != overlayVersion:
+        raise Exception('Unsupported overlay version %s in %s' % \
+                        (overlay.get("overlay-version"), path))
+    methods = {}
+    for (name, hints) in overlay.get("methods", {}).items():
+        checkOverlayHints(name, hints, overlayMethodHints)
+        fields = {}
+        for (fieldName, fieldHints) in hints.get("fields", {}).items():
+            checkOverlayHints(name + '.' + fieldName, fieldHints, overlayFieldHints)
+            fields[erlangize(fieldName)] = fieldHints
+        hints = dict(hints)
+        hints["fields"] = fields
+        methods[erlangize(name)] = hints
+    return methods
+
+def checkOverlayHints(name, hints, known):
+    for (hint, value) in hints.items():
+        if hint not in known:
+            raise Exception('Unknown overlay hint %s for %s' % (hint, name))
+        if known[hint] is not None and value not in known[hint]:
+            raise Exception('Bad value %s of overlay hint %s for %s' % \
+                            (value, hint, name))
+
+def overlayHints(m):
+    global loadedOverlay
+    if codegenOptions["overlay"] is None:
+        return {"fields": {}}
+    if loadedOverlay is None:
+        loadedOverlay = loadOverlay(codegenOptions["overlay"])
+    return loadedOverlay.get(methodProfileKey(m), {"fields": {}})
+
+def overlayFieldHint(m, f, hint):
+    return overlayHints(m)["fields"].get(erlangize(f.name), {}).get(hint)
+
+def isLazyTableMethod(m):
+    tables = overlayHints(m).get("tables")
+    if tables is not None:
+        return tables == "lazy"
+    lazy = codegenOptions["lazy-tables"]
+    if lazy is None:
+        return False
+    return lazy == "all" or \
+        methodProfileKey(m) in [erlangize(n.strip()) for n in lazy.split(',')]
+
+def copiedFieldNames(m):
+    names = []
+    copy = codegenOptions["copy-fields"]
+    if copy is not None:
+        key = methodProfileKey(m)
+        for entry in [erlangize(e.strip()) for e in copy.split(',')]:
+            if entry == key:
+                names += [erlangize(f.name) for f in m.arguments]
+            elif entry.startswith(key + '.'):
+                names.append(entry[len(key) + 1:])
+    methodCopy = overlayHints(m).get("copy")
+    if methodCopy is not None:
+        names = methodCopy and [erlangize(f.name) for f in m.arguments] or []
+    for f in m.arguments:
+        fieldCopy = overlayFieldHint(m, f, "copy")
+        if fieldCopy is True and erlangize(f.name) not in names:
+            names.append(erlangize(f.name))
+        elif fieldCopy is False and erlangize(f.name) in names:
+            names.remove(erlangize(f.name))
+    return names
+
+def assertsUtf8(m, f):
+    # By default the check is skipped on content-bearing methods for
+    # speed. This is a sanity check, not a security thing.
+    check = overlayFieldHint(m, f, "assert-utf8")
+    if check is None:
+        return not m.hasContent
+    return check
+
+def splitHotMethods(methods, profile):
+    """Split methods into the hot group and the remaining methods. The
+    hot group holds the methods the overlay places there followed by,
+    most frequent first, those covering the configured share of the
+    profiled traffic. The remaining methods are in spec order, except
+    that methods the overlay places as cold come last."""
+    def placement(m):
+        return overlayHints(m).get("placement")
+    hot = [m for m in methods if placement(m) == "hot"]
+    if profile:
+        def count(m):
+            return profile.get(methodProfileKey(m), 0)
+        total = sum([count(m) for m in methods])
+        share = float(codegenOptions["hot-share"])
+        covered = 0
+        for m in sorted(methods, key = count, reverse = True):
+            if count(m) == 0 or covered >= share * total:
+                break
+            if placement(m) is None:
+                hot.append(m)
+            covered += count(m)
+    cold = [m for m in methods if placement(m) == "cold"]
+    return (hot, [m for m in methods if m not in hot and m not in cold] + cold)
+
+def splitHotClasses(classes, hot):
+    """Classes whose content properties are used by hot methods come
+    first, in the order their first hot method appears."""
+    hotClasses = []
+    for m in hot:
+        if m.klass in classes and m.klass not in hotClasses:
+            hotClasses.append(m.klass)
+    return (hotClasses, [c for c in classes if c not in hotClasses])
+
+# Presence patterns common enough in practice to get a dedicated
+# encode_properties/1 clause, by property name. Each applies to every
+# class that has all of the named properties.
+commonPropertyPatterns = [
+    [],
+    ['delivery_mode'],
+    ['content_type', 'delivery_mode'],
+    ['delivery_mode', 'headers'],
+    ['content_type', 'delivery_mode', 'headers']
+]
+
+# Widths in bits of the fixed-size field types.
+fixedWidthTypes = {
+    'octet': 8,
+    'short': 16,
+    'long': 32,
+    'longlong': 64,
+    'timestamp': 64
+}
+
+# Extractors that decode only the fields of a method the channel needs
+# on its hot path: function name, method and the fields returned, in
+# order, as a tuple.
+envelopeExtractors = [
+    ('decode_publish_envelope', 'basic.publish',
+     ['exchange', 'routing_key', 'mandatory']),
+    ('decode_ack_envelope', 'basic.ack', ['delivery_tag', 'multiple']),
+    ('decode_nack_envelope', 'basic.nack',
+     ['delivery_tag', 'multiple', 'requeue'])
+]
+
 class PackedMethodBitField:
     def __init__(self, index):
         self.index = index
@@ -97,7 +438,7 @@ def prettyType(typeName, subTypes, typesPerLine = 4):
                           thingsPerLine = typesPerLine)
     return "-type %s ::\n       %s." % (typeName, sTs)
 
-def printFileHeader():
+def printFileHeader(comment = "%%"):
     print("""%%   Autogenerated code. Do not edit.
 %%
 %%  The contents of this file are subject to the Mozilla Public License
@@ -114,7 +455,17 @@ def printFileHeader():
 %%
 %%  The Initial Developer of the Original Code is Pivotal Software, Inc.
 %%  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
-%%""")
+%%""".replace("%%", comment))
+
+def framingModuleName(spec):
+    if codegenOptions["module"] is not None:
+        return codegenOptions["module"]
+    module = "rabbit_framing_amqp_%d_%d" % (spec.major, spec.minor)
+    if spec.revision != 0:
+        module = "%s_%d" % (module, spec.revision)
+    if module == "rabbit_framing_amqp_8_0":
+        module = "rabbit_framing_amqp_0_8"
+    return module
 
 def genErl(spec):
     def erlType(domain):
@@ -135,14 +486,39 @@ def genErl(spec):
     def genLookupMethodName(m):
         print("lookup_method_name({%d, %d}) -> %s;" % (m.klass.index, m.index, m.erlangName()))
 
-    def genLookupClassName(c):
-        print("lookup_class_name(%d) -> %s;" % (c.index, c.erlangName()))
-
-    def genMethodId(m):
-        print("method_id(%s) -> {%d, %d};" % (m.erlangName(), m.klass.index, m.index))
-
-    def genMethodHasContent(m):
-        print("method_has_content(%s) -> %s;" % (m.erlangName(), str(m.hasContent).lower()))
+    def usesFieldType(type):
+        return len([f for m in methods for f in m.arguments
+                    if erlType(f.domain) == type]) > 0
+
+    def genMethodInfo(m):
+        print("method_info(%s) ->" % (m.erlangName(),))
+        print("  {{%d, %d}, %s, %s, %s, #%s{}};" % \
+              (m.klass.index, m.index, str(m.hasContent).lower(),
+               str(m.isSynchronous).lower(), fieldNameList(m.arguments),
+               m.erlangName()))
+
+    def genDenseLookup(name, pairs, badArg):
+        """Prints a clause of name/1 looking up the integer keys of pairs
+        with element/2 in a literal tuple spanning the smallest to the
+        largest key, holes holding undefined. badArg is the body of the
+        clause for a hole, if any."""
+        keys = [k for (k, _) in pairs]
+        (low, high) = (min(keys), max(keys))
+        table = dict(pairs)
+        elements = [table.get(k, 'undefined') for k in range(low, high + 1)]
+        tuple = multiLineFormat(elements, "{", ", ", ",\n   ", "}", thingsPerLine = 6)
+        if low == 1:
+            index = "Key"
+        else:
+            index = "Key - %d" % (low - 1,)
+        print("%s(Key) when is_integer(Key), Key >= %d, Key =< %d ->" % (name, low, high))
+        if badArg is None or len(table) == len(elements):
+            print("  element(%s,\n  %s);" % (index, tuple))
+        else:
+            print("  case element(%s,\n  %s) of" % (index, tuple))
+            print("    undefined -> %s;" % (badArg,))
+            print("    Value     -> Value")
+            print("  end;")
 
     def genMethodIsSynchronous(m):
         hasNoWait = "nowait" in fieldNameList(m.arguments)
@@ -155,9 +531,6 @@ def genErl(spec):
         """Not currently used - may be useful in future?"""
         print("method_fieldtypes(%s) -> %s;" % (m.erlangName(), fieldTypeList(m.arguments)))
 
-    def genMethodFieldNames(m):
-        print("method_fieldnames(%s) -> %s;" % (m.erlangName(), fieldNameList(m.arguments)))
-
     def packMethodFields(fields):
         packed = []
         bitfield = None
@@ -194,40 +567,141 @@ def genErl(spec):
         elif type == 'table':
             return p+'Len:32/unsigned, '+p+'Tab:'+p+'Len/binary'
 
-    def genFieldPostprocessing(packed, hasContent):
+    def decodeFieldFragment(f, copied):
+        # Strings that are copied are matched as FnSub and only bound
+        # to Fn once copied out of the frame.
+        type = erlType(f.domain)
+        p = 'F' + str(f.index)
+        if f in copied and type == 'shortstr':
+            return p+'Len:8/unsigned, '+p+'Sub:'+p+'Len/binary'
+        elif f in copied and type == 'longstr':
+            return p+'Len:32/unsigned, '+p+'Sub:'+p+'Len/binary'
+        else:
+            return methodFieldFragment(f)
+
+    def genFieldPostprocessing(packed, m):
+        lazyTables = isLazyTableMethod(m)
+        copied = copiedFields(m)
         for f in packed:
             type = erlType(f.domain)
+            tab = 'F%dTab' % (f.index,)
+            if f in copied:
+                tab = 'binary:copy(%s)' % (tab,)
             if type == 'bit':
                 for index in range(f.count()):
                     print("  F%d = ((F%dBits band %d) /= 0)," % \
                           (f.index + index,
                            f.index,
                            1 << index))
+            elif type == 'table' and lazyTables:
+                print("  F%d = {lazy_table, %s}," % (f.index, tab))
             elif type == 'table':
-                print("  F%d = rabbit_binary_parser:parse_table(F%dTab)," % \
-                      (f.index, f.index))
-            # We skip the check on content-bearing methods for
-            # speed. This is a sanity check, not a security thing.
-            elif type == 'shortstr' and not hasContent:
+                print("  F%d = rabbit_binary_parser:parse_table(%s)," % \
+                      (f.index, tab))
+            elif type in ('shortstr', 'longstr') and f in copied:
+                print("  F%d = binary:copy(F%dSub)," % (f.index, f.index))
+            if type == 'shortstr' and assertsUtf8(m, f):
                 print("  rabbit_binary_parser:assert_utf8(F%d)," % (f.index))
-            else:
-                pass
 
-    def genMethodRecord(m):
-        print("method_record(%s) -> #%s{};" % (m.erlangName(), m.erlangName()))
+    def copiedFields(m):
+        names = copiedFieldNames(m)
+        return [f for f in m.arguments if erlangize(f.name) in names]
+
+    def genDecodeEnvelope(fun, m, names):
+        # Fields that are not wanted are skipped over with _ in the
+        # pattern, so no record and no unused sub binaries are built.
+        wanted = [f for f in m.arguments if erlangize(f.name) in names]
+        copied = copiedFields(m)
+        fragments = []
+        for f in packMethodFields(m.arguments):
+            type = erlType(f.domain)
+            p = 'F' + str(f.index)
+            if type == 'bit':
+                if [b for b in f.contents if b in wanted]:
+                    fragments.append(p + 'Bits:8')
+                else:
+                    fragments.append('_:8')
+            elif f in wanted:
+                fragments.append(decodeFieldFragment(f, copied))
+            elif type in fixedWidthTypes:
+                fragments.append('_:%d' % (fixedWidthTypes[type],))
+            elif type == 'shortstr':
+                fragments.append(p + 'Len:8/unsigned, _:' + p + 'Len/binary')
+            else:
+                fragments.append(p + 'Len:32/unsigned, _:' + p + 'Len/binary')
+        print("%s(<<%s>>%s) ->" % (fun, ', '.join(fragments), countedBinMatch()))
+        genCountDecode(m.erlangName(), 0)
+        for f in wanted:
+            if erlType(f.domain) == 'bit':
+                bits = bitFieldOf(m, f)
+                print("  F%d = ((F%dBits band %d) /= 0)," % \
+                      (f.index, bits.index, 1 << (f.index - bits.index)))
+            else:
+                genFieldPostprocessing([f], m)
+        print("  {%s};" % (', '.join(['F%d' % (f.index,) for f in sorted(
+            wanted, key = lambda f: names.index(erlangize(f.name)))]),))
+
+    def bitFieldOf(m, f):
+        return [b for b in packMethodFields(m.arguments)
+                if erlType(b.domain) == 'bit' and f in b.contents][0]
+
+    def genTableSchemaDecoder(name, keys):
+        print("""
+%%%% Splits a table into a map of the entries whose keys the
+%%%% %(name)s schema knows and a list of the other entries, in order.
+%%%% Of repeated known keys the first one wins, as with
+%%%% rabbit_misc:table_lookup/2, and the later ones are dropped without
+%%%% their type being checked.
+decode_schema_%(name)s(Table) when is_list(Table) ->
+  decode_schema_%(name)s(Table, #{}, []);
+decode_schema_%(name)s(TableBin) ->
+  decode_schema_%(name)s(rabbit_binary_parser:parse_table(TableBin), #{}, []).
+""" % {'name': name})
+        fun = "decode_schema_" + name
+        print("%s([], Known, Residual) ->" % (fun,))
+        print("  {ok, Known, lists:reverse(Residual)};")
+        print("%s([{K, _T, _V} | Rest], Known, Residual) when is_map_key(K, Known) ->" % (fun,))
+        print("  %s(Rest, Known, Residual);" % (fun,))
+        for key in sorted(keys):
+            types = keys[key]
+            print("%s([{<<\"%s\">> = K, T, V} | Rest], Known, Residual)" % (fun, key))
+            print("  when %s ->" % ('; '.join(["T =:= %s" % (t,) for t in types]),))
+            print("  %s(Rest, Known#{K => {T, V}}, Residual);" % (fun,))
+            print("%s([{<<\"%s\">> = K, T, _V} | _Rest], _Known, _Residual) ->" % (fun, key))
+            print("  {error, {invalid_type, K, T}};")
+        print("%s([Entry | Rest], Known, Residual) ->" % (fun,))
+        print("  %s(Rest, Known, [Entry | Residual])." % (fun,))
+
+    def genTableField(m):
+        for f in m.arguments:
+            if erlType(f.domain) == 'table':
+                print("table_field(%s, #%s{%s = T}) -> force_table(T);" % \
+                      (erlangize(f.name), m.erlangName(), erlangize(f.name)))
 
     def genDecodeMethodFields(m):
         packedFields = packMethodFields(m.arguments)
-        binaryPattern = ', '.join([methodFieldFragment(f) for f in packedFields])
+        copied = copiedFields(m)
+        binaryPattern = ', '.join([decodeFieldFragment(f, copied) for f in packedFields])
         if binaryPattern:
             restSeparator = ', '
         else:
             restSeparator = ''
         recordConstructorExpr = '#%s{%s}' % (m.erlangName(), fieldMapList(m.arguments))
-        print("decode_method_fields(%s, <<%s>>) ->" % (m.erlangName(), binaryPattern))
-        genFieldPostprocessing(packedFields, m.hasContent)
+        print("decode_method_fields(%s, <<%s>>%s) ->" % (m.erlangName(), binaryPattern, countedBinMatch()))
+        genCountDecode(m.erlangName(), 0)
+        genFieldPostprocessing(packedFields, m)
         print("  %s;" % (recordConstructorExpr,))
 
+    def genDecodeMethodFrame(m):
+        packedFields = packMethodFields(m.arguments)
+        copied = copiedFields(m)
+        binaryPattern = ', '.join(["%d:16, %d:16" % (m.klass.index, m.index)] +
+                                  [decodeFieldFragment(f, copied) for f in packedFields])
+        print("decode_method_frame(<<%s>>%s) ->" % (binaryPattern, countedBinMatch()))
+        genCountDecode(m.erlangName(), 4)
+        genFieldPostprocessing(packedFields, m)
+        print("  {#%s{%s}, %s};" % (m.erlangName(), fieldMapList(m.arguments), str(m.hasContent).lower()))
+
     def genDecodeProperties(c):
         def presentBin(fields):
             ps = ', '.join(['P' + str(f.index) + ':1' for f in fields])
@@ -242,16 +716,73 @@ def genErl(spec):
                     (i, str(field.index + 1), i, i, erlType(field.domain).upper(), i, i, i, i))
 
         if len(c.fields) == 0:
-            print("decode_properties(%d, <<>>) ->" % (c.index,))
+            print("decode_properties(%d, <<>>%s) ->" % (c.index, countedBinMatch()))
+            genCountDecode(propertiesRecordName(c), 0)
         else:
-            print(("decode_properties(%d, %s) ->" %
-                   (c.index, presentBin(c.fields))))
+            print(("decode_properties(%d, %s%s) ->" %
+                   (c.index, presentBin(c.fields), countedBinMatch())))
+            genCountDecode(propertiesRecordName(c), 0)
             for field in c.fields:
                 writePropFieldLine(field)
             print("  <<>> = %s," % ('R' + str(len(c.fields))))
         print("  #'P_%s'{%s};" % (erlangize(c.name), fieldMapList(c.fields)))
 
-    def genFieldPreprocessing(packed):
+    def genDecodeProperty(c):
+        # One clause per property: only the presence flags up to the
+        # requested property are matched, and the values before it are
+        # skipped over without being decoded.
+        # A bit property is its flag alone, so neither its clause nor
+        # the ones of the properties after it bind anything else for it.
+        for field in c.fields:
+            k = field.index
+            if erlType(field.domain) == 'bit':
+                skipped = k and "_:%d, " % (k,) or ""
+                print("decode_property(%d, %s, <<%sP%d:1, _:%d, _/binary>>) ->" % \
+                      (c.index, erlangize(field.name), skipped, k, 15 - k))
+                print("  P%d =/= 0;" % (k,))
+                continue
+            flags = ', '.join([erlType(f.domain) == 'bit' and '_:1' or 'P%d:1' % (f.index,)
+                               for f in c.fields[:k]] + ['P%d:1' % (k,)])
+            print("decode_property(%d, %s, <<%s, _:%d, R0/binary>>) ->" % \
+                  (c.index, erlangize(field.name), flags, 15 - k))
+            for f in c.fields[:k]:
+                i = f.index
+                if erlType(f.domain) == 'bit':
+                    print("  R%d = R%d," % (i + 1, i))
+                else:
+                    print("  R%d = ?%s_SKIP(P%d, R%d, L%d, X%d)," % \
+                          (i + 1, erlType(f.domain).upper(), i, i, i, i))
+            print("  if P%d =:= 0 -> undefined; true -> {F%d, _} = ?%s_VAL(R%d, L%d, V%d, X%d), F%d end;" % \
+                  (k, k, erlType(field.domain).upper(), k, k, k, k, k))
+
+    def genPropertyOffsets(c):
+        if len(c.fields) == 0:
+            print("property_offsets(%d, <<>>) ->" % (c.index,))
+            print("  {};")
+            return
+        flags = ', '.join(['P%d:1' % (f.index,) for f in c.fields])
+        print("property_offsets(%d, <<%s, _:%d, _/binary>> = Bin) ->" % \
+              (c.index, flags, 16 - len(c.fields)))
+        print("  O0 = 2,")
+        for f in c.fields:
+            i = f.index
+            type = erlType(f.domain)
+            if type == 'bit':
+                span = "?BIT_SPAN(P%d, O%d)" % (i, i)
+            elif type in fixedWidthTypes:
+                span = "?FIXED_SPAN(P%d, O%d, %d)" % (i, i, fixedWidthTypes[type] // 8)
+            else:
+                span = "?%s_SPAN(P%d, Bin, O%d, L%d)" % (type.upper(), i, i, i)
+            print("  {S%d, O%d} = %s," % (i, i + 1, span))
+        print("  O%d = size(Bin)," % (len(c.fields),))
+        print("  {%s};" % (', '.join(['S%d' % (f.index,) for f in c.fields]),))
+
+    def genPropertyInfo(c):
+        for f in c.fields:
+            print("property_info(%d, %s) -> {%d, %s};" % \
+                  (c.index, erlangize(f.name), f.index, erlType(f.domain)))
+
+    def genFieldPreprocessing(packed, lazyTables = False):
         for f in packed:
             type = erlType(f.domain)
             if type == 'bit':
@@ -259,6 +790,12 @@ def genErl(spec):
                       (f.index,
                        ' bor '.join(['(bitvalue(F%d) bsl %d)' % (x.index, x.index - f.index)
                                      for x in f.contents])))
+            elif type == 'table' and lazyTables:
+                print("  F%dTab = table_bin(F%d)," % (f.index, f.index))
+                print("  F%dLen = size(F%dTab)," % (f.index, f.index))
+            elif type == 'table' and iodataTables:
+                print("  F%dTab = rabbit_binary_generator:generate_table_iolist(F%d)," % (f.index, f.index))
+                print("  F%dLen = rabbit_binary_generator:table_size(F%d)," % (f.index, f.index))
             elif type == 'table':
                 print("  F%dTab = rabbit_binary_generator:generate_table(F%d)," % (f.index, f.index))
                 print("  F%dLen = size(F%dTab)," % (f.index, f.index))
@@ -269,11 +806,94 @@ def genErl(spec):
             else:
                 pass
 
+    def hasIodataFields(packedFields):
+        return iodataTables and 'table' in [erlType(f.domain) for f in packedFields]
+
+    def iodataFields(packedFields):
+        # The fields as a list of binaries with the (iodata) tables in
+        # between, and an expression of their total size.
+        segments = []
+        sizes = []
+        fragments = []
+        for f in packedFields:
+            if erlType(f.domain) == 'table':
+                fragments.append('F%dLen:32/unsigned' % (f.index,))
+                segments.append('<<%s>>' % (', '.join(fragments),))
+                segments.append('F%dTab' % (f.index,))
+                sizes.append('F%dLen' % (f.index,))
+                fragments = []
+            else:
+                fragments.append(methodFieldFragment(f))
+        if fragments:
+            segments.append('<<%s>>' % (', '.join(fragments),))
+        binaries = ['FieldsBin%d' % (i,) for (i, seg) in enumerate(segments) if seg.startswith('<<')]
+        return (segments, ' + '.join(['size(%s)' % (b,) for b in binaries] + sizes))
+
+    def genIodataFields(packedFields):
+        (segments, size) = iodataFields(packedFields)
+        names = []
+        for (i, seg) in enumerate(segments):
+            if seg.startswith('<<'):
+                print("  FieldsBin%d = %s," % (i, seg))
+                names.append('FieldsBin%d' % (i,))
+            else:
+                names.append(seg)
+        print("  FieldsSize = %s," % (size,))
+        return '[%s]' % (', '.join(names),)
+
     def genEncodeMethodFields(m):
         packedFields = packMethodFields(m.arguments)
         print("encode_method_fields(#%s{%s}) ->" % (m.erlangName(), fieldMapList(m.arguments)))
-        genFieldPreprocessing(packedFields)
-        print("  <<%s>>;" % (', '.join([methodFieldFragment(f) for f in packedFields])))
+        genFieldPreprocessing(packedFields, isLazyTableMethod(m))
+        if hasIodataFields(packedFields):
+            fields = genIodataFields(packedFields)
+            genCountEncode(m.erlangName(), "FieldsSize")
+            print("  %s;" % (fields,))
+        else:
+            genCountedEncode(m.erlangName(), "<<%s>>" % (', '.join([methodFieldFragment(f) for f in packedFields])))
+
+    def genEncodeMethodFrame(m):
+        # The frame type, class id and method id never change for a
+        # given method, so they are emitted as literals and only the
+        # channel and frame size are computed at runtime.
+        packedFields = packMethodFields(m.arguments)
+        idBin = "<<%d:16, %d:16>>" % (m.klass.index, m.index)
+        print("encode_method_frame(Channel, #%s{%s}) ->" % (m.erlangName(), fieldMapList(m.arguments)))
+        if len(packedFields) == 0:
+            genCountEncode(m.erlangName(), "0")
+            print("  [<<?FRAME_METHOD, Channel:16, 4:32>>, %s, ?FRAME_END];" % (idBin,))
+        elif hasIodataFields(packedFields):
+            genFieldPreprocessing(packedFields, isLazyTableMethod(m))
+            fields = genIodataFields(packedFields)
+            genCountEncode(m.erlangName(), "FieldsSize")
+            print("  [<<?FRAME_METHOD, Channel:16, (FieldsSize + 4):32>>, %s, %s, ?FRAME_END];" % \
+                  (idBin, fields))
+        else:
+            genFieldPreprocessing(packedFields, isLazyTableMethod(m))
+            print("  Fields = <<%s>>," % (', '.join([methodFieldFragment(f) for f in packedFields])))
+            genCountEncode(m.erlangName(), "size(Fields)")
+            print("  [<<?FRAME_METHOD, Channel:16, (size(Fields) + 4):32>>, %s, Fields, ?FRAME_END];" % (idBin,))
+
+    def genEncodeContentCommand(m):
+        # The method frame is built as a single binary whose frame type,
+        # class and method ids and end octet are literals.
+        packedFields = packMethodFields(m.arguments)
+        print("encode_content_commands([{Channel, #%s{%s}, Content} | Commands], FrameMax, Acc) ->" % \
+              (m.erlangName(), fieldMapList(m.arguments)))
+        genFieldPreprocessing(packedFields, isLazyTableMethod(m))
+        if hasIodataFields(packedFields):
+            fields = genIodataFields(packedFields)
+            genCountEncode(m.erlangName(), "FieldsSize")
+            print("  MethodFrame = [<<?FRAME_METHOD, Channel:16, (FieldsSize + 4):32, %d:16, %d:16>>, %s, ?FRAME_END]," % \
+                  (m.klass.index, m.index, fields))
+        else:
+            print("  Fields = <<%s>>," % (', '.join([methodFieldFragment(f) for f in packedFields])))
+            genCountEncode(m.erlangName(), "size(Fields)")
+            print("  MethodFrame = <<?FRAME_METHOD, Channel:16, (size(Fields) + 4):32, %d:16, %d:16, Fields/binary, ?FRAME_END>>," % \
+                  (m.klass.index, m.index))
+        print("  encode_content_commands(Commands, FrameMax,")
+        print("                          rabbit_binary_generator:build_content_frames_rev(")
+        print("                            Channel, Content, FrameMax, ?MODULE, [MethodFrame | Acc]));")
 
     def genEncodeProperties(c):
         def presentBin(fields):
@@ -290,13 +910,132 @@ def genErl(spec):
 
         print("encode_properties(#'P_%s'{%s}) ->" % (erlangize(c.name), fieldMapList(c.fields)))
         if len(c.fields) == 0:
-            print("  <<>>;")
+            genCountedEncode(propertiesRecordName(c), "<<>>")
         else:
             print("  R0 = [<<>>],")
             for field in c.fields:
                 writePropFieldLine(field)
-            print("  list_to_binary([%s | lists:reverse(R%s)]);" % \
-                (presentBin(c.fields), str(len(c.fields))))
+            genCountedEncode(propertiesRecordName(c),
+                             "list_to_binary([%s | lists:reverse(R%s)])" % \
+                             (presentBin(c.fields), str(len(c.fields))))
+
+    def genEncodePropertiesPattern(c, names):
+        present = [f for f in c.fields if erlangize(f.name) in names]
+        flags = sum([1 << (15 - f.index) for f in present])
+        def fieldPattern(f):
+            if f in present:
+                return "%s = F%d" % (erlangize(f.name), f.index)
+            else:
+                return "%s = undefined" % (erlangize(f.name),)
+        guard = ', '.join(["F%d =/= undefined" % (f.index,) for f in present])
+        if guard:
+            guard = " when " + guard
+        print("encode_properties(#'P_%s'{%s})%s ->" % \
+              (erlangize(c.name), ', '.join([fieldPattern(f) for f in c.fields]), guard))
+        segments = ["2#%s:16" % (bin(flags)[2:].zfill(16),)]
+        for f in present:
+            type = erlType(f.domain)
+            if type in fixedWidthTypes:
+                segments.append("F%d:%d/unsigned" % (f.index, fixedWidthTypes[type]))
+            else:
+                print("  B%d = ?%s_PROP(F%d, L%d)," % (f.index, type.upper(), f.index, f.index))
+                segments.append("B%d/binary" % (f.index,))
+        genCountedEncode(propertiesRecordName(c), "<<%s>>" % (', '.join(segments),))
+
+    def genEncodePropertiesSinglePass(c):
+        # Common presence patterns get a clause of their own that builds
+        # the whole binary in one go; everything else collects one
+        # binary per field and concatenates them in a single
+        # construction, without an intermediate list.
+        names = [erlangize(f.name) for f in c.fields]
+        hasBits = 'bit' in [erlType(f.domain) for f in c.fields]
+        if len(c.fields) > 0 and not hasBits:
+            for pattern in commonPropertyPatterns:
+                if set(pattern) <= set(names):
+                    genEncodePropertiesPattern(c, pattern)
+
+        print("encode_properties(#'P_%s'{%s}) ->" % (erlangize(c.name), fieldMapList(c.fields)))
+        if len(c.fields) == 0:
+            genCountedEncode(propertiesRecordName(c), "<<>>")
+            return
+        for field in c.fields:
+            i = str(field.index)
+            if erlType(field.domain) == 'bit':
+                # A bit property is its flag, there is no value.
+                print("  P%s = bitvalue(F%s)," % (i, i))
+            else:
+                print("  {P%s, B%s} = if F%s =:= undefined -> {0, <<>>}; true -> {1, ?%s_PROP(F%s, L%s)} end," % \
+                    (i, i, i, erlType(field.domain).upper(), i, i))
+        genCountedEncode(propertiesRecordName(c),
+                         "<<%s>>" % \
+                         (', '.join(['P%d:1' % (f.index,) for f in c.fields] +
+                                    ['0:%d' % (16 - len(c.fields),)] +
+                                    ['B%d/binary' % (f.index,) for f in c.fields
+                                     if erlType(f.domain) != 'bit']),))
+
+    def genEncodedSize(m):
+        # Fixed-width fields and string/table length prefixes add up to
+        # a literal; only string and table contents are sized at
+        # runtime.
+        fixed = 0
+        bound = []
+        terms = []
+        for f in packMethodFields(m.arguments):
+            type = erlType(f.domain)
+            if type == 'bit':
+                fixed += 1
+            elif type in fixedWidthTypes:
+                fixed += fixedWidthTypes[type] // 8
+            else:
+                bound.append(f)
+                if type == 'shortstr':
+                    fixed += 1
+                    terms.append("size(F%d)" % (f.index,))
+                elif type == 'longstr':
+                    fixed += 4
+                    terms.append("size(F%d)" % (f.index,))
+                elif type == 'table' and isLazyTableMethod(m):
+                    fixed += 4
+                    terms.append("table_bin_size(F%d)" % (f.index,))
+                elif type == 'table':
+                    fixed += 4
+                    terms.append("rabbit_binary_generator:table_size(F%d)" % (f.index,))
+        print("encoded_size(#%s{%s}) ->" % (m.erlangName(), fieldMapList(bound)))
+        print("  %s;" % (' + '.join([str(fixed)] + terms),))
+
+    def genEncodedPropertiesSize(c):
+        if len(c.fields) == 0:
+            print("encoded_properties_size(#'P_%s'{}) -> 0;" % (erlangize(c.name),))
+            return
+        bound = [f for f in c.fields if erlType(f.domain) != 'bit']
+        terms = []
+        for f in bound:
+            type = erlType(f.domain)
+            if type in fixedWidthTypes:
+                size = str(fixedWidthTypes[type] // 8)
+            elif type == 'shortstr':
+                size = "1 + size(F%d)" % (f.index,)
+            elif type == 'longstr':
+                size = "4 + size(F%d)" % (f.index,)
+            elif type == 'table':
+                size = "4 + rabbit_binary_generator:table_size(F%d)" % (f.index,)
+            terms.append("?PROP_SIZE(F%d, %s)" % (f.index, size))
+        print("encoded_properties_size(#'P_%s'{%s}) ->" % (erlangize(c.name), fieldMapList(bound)))
+        print("  %s;" % (' +\n    '.join(["2"] + terms),))
+
+    def genPropertiesCacheKey(c):
+        tables = [f for f in c.fields if erlType(f.domain) == 'table']
+        perMessage = [f for f in c.fields if erlangize(f.name) in perMessageProperties]
+        if not tables and not perMessage:
+            print("properties_cache_key(#'P_%s'{} = Props) -> {?MODULE, Props};" % (erlangize(c.name),))
+            return
+        print("properties_cache_key(#'P_%s'{%s} = Props)" % \
+              (erlangize(c.name), fieldMapList(tables + perMessage)))
+        print("  when %s ->" % (', '.join(["(F%d =:= undefined orelse F%d =:= [])" % (f.index, f.index)
+                                         for f in tables] +
+                                        ["F%d =:= undefined" % (f.index,)
+                                         for f in perMessage]),))
+        print("  {?MODULE, Props};")
 
     def messageConstantClass(cls):
         # We do this because 0.8 uses "soft error" and 8.1 uses "soft-error".
@@ -314,37 +1053,158 @@ def genErl(spec):
         print('lookup_amqp_exception(%s) -> {%s, ?%s, <<"%s">>};' % \
               (n.lower(), hardErrorBoolStr, n, n))
 
-    def genAmqpException(c,v,cls):
-        n = erlangConstantName(c)
-        print('amqp_exception(?%s) -> %s;' % \
-            (n, n.lower()))
+    def genAmqpExceptions(constants):
+        # The first constant of a value wins, as it would as a clause;
+        # the values in the range of the error codes go in a dense
+        # tuple, the other ones (frame types, sizes...) stay clauses.
+        names = {}
+        for (c,v,cls) in constants:
+            names.setdefault(v, erlangConstantName(c).lower())
+        codes = [v for (c,v,cls) in constants
+                 if messageConstantClass(cls) in ('SOFT_ERROR', 'HARD_ERROR')]
+        dense = []
+        for (c,v,cls) in constants:
+            n = erlangConstantName(c)
+            if codes and min(codes) <= v <= max(codes):
+                if names[v] == n.lower():
+                    dense.append((v, n.lower()))
+            elif names[v] == n.lower():
+                print('amqp_exception(?%s) -> %s;' % (n, n.lower()))
+        if dense:
+            genDenseLookup("amqp_exception", dense, None)
+
+    def propertiesRecordName(c):
+        return "'P_%s'" % (erlangize(c.name),)
+
+    # Each method and content class has four consecutive counters:
+    # decode calls, decode bytes, encode calls and encode bytes.
+    def countedBinMatch():
+        if countCodec:
+            return " = CodecBin"
+        return ""
+
+    def genCountDecode(name, headerSize):
+        if countCodec:
+            size = "size(CodecBin)"
+            if headerSize:
+                size = "size(CodecBin) - %d" % (headerSize,)
+            print("  count_codec(%d, %s)," % (codecCounterBase[name], size))
+
+    def genCountEncode(name, size):
+        if countCodec:
+            print("  count_codec(%d, %s)," % (codecCounterBase[name] + 2, size))
+
+    def genCountedEncode(name, expr):
+        if countCodec:
+            print("  CodecBin = %s," % (expr,))
+            genCountEncode(name, "size(CodecBin)")
+            print("  CodecBin;")
+        else:
+            print("  %s;" % (expr,))
+
+    def genCodecCounters():
+        if not countCodec:
+            print("""
+%% Built without --codec-counters=on.
+init_codec_counters() -> ok.
+
+codec_counters() -> [].""")
+            return
+        bases = sorted(codecCounterBase.items(), key = lambda x: x[1])
+        print("""
+-define(CODEC_COUNTERS_KEY, {?MODULE, codec_counters}).
+
+init_codec_counters() ->
+    case persistent_term:get(?CODEC_COUNTERS_KEY, undefined) of
+        undefined -> persistent_term:put(?CODEC_COUNTERS_KEY,
+                                         counters:new(%d, [write_concurrency]));
+        _         -> ok
+    end.
+
+codec_counters() ->
+    case persistent_term:get(?CODEC_COUNTERS_KEY, undefined) of
+        undefined -> [];
+        Counters  -> [{Name, codec_counts(Counters, Base)} ||
+                         {Name, Base} <- [%s]]
+    end.
+
+codec_counts(Counters, Base) ->
+    [{decode_calls, counters:get(Counters, Base)},
+     {decode_bytes, counters:get(Counters, Base + 1)},
+     {encode_calls, counters:get(Counters, Base + 2)},
+     {encode_bytes, counters:get(Counters, Base + 3)}].
+
+count_codec(Index, Bytes) ->
+    case persistent_term:get(?CODEC_COUNTERS_KEY, undefined) of
+        undefined -> ok;
+        Counters  -> counters:add(Counters, Index, 1),
+                     counters:add(Counters, Index + 1, Bytes)
+    end.""" % (4 * len(bases),
+           ',\n                                          '.join(["{%s, %d}" % b for b in bases])))
+
+    def genClauses(gen, hot, cold):
+        if hot:
+            print("%% Hot clauses (method profile and overlay placement).")
+            for x in hot: gen(x)
+            print("%% Remaining clauses.")
+        for x in cold: gen(x)
 
     methods = spec.allMethods()
+    tableSchema = loadTableSchema()
+    profile = None
+    if codegenOptions["profile"] is not None:
+        profile = loadMethodProfile(codegenOptions["profile"])
+    (hotMethods, coldMethods) = splitHotMethods(methods, profile)
+    (hotClasses, coldClasses) = splitHotClasses(spec.allClasses(), hotMethods)
+
+    if codegenOptions["codec-counters"] not in ["on", "off"]:
+        raise Exception("Unknown --codec-counters value: " + codegenOptions["codec-counters"])
+    countCodec = codegenOptions["codec-counters"] == "on"
+    if codegenOptions["iodata-tables"] not in ["on", "off"]:
+        raise Exception("Unknown --iodata-tables value: " + codegenOptions["iodata-tables"])
+    iodataTables = codegenOptions["iodata-tables"] == "on"
+    codecCounterBase = {}
+    for m in methods:
+        codecCounterBase[m.erlangName()] = 4 * len(codecCounterBase) + 1
+    for c in spec.allClasses():
+        codecCounterBase[propertiesRecordName(c)] = 4 * len(codecCounterBase) + 1
 
     printFileHeader()
-    module = "rabbit_framing_amqp_%d_%d" % (spec.major, spec.minor)
-    if spec.revision != 0:
-        module = "%s_%d" % (module, spec.revision)
-    if module == "rabbit_framing_amqp_8_0":
-        module = "rabbit_framing_amqp_0_8"
-    print("-module(%s)." % module)
+    print("-module(%s)." % framingModuleName(spec))
     print("""-include("rabbit_framing.hrl").
 
 -export([version/0]).
 -export([lookup_method_name/1]).
 -export([lookup_class_name/1]).
 
+-export([method_info/1]).
 -export([method_id/1]).
 -export([method_has_content/1]).
 -export([is_method_synchronous/1]).
 -export([method_record/1]).
 -export([method_fieldnames/1]).
 -export([decode_method_fields/2]).
+-export([decode_method_frame/1]).
+-export([decode_publish_envelope/1]).
+-export([decode_ack_envelope/1]).
+-export([decode_nack_envelope/1]).
+-export([decode_frames/2]).
+-export([table_field/2]).
 -export([decode_properties/2]).
+-export([decode_property/3]).
+-export([property_offsets/2]).
+-export([patch_properties_bin/3]).
 -export([encode_method_fields/1]).
+-export([encode_method_frame/2]).
+-export([encode_content_commands/2]).
 -export([encode_properties/1]).
+-export([encoded_size/1]).
+-export([encoded_properties_size/1]).
+-export([properties_cache_key/1]).
 -export([lookup_amqp_exception/1]).
 -export([amqp_exception/1]).
+-export([init_codec_counters/0]).
+-export([codec_counters/0]).
 
 """)
     print("%% Various types")
@@ -353,6 +1213,7 @@ def genErl(spec):
               amqp_table/0, amqp_array/0, amqp_value/0,
               amqp_method_name/0, amqp_method/0, amqp_method_record/0,
               amqp_method_field_name/0, amqp_property_record/0,
+              amqp_lazy_table/0,
               amqp_exception/0, amqp_exception_code/0, amqp_class_id/0]).
 
 -type amqp_field_type() ::
@@ -365,6 +1226,8 @@ def genErl(spec):
       'longlong' | 'timestamp' | 'bit' | 'table'.
 
 -type amqp_table() :: [{binary(), amqp_field_type(), amqp_value()}].
+%% Undecoded table field of a method decoded with --lazy-tables.
+-type amqp_lazy_table() :: {'lazy_table', binary()}.
 -type amqp_array() :: [{amqp_field_type(), amqp_value()}].
 -type amqp_value() :: binary() |    % longstr
                       integer() |   % signedint
@@ -414,6 +1277,9 @@ def genErl(spec):
 -spec version() -> {non_neg_integer(), non_neg_integer(), non_neg_integer()}.
 -spec lookup_method_name(amqp_method()) -> amqp_method_name().
 -spec lookup_class_name(amqp_class_id()) -> amqp_class_name().
+-spec method_info(amqp_method_name()) ->
+          {amqp_method(), boolean(), boolean(), [amqp_method_field_name()],
+           amqp_method_record()}.
 -spec method_id(amqp_method_name()) -> amqp_method().
 -spec method_has_content(amqp_method_name()) -> boolean().
 -spec is_method_synchronous(amqp_method_record()) -> boolean().
@@ -421,23 +1287,61 @@ def genErl(spec):
 -spec method_fieldnames(amqp_method_name()) -> [amqp_method_field_name()].
 -spec decode_method_fields(amqp_method_name(), binary()) ->
           amqp_method_record() | rabbit_types:connection_exit().
+-spec decode_method_frame(binary()) ->
+          {amqp_method_record(), boolean()} | rabbit_types:connection_exit().
+-spec decode_publish_envelope(binary()) ->
+          {binary(), binary(), boolean()} | rabbit_types:connection_exit().
+-spec decode_ack_envelope(binary()) ->
+          {non_neg_integer(), boolean()} | rabbit_types:connection_exit().
+-spec decode_nack_envelope(binary()) ->
+          {non_neg_integer(), boolean(), boolean()} |
+          rabbit_types:connection_exit().
+-spec decode_frames(binary(), non_neg_integer()) ->
+          {[{non_neg_integer(), tuple() | 'heartbeat'}], binary()}.
+-spec table_field(amqp_method_field_name(), amqp_method_record()) ->
+          amqp_table().
 -spec decode_properties(non_neg_integer(), binary()) -> amqp_property_record().
--spec encode_method_fields(amqp_method_record()) -> binary().
+-spec decode_property(non_neg_integer(), atom(), binary()) -> any().
+-spec property_offsets(non_neg_integer(), binary()) -> tuple().
+-spec patch_properties_bin(non_neg_integer(), [{atom(), any()}], binary()) ->
+          binary().
+-spec encode_method_frame(non_neg_integer(), amqp_method_record()) -> iolist().
+-spec encode_content_commands(
+        [{non_neg_integer(), amqp_method_record(), rabbit_types:content()}],
+        non_neg_integer()) -> iolist().
 -spec encode_properties(amqp_property_record()) -> binary().
+-spec encoded_size(amqp_method_record()) -> non_neg_integer().
+-spec encoded_properties_size(amqp_property_record()) -> non_neg_integer().
+-spec properties_cache_key(amqp_property_record()) ->
+          {module(), amqp_property_record()} | 'uncacheable'.
 -spec lookup_amqp_exception(amqp_exception()) ->
           {boolean(), amqp_exception_code(), binary()}.
 -spec amqp_exception(amqp_exception_code()) -> amqp_exception().
-
+-spec init_codec_counters() -> ok.
+-spec codec_counters() -> [{atom(), [{atom(), non_neg_integer()}]}].""")
+    print("-spec encode_method_fields(amqp_method_record()) -> %s." % \
+          (iodataTables and "iodata()" or "binary()",))
+    for name in sorted(tableSchema):
+        print("-export([decode_schema_%s/1])." % (name,))
+        print("-spec decode_schema_%s(amqp_table() | binary()) ->" % (name,))
+        print("          {'ok', #{binary() => {amqp_field_type(), amqp_value()}}, amqp_table()} |")
+        print("          {'error', {'invalid_type', binary(), amqp_field_type()}}.")
+    # A module pruned with --methods may have no field of some type,
+    # and erlc would then reject the unused helper.
+    if usesFieldType('bit') or \
+            [f for c in spec.allClasses() for f in c.fields if erlType(f.domain) == 'bit']:
+        print("""
 bitvalue(true) -> 1;
 bitvalue(false) -> 0;
-bitvalue(undefined) -> 0.
-
+bitvalue(undefined) -> 0.""")
+    if usesFieldType('shortstr'):
+        print("""
 shortstr_size(S) ->
     case size(S) of
         Len when Len =< 255 -> Len;
         _                   -> exit(method_field_shortstr_overflow)
-    end.
-
+    end.""")
+    print("""
 -define(SHORTSTR_VAL(R, L, V, X),
         begin
             <<L:8/unsigned, V:L/binary, X/binary>> = R,
@@ -486,6 +1390,40 @@ shortstr_size(S) ->
             {V, X}
         end).
 
+-define(SHORTSTR_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<L:8/unsigned, _:L/binary, X/binary>> = R, X
+        end).
+
+-define(LONGSTR_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<L:32/unsigned, _:L/binary, X/binary>> = R, X
+        end).
+
+-define(TABLE_SKIP(P, R, L, X), ?LONGSTR_SKIP(P, R, L, X)).
+
+-define(OCTET_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<_:8, X/binary>> = R, X
+        end).
+
+-define(SHORT_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<_:16, X/binary>> = R, X
+        end).
+
+-define(LONG_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<_:32, X/binary>> = R, X
+        end).
+
+-define(LONGLONG_SKIP(P, R, L, X),
+        if P =:= 0 -> R;
+           true    -> <<_:64, X/binary>> = R, X
+        end).
+
+-define(TIMESTAMP_SKIP(P, R, L, X), ?LONGLONG_SKIP(P, R, L, X)).
+
 -define(SHORTSTR_PROP(X, L),
         begin
             L = size(X),
@@ -505,59 +1443,298 @@ shortstr_size(S) ->
 -define(LONG_PROP(X, L),      <<X:32/unsigned>>).
 -define(LONGLONG_PROP(X, L),  <<X:64/unsigned>>).
 -define(TIMESTAMP_PROP(X, L), <<X:64/unsigned>>).
-
--define(TABLE_PROP(X, T),
+""")
+    if iodataTables:
+        # The table is flattened once, together with its length prefix,
+        # rather than into a binary that is then copied behind it.
+        print("""-define(TABLE_PROP(X, T),
+        begin
+            T = rabbit_binary_generator:generate_table_iolist(X),
+            iolist_to_binary(
+              [<<(rabbit_binary_generator:table_size(X)):32>> | T])
+        end).""")
+    else:
+        print("""-define(TABLE_PROP(X, T),
         begin
             T = rabbit_binary_generator:generate_table(X),
             <<(size(T)):32, T/binary>>
+        end).""")
+    print("""
+-define(PROP_SIZE(X, Size),
+        if X =:= undefined -> 0;
+           true            -> Size
+        end).
+
+-define(SHORTSTR_SPAN(P, B, O, L),
+        if P =:= 0 -> {undefined, O};
+           true    -> <<_:O/binary, L:8/unsigned, _/binary>> = B,
+                      {{O, L + 1}, O + L + 1}
+        end).
+
+-define(LONGSTR_SPAN(P, B, O, L),
+        if P =:= 0 -> {undefined, O};
+           true    -> <<_:O/binary, L:32/unsigned, _/binary>> = B,
+                      {{O, L + 4}, O + L + 4}
+        end).
+
+-define(TABLE_SPAN(P, B, O, L), ?LONGSTR_SPAN(P, B, O, L)).
+
+-define(FIXED_SPAN(P, O, N),
+        if P =:= 0 -> {undefined, O};
+           true    -> {{O, N}, O + N}
+        end).
+
+-define(BIT_SPAN(P, O),
+        if P =:= 0 -> {undefined, O};
+           true    -> {{O, 0}, O}
         end).
+
+encode_property_value(shortstr,  V) -> ?SHORTSTR_PROP(V, L);
+encode_property_value(longstr,   V) -> ?LONGSTR_PROP(V, L);
+encode_property_value(octet,     V) -> ?OCTET_PROP(V, L);
+encode_property_value(short,     V) -> ?SHORT_PROP(V, L);
+encode_property_value(long,      V) -> ?LONG_PROP(V, L);
+encode_property_value(longlong,  V) -> ?LONGLONG_PROP(V, L);
+encode_property_value(timestamp, V) -> ?TIMESTAMP_PROP(V, L);
+encode_property_value(table,     V) -> ?TABLE_PROP(V, T);
+encode_property_value(bit,      _V) -> <<>>.
+
+%% Only the bytes of the changed properties are encoded. The changes
+%% are applied in property order against the offsets of the original
+%% binary, so that the result is built once, from the new values and
+%% the untouched bytes between them. A property changed more than once
+%% gets the last of its values.
+patch_properties_bin(_ClassId, [], Bin) ->
+    Bin;
+patch_properties_bin(ClassId, Changes, <<Flags:16, _/binary>> = Bin) ->
+    Patches = lists:ukeysort(1, [{Index, Type, Value} ||
+                                    {Name, Value} <- lists:reverse(Changes),
+                                    {Index, Type} <- [property_info(ClassId, Name)]]),
+    patch_properties(Patches, property_offsets(ClassId, Bin), Bin, Flags, 2, []).
+
+patch_properties([], _Offsets, Bin, Flags, Pos, Acc) ->
+    Tail = binary:part(Bin, Pos, size(Bin) - Pos),
+    iolist_to_binary([<<Flags:16>> | lists:reverse(Acc, [Tail])]);
+patch_properties([{Index, Type, Value} | Patches], Offsets, Bin, Flags, Pos, Acc) ->
+    {Start, OldLen} = case element(Index + 1, Offsets) of
+                          undefined -> {insertion_offset(Offsets, Index), 0};
+                          Span      -> Span
+                      end,
+    Present = case Type of
+                  bit -> Value =:= true;
+                  _   -> Value =/= undefined
+              end,
+    Mask = 1 bsl (15 - Index),
+    {NewFlags, NewValue} = case Present of
+                               true  -> {Flags bor Mask,
+                                         encode_property_value(Type, Value)};
+                               false -> {Flags band (bnot Mask), <<>>}
+                           end,
+    patch_properties(Patches, Offsets, Bin, NewFlags, Start + OldLen,
+                     [NewValue, binary:part(Bin, Pos, Start - Pos) | Acc]).
+
+insertion_offset(_Offsets, 0) ->
+    2;
+insertion_offset(Offsets, Index) ->
+    case element(Index, Offsets) of
+        undefined   -> insertion_offset(Offsets, Index - 1);
+        {Off, Len}  -> Off + Len
+    end.
 """)
     version = "{%d, %d, %d}" % (spec.major, spec.minor, spec.revision)
     if version == '{8, 0, 0}': version = '{0, 8, 0}'
     print("version() -> %s." % (version))
 
-    for m in methods: genLookupMethodName(m)
+    genClauses(genLookupMethodName, hotMethods, coldMethods)
+    # The methods left out with --methods keep their names, so that
+    # rabbit_command_assembler:analyze_frame/3 hands their frames on
+    # and process/2 gets not_implemented from unknown_method/1.
+    for m in spec.prunedMethods:
+        genLookupMethodName(m)
     print("lookup_method_name({_ClassId, _MethodId} = Id) -> exit({unknown_method_id, Id}).")
 
-    for c in spec.allClasses(): genLookupClassName(c)
+    # A module pruned with --methods may have no class left.
+    if spec.allClasses():
+        genDenseLookup("lookup_class_name",
+                       [(c.index, c.erlangName()) for c in spec.allClasses()],
+                       "exit({unknown_class_id, Key})")
     print("lookup_class_name(ClassId) -> exit({unknown_class_id, ClassId}).")
 
-    for m in methods: genMethodId(m)
-    print("method_id(Name) -> exit({unknown_method_name, Name}).")
+    print("""
+%% The static metadata of a method, as one literal: {ClassId, MethodId},
+%% whether it carries content, whether it is synchronous (as in the
+%% spec, regardless of nowait; see is_method_synchronous/1), its field
+%% names and its record with the default field values.""")
+    for m in methods: genMethodInfo(m)
+    print("method_info(Name) -> exit({unknown_method_name, Name}).")
 
-    for m in methods: genMethodHasContent(m)
-    print("method_has_content(Name) -> exit({unknown_method_name, Name}).")
+    print("method_id(Name) -> element(1, method_info(Name)).")
+    print("method_has_content(Name) -> element(2, method_info(Name)).")
 
     for m in methods: genMethodIsSynchronous(m)
     print("is_method_synchronous(Name) -> exit({unknown_method_name, Name}).")
 
-    for m in methods: genMethodRecord(m)
-    print("method_record(Name) -> exit({unknown_method_name, Name}).")
+    print("method_record(Name) -> element(5, method_info(Name)).")
+    print("method_fieldnames(Name) -> element(4, method_info(Name)).")
 
-    for m in methods: genMethodFieldNames(m)
-    print("method_fieldnames(Name) -> exit({unknown_method_name, Name}).")
-
-    for m in methods: genDecodeMethodFields(m)
+    genClauses(genDecodeMethodFields, hotMethods, coldMethods)
+    for m in spec.prunedMethods:
+        print("decode_method_fields(%s, _BinaryFields) -> unknown_method(%s);" %
+              (m.erlangName(), m.erlangName()))
     print("decode_method_fields(Name, BinaryFields) ->")
     print("  rabbit_misc:frame_error(Name, BinaryFields).")
 
-    for c in spec.allClasses(): genDecodeProperties(c)
+    for (fun, name, names) in envelopeExtractors:
+        for m in methods:
+            if m.erlangName() == "'%s'" % (name,):
+                genDecodeEnvelope(fun, m, names)
+        pruned = [m for m in spec.prunedMethods if m.erlangName() == "'%s'" % (name,)]
+        if pruned:
+            print("%s(_BinaryFields) -> unknown_method(%s)." % (fun, pruned[0].erlangName()))
+        else:
+            print("%s(BinaryFields) ->" % (fun,))
+            print("  rabbit_misc:frame_error('%s', BinaryFields)." % (name,))
+
+    genClauses(genDecodeMethodFrame, hotMethods, coldMethods)
+    for m in spec.prunedMethods:
+        print("decode_method_frame(<<%d:16, %d:16, _/binary>>) -> unknown_method(%s);" %
+              (m.klass.index, m.index, m.erlangName()))
+    print("decode_method_frame(<<ClassId:16, MethodId:16, BinaryFields/binary>>) ->")
+    print("  rabbit_misc:frame_error(lookup_method_name({ClassId, MethodId}), BinaryFields).")
+    if spec.prunedMethods:
+        print("""
+%% Methods of the protocol this module was generated without (see
+%% --methods in codegen.py) are refused as not implemented.
+unknown_method(Name) ->
+  rabbit_misc:protocol_error(not_implemented, "method ~w is not supported", [Name]).""")
+    print("""
+%% Splits a buffer read from the socket into frames in one pass, and
+%% decodes the method frames of channels other than 0 on the way.
+%% Frames are returned as rabbit_command_assembler:analyze_frame/3
+%% would, except that decoded methods are {decoded_method, ClassId,
+%% Method, HasContent}. The pass stops at the first frame that is
+%% incomplete, larger than FrameMax, malformed or whose method does
+%% not decode; that frame and the rest of the buffer are returned for
+%% the caller to handle frame by frame.
+decode_frames(Buffer, FrameMax) ->
+    decode_frames(Buffer, FrameMax, []).
+
+decode_frames(<<Type:8, Channel:16, Size:32, Payload:Size/binary, ?FRAME_END,
+                Rest/binary>> = Buffer, FrameMax, Acc)
+  when FrameMax =:= 0 orelse Size + 8 =< FrameMax -> % 8: header and end octet
+    case decode_frame(Type, Channel, Payload) of
+        error -> {lists:reverse(Acc), Buffer};
+        Frame -> decode_frames(Rest, FrameMax, [{Channel, Frame} | Acc])
+    end;
+decode_frames(Buffer, _FrameMax, Acc) ->
+    {lists:reverse(Acc), Buffer}.
+
+decode_frame(?FRAME_METHOD, 0, <<ClassId:16, MethodId:16, Fields/binary>>) ->
+    try {method, lookup_method_name({ClassId, MethodId}), Fields}
+    catch exit:_ -> error
+    end;
+decode_frame(?FRAME_METHOD, _Channel,
+             <<ClassId:16, _MethodId:16, _/binary>> = Payload) ->
+    try decode_method_frame(Payload) of
+        {Method, HasContent} -> {decoded_method, ClassId, Method, HasContent}
+    catch exit:_ -> error
+    end;
+decode_frame(?FRAME_HEADER, _Channel,
+             <<ClassId:16, Weight:16, BodySize:64, Properties/binary>>) ->
+    {content_header, ClassId, Weight, BodySize, Properties};
+decode_frame(?FRAME_BODY, _Channel, Body) ->
+    {content_body, Body};
+decode_frame(?FRAME_HEARTBEAT, _Channel, <<>>) ->
+    heartbeat;
+decode_frame(_Type, _Channel, _Payload) ->
+    error.""")
+
+    for name in sorted(tableSchema):
+        genTableSchemaDecoder(name, tableSchema[name])
+
+    print("""
+%% The value of a table field of a method record. A lazy table (see
+%% --lazy-tables in codegen.py) stays unparsed in the record and is
+%% parsed again on every call, so callers that need the table more
+%% than once should call this once and keep the result.""")
+    for m in methods: genTableField(m)
+    print("table_field(Name, Record) -> exit({unknown_table_field, element(1, Record), Name}).")
+    if usesFieldType('table'):
+        print("""
+force_table({lazy_table, Bin}) -> rabbit_binary_parser:parse_table(Bin);
+force_table(Table)             -> Table.""")
+    if len([m for m in methods if isLazyTableMethod(m)]) > 0:
+        print("""
+table_bin({lazy_table, Bin}) -> Bin;
+table_bin(Table)             -> rabbit_binary_generator:generate_table(Table).
+
+table_bin_size({lazy_table, Bin}) -> size(Bin);
+table_bin_size(Table)             -> rabbit_binary_generator:table_size(Table).""")
+
+    genClauses(genDecodeProperties, hotClasses, coldClasses)
     print("decode_properties(ClassId, _BinaryFields) -> exit({unknown_class_id, ClassId}).")
 
-    for m in methods: genEncodeMethodFields(m)
+    genClauses(genDecodeProperty, hotClasses, coldClasses)
+    print("decode_property(ClassId, Name, _BinaryFields) -> exit({unknown_property, ClassId, Name}).")
+
+    genClauses(genPropertyOffsets, hotClasses, coldClasses)
+    print("property_offsets(ClassId, _BinaryFields) -> exit({unknown_class_id, ClassId}).")
+
+    genClauses(genPropertyInfo, hotClasses, coldClasses)
+    print("property_info(ClassId, Name) -> exit({unknown_property, ClassId, Name}).")
+
+    genClauses(genEncodeMethodFields, hotMethods, coldMethods)
     print("encode_method_fields(Record) -> exit({unknown_method_name, element(1, Record)}).")
 
-    for c in spec.allClasses(): genEncodeProperties(c)
+    genClauses(genEncodeMethodFrame, hotMethods, coldMethods)
+    print("encode_method_frame(_Channel, Record) -> exit({unknown_method_name, element(1, Record)}).")
+
+    print("""
+%% All the frames of a run of content-bearing commands, e.g. the
+%% deliveries queued by a writer between two socket flushes, as one
+%% iolist.
+encode_content_commands(Commands, FrameMax) ->
+    encode_content_commands(Commands, FrameMax, []).
+
+encode_content_commands([], _FrameMax, Acc) ->
+  lists:reverse(Acc);""")
+    genClauses(genEncodeContentCommand, [m for m in hotMethods if m.hasContent],
+               [m for m in coldMethods if m.hasContent])
+    print("encode_content_commands([{_Channel, Record, _Content} | _], _FrameMax, _Acc) ->")
+    print("  exit({unknown_content_method, element(1, Record)}).")
+
+    if codegenOptions["properties-encoder"] == "list":
+        for c in spec.allClasses(): genEncodeProperties(c)
+    else:
+        for c in spec.allClasses(): genEncodePropertiesSinglePass(c)
     print("encode_properties(Record) -> exit({unknown_properties_record, Record}).")
 
+    genClauses(genEncodedSize, hotMethods, coldMethods)
+    print("encoded_size(Record) -> exit({unknown_method_name, element(1, Record)}).")
+
+    genClauses(genEncodedPropertiesSize, hotClasses, coldClasses)
+    print("encoded_properties_size(Record) -> exit({unknown_properties_record, Record}).")
+
+    print("""
+%% The key rabbit_properties_cache keeps the encoding of a properties
+%% record under: the record itself, which only matches an identical
+%% record, tagged with this module since encodings are per protocol.
+%% Records with non-empty tables are not cached, hashing those costs
+%% about as much as encoding them, nor records with properties that
+%% change with every message, which would only ever miss.""")
+    genClauses(genPropertiesCacheKey, hotClasses, coldClasses)
+    print("properties_cache_key(_Record) -> uncacheable.")
+
     for (c,v,cls) in spec.constants: genLookupException(c,v,cls)
     print("lookup_amqp_exception(Code) ->")
     print("  rabbit_log:warning(\"Unknown AMQP error code '~p'~n\", [Code]),")
     print("  {true, ?INTERNAL_ERROR, <<\"INTERNAL_ERROR\">>}.")
 
-    for(c,v,cls) in spec.constants: genAmqpException(c,v,cls)
+    genAmqpExceptions(spec.constants)
     print("amqp_exception(_Code) -> undefined.")
 
+    genCodecCounters()
+
 def genHrl(spec):
     def fieldNameList(fields):
         return ', '.join([erlangize(f.name) for f in fields])
@@ -588,13 +1765,949 @@ def genHrl(spec):
         print("-record('P_%s', {%s})." % (erlangize(c.name), fieldNameList(c.fields)))
 
 
+# Representative field values used to build method records in the
+# generated benchmarks.
+erlangSampleValues = {
+    'shortstr': '<<"sample">>',
+    'longstr': '<<"sample long string">>',
+    'octet': '1',
+    'short': '1',
+    'long': '1',
+    'longlong': '1',
+    'timestamp': '1',
+    'bit': 'false',
+    'table': '[{<<"key">>, longstr, <<"value">>}]'
+}
+
+def sampleRecord(spec, recordName, fields, tableValue = None):
+    def sampleValue(f):
+        type = erlangize(spec.resolveDomain(f.domain))
+        if type == 'table' and tableValue is not None:
+            return tableValue
+        return erlangSampleValues[type]
+    return "#%s{%s}" % (recordName,
+                        ', '.join(["%s = %s" % (erlangize(f.name), sampleValue(f))
+                                   for f in fields]))
+
+def sampleMethodRecord(spec, m):
+    return sampleRecord(spec, m.erlangName(), m.arguments)
+
+def hasTableField(spec, fields):
+    return any(spec.resolveDomain(f.domain) == 'table' for f in fields)
+
+def genProfileBench(spec):
+    profile = None
+    if codegenOptions["profile"] is not None:
+        profile = loadMethodProfile(codegenOptions["profile"])
+    (hot, cold) = splitHotMethods(spec.allMethods(), profile)
+
+    printFileHeader()
+    print("""-module(rabbit_framing_profile_bench).
+-include("rabbit_framing.hrl").
+
+-export([run/2, run/3]).
+
+%% Compares the per-call cost of method frame decoding (method name
+%% lookup followed by field decoding) between a framing module
+%% generated in spec order and one generated with --profile, e.g.
+%%
+%%   rabbit_framing_profile_bench:run(rabbit_framing_amqp_0_9_1_baseline,
+%%                                    rabbit_framing_amqp_0_9_1, 1000000).
+%%
+%% Hot methods of the profile are listed first.
+
+run(Baseline, Profiled) ->
+    run(Baseline, Profiled, 1000000).
+
+run(Baseline, Profiled, Iterations) ->
+    io:format("~-32s ~12s ~12s ~8s~n",
+              ["method", "baseline ns", "profiled ns", "ratio"]),
+    lists:foreach(
+      fun (Record) ->
+              Name = element(1, Record),
+              Id = Profiled:method_id(Name),
+              Fields = iolist_to_binary(Profiled:encode_method_fields(Record)),
+              B = ns_per_call(Baseline, Id, Fields, Iterations),
+              P = ns_per_call(Profiled, Id, Fields, Iterations),
+              io:format("~-32s ~12.1f ~12.1f ~8.2f~n",
+                        [Name, B, P, ratio(B, P)])
+      end, records()).
+
+ns_per_call(Protocol, Id, Fields, Iterations) ->
+    {Micros, ok} = timer:tc(fun () ->
+                                    loop(Protocol, Id, Fields, Iterations)
+                            end),
+    Micros * 1000 / Iterations.
+
+loop(_Protocol, _Id, _Fields, 0) ->
+    ok;
+loop(Protocol, Id, Fields, N) ->
+    Name = Protocol:lookup_method_name(Id),
+    _ = Protocol:decode_method_fields(Name, Fields),
+    loop(Protocol, Id, Fields, N - 1).
+
+ratio(B, P) when P > 0 -> B / P;
+ratio(_B, _P)          -> 0.0.
+""")
+    print("records() ->")
+    print("    [%s]." % ',\n     '.join([sampleMethodRecord(spec, m) for m in hot + cold]))
+
+def genBench(spec):
+    module = framingModuleName(spec)
+
+    printFileHeader()
+    print("""-module(%(module)s_bench).
+-include("rabbit_framing.hrl").
+
+-export([run/0, run/1]).
+
+%%%% Times encoding and decoding of a synthetic record for every method
+%%%% and every content class of %(module)s, e.g.
+%%%%
+%%%%   %(module)s_bench:run(100000).
+%%%%
+%%%% Methods and classes with table fields are also run with a large
+%%%% table (?LARGE_TABLE_SIZE entries). Bytes per call are approximate:
+%%%% heap growth of a fresh process plus any off-heap binaries it
+%%%% references, less the cost of an empty call.
+
+-define(LARGE_TABLE_SIZE, 100).
+
+run() ->
+    run(100000).
+
+run(Iterations) ->
+    io:format("~-48s ~-6s ~12s ~10s~n", ["case", "op", "ops/sec", "bytes"]),
+    lists:foreach(
+      fun ({Label, Record}) ->
+              Name = element(1, Record),
+              Bin = iolist_to_binary(%(module)s:encode_method_fields(Record)),
+              report(Label, encode, Iterations,
+                     fun () -> %(module)s:encode_method_fields(Record) end),
+              report(Label, decode, Iterations,
+                     fun () -> %(module)s:decode_method_fields(Name, Bin) end)
+      end, methods()),
+    lists:foreach(
+      fun ({Label, ClassId, Record}) ->
+              Bin = %(module)s:encode_properties(Record),
+              report(Label, encode, Iterations,
+                     fun () -> %(module)s:encode_properties(Record) end),
+              report(Label, decode, Iterations,
+                     fun () -> %(module)s:decode_properties(ClassId, Bin) end)
+      end, properties()).
+
+report(Label, Op, Iterations, Fun) ->
+    {Micros, ok} = timer:tc(fun () -> loop(Fun, Iterations) end),
+    io:format("~-48s ~-6s ~12b ~10b~n",
+              [Label, Op, ops_per_sec(Iterations, Micros),
+               allocated(Fun) - allocated(fun () -> ok end)]).
+
+loop(_Fun, 0) ->
+    ok;
+loop(Fun, N) ->
+    _ = Fun(),
+    loop(Fun, N - 1).
+
+ops_per_sec(Iterations, Micros) when Micros > 0 -> Iterations * 1000000 div Micros;
+ops_per_sec(_Iterations, _Micros)               -> 0.
+
+allocated(Fun) ->
+    Parent = self(),
+    Pid = spawn_opt(fun () ->
+                            Before = used_bytes(),
+                            _ = Fun(),
+                            Parent ! {self(), used_bytes() - Before}
+                    end, [{min_heap_size, 1 bsl 20}]),
+    receive {Pid, Bytes} -> Bytes end.
+
+used_bytes() ->
+    {garbage_collection_info, Info} =
+        process_info(self(), garbage_collection_info),
+    {binary, Bins} = process_info(self(), binary),
+    proplists:get_value(heap_size, Info) * erlang:system_info(wordsize) +
+        lists:sum([Size || {_Id, Size, _RefCount} <- Bins]).
+
+large_table() ->
+    [{<<"header-", (integer_to_binary(N))/binary>>, longstr,
+      <<"sample header value">>} || N <- lists:seq(1, ?LARGE_TABLE_SIZE)].
+""" % {'module': module})
+
+    methods = []
+    for m in spec.allMethods():
+        label = "%s.%s" % (m.klass.name, m.name)
+        methods.append('{"%s", %s}' % (label, sampleMethodRecord(spec, m)))
+        if hasTableField(spec, m.arguments):
+            methods.append('{"%s (large table)", %s}' %
+                           (label, sampleRecord(spec, m.erlangName(), m.arguments,
+                                                'large_table()')))
+    print("methods() ->")
+    print("    [%s]." % ',\n     '.join(methods))
+    print()
+
+    properties = []
+    for c in spec.allClasses():
+        if not c.fields:
+            continue
+        recordName = "'P_%s'" % erlangize(c.name)
+        properties.append('{"%s properties", %d, %s}' %
+                          (c.name, c.index, sampleRecord(spec, recordName, c.fields)))
+        if hasTableField(spec, c.fields):
+            properties.append('{"%s properties (large table)", %d, %s}' %
+                              (c.name, c.index,
+                               sampleRecord(spec, recordName, c.fields, 'large_table()')))
+    print("properties() ->")
+    print("    [%s]." % ',\n     '.join(properties))
+
+# Formats of the fixed-width field types for the generated Python codec.
+pythonStructFormats = {
+    'octet': 'B',
+    'short': 'H',
+    'long': 'I',
+    'longlong': 'Q',
+    'timestamp': 'Q'
+}
+
+def pythonClassName(name):
+    return ''.join([w.capitalize() for w in re.split('[-_. ]', name)])
+
+def pythonFieldName(f):
+    name = erlangize(f.name)
+    if keyword.iskeyword(name):
+        name += '_'
+    return name
+
+def pythonDefaultValue(spec, f):
+    type = spec.resolveDomain(f.domain)
+    value = f.defaultvalue
+    if type in ('shortstr', 'longstr'):
+        return repr((value or '').encode('utf-8'))
+    elif type == 'bit':
+        return repr(bool(value))
+    elif type == 'table':
+        return 'None'
+    return repr(int(value or 0))
+
+def genPython(spec):
+    def pyType(f):
+        return spec.resolveDomain(f.domain)
+
+    def slotName(f):
+        if pyType(f) in ('shortstr', 'longstr', 'table'):
+            return '_' + pythonFieldName(f)
+        return pythonFieldName(f)
+
+    def packFields(fields):
+        # Same grouping of consecutive bits into octets as the Erlang
+        # codec, see packMethodFields.
+        packed = []
+        bitfield = None
+        for f in fields:
+            if pyType(f) == 'bit':
+                if not(bitfield) or bitfield.full():
+                    bitfield = PackedMethodBitField(f.index)
+                    packed.append(bitfield)
+                bitfield.extend(f)
+            else:
+                bitfield = None
+                packed.append(f)
+        return packed
+
+    def structRuns(fields):
+        # Splits the packed fields into runs of fixed-width fields
+        # (unpacked with one struct.Struct each) and single variable
+        # width fields.
+        runs = []
+        run = None
+        for f in packFields(fields):
+            if f.domain == 'bit' or pyType(f) in pythonStructFormats:
+                if run is None:
+                    run = []
+                    runs.append(run)
+                run.append(f)
+            else:
+                run = None
+                runs.append(f)
+        return runs
+
+    def structFormat(run):
+        return '>' + ''.join([f.domain == 'bit' and 'B' or pythonStructFormats[pyType(f)]
+                              for f in run])
+
+    structs = []
+    def namedRuns(prefix, fields):
+        # Each run of fixed-width fields gets a module-level
+        # struct.Struct, shared by the decoder and the encoder.
+        named = []
+        for run in structRuns(fields):
+            if isinstance(run, list):
+                name = '_%s_%d' % (prefix.upper(), len([n for (n, _) in named if n]))
+                structs.append((name, structFormat(run)))
+                named.append((name, run))
+            else:
+                named.append((None, run))
+        return named
+
+    def bitsExpr(bitfield):
+        return ' | '.join(['(%d if self.%s else 0)' % (1 << i, slotName(f))
+                           for (i, f) in enumerate(bitfield.contents)])
+
+    def genDecodeRuns(runs, lines):
+        for (name, run) in runs:
+            if name is not None:
+                targets = []
+                for f in run:
+                    if f.domain == 'bit':
+                        targets.append('bits%d' % (f.index,))
+                    else:
+                        targets.append('self.%s' % (slotName(f),))
+                lines.append('%s, = %s.unpack_from(view, o)' % (', '.join(targets), name)
+                             if len(targets) == 1 else
+                             '%s = %s.unpack_from(view, o)' % (', '.join(targets), name))
+                lines.append('o += %d' % (struct.calcsize(structFormat(run)),))
+                for f in run:
+                    if f.domain == 'bit':
+                        for (i, b) in enumerate(f.contents):
+                            lines.append('self.%s = bits%d & %d != 0' %
+                                         (slotName(b), f.index, 1 << i))
+            else:
+                genDecodeVariable(run, lines)
+
+    def genDecodeVariable(f, lines):
+        if pyType(f) == 'shortstr':
+            lines.append('n = view[o] + 1')
+            lines.append('self.%s = view[o + 1:o + n]' % (slotName(f),))
+        else:
+            lines.append('n, = _LONG.unpack_from(view, o)')
+            lines.append('n += 4')
+            lines.append('self.%s = view[o + 4:o + n]' % (slotName(f),))
+        lines.append('o += n')
+
+    def genEncodeRuns(runs, lines):
+        for (name, run) in runs:
+            if name is not None:
+                args = []
+                for f in run:
+                    if f.domain == 'bit':
+                        args.append(bitsExpr(f))
+                    else:
+                        args.append('self.%s' % (slotName(f),))
+                lines.append('%s.pack(%s)' % (name, ', '.join(args)))
+            else:
+                lines.append(encodeVariable(run))
+
+    def encodeVariable(f):
+        fun = {'shortstr': '_shortstr', 'longstr': '_longstr', 'table': '_table'}[pyType(f)]
+        return '%s(self.%s)' % (fun, pythonFieldName(f))
+
+    def genAccessors(fields):
+        for f in fields:
+            if pyType(f) in ('shortstr', 'longstr'):
+                print("    %s = _bytes_field('%s')" % (pythonFieldName(f), slotName(f)))
+            elif pyType(f) == 'table':
+                print("    %s = _table_field('%s')" % (pythonFieldName(f), slotName(f)))
+
+    def genSlots(fields):
+        slots = ["'%s'" % (slotName(f),) for f in fields]
+        if len(slots) == 1:
+            slots.append('')
+        print("    __slots__ = (%s)" % (', '.join(slots),))
+        print("    FIELDS = (%s)" % (', '.join(["'%s'" % (pythonFieldName(f),) for f in fields] +
+                                             ([''] if len(fields) == 1 else [])),))
+
+    def printBody(lines, indent = 8):
+        for line in lines:
+            print(' ' * indent + line)
+
+    def genMethodClass(m):
+        prefix = erlangize('%s_%s' % (m.klass.name, m.name))
+        print()
+        print("class %s(Method):" % (pythonClassName('%s.%s' % (m.klass.name, m.name)),))
+        genSlots(m.arguments)
+        print("    NAME = '%s.%s'" % (erlangize(m.klass.name), erlangize(m.name)))
+        print("    CLASS_ID = %d" % (m.klass.index,))
+        print("    METHOD_ID = %d" % (m.index,))
+        print("    HAS_CONTENT = %s" % (m.hasContent and 'True' or 'False',))
+        print("    SYNCHRONOUS = %s" % (m.isSynchronous and 'True' or 'False',))
+        genAccessors(m.arguments)
+        print()
+        args = ''.join([', %s=%s' % (pythonFieldName(f), pythonDefaultValue(spec, f))
+                        for f in m.arguments])
+        print("    def __init__(self%s):" % (args,))
+        if not m.arguments:
+            print("        pass")
+        for f in m.arguments:
+            if pyType(f) == 'table':
+                print("        self.%s = %s or []" % (slotName(f), pythonFieldName(f)))
+            else:
+                print("        self.%s = %s" % (slotName(f), pythonFieldName(f)))
+        print()
+        print("    @classmethod")
+        print("    def decode(cls, view):")
+        print("        self = cls.__new__(cls)")
+        lines = ['o = 0']
+        runs = namedRuns(prefix, m.arguments)
+        genDecodeRuns(runs, lines)
+        lines.append('if o != len(view):')
+        lines.append('    raise DecodeError("%s: %%d bytes for %%d" %% (o, len(view)))' %
+                     (m.erlangName().strip("'"),))
+        lines.append('return self')
+        printBody(lines)
+        print()
+        print("    def encode(self):")
+        lines = []
+        genEncodeRuns(runs, lines)
+        if not lines:
+            print("        return b''")
+        elif len(lines) == 1:
+            print("        return %s" % (lines[0],))
+        else:
+            print("        return b''.join((")
+            printBody([l + ',' for l in lines], 12)
+            print("        ))")
+
+    def genPropertiesClass(c):
+        print()
+        print("class %sProperties(Properties):" % (pythonClassName(c.name),))
+        genSlots(c.fields)
+        print("    CLASS_ID = %d" % (c.index,))
+        genAccessors(c.fields)
+        print()
+        args = ''.join([', %s=None' % (pythonFieldName(f),) for f in c.fields])
+        print("    def __init__(self%s):" % (args,))
+        if not c.fields:
+            print("        pass")
+        for f in c.fields:
+            print("        self.%s = %s" % (slotName(f), pythonFieldName(f)))
+        print()
+        print("    @classmethod")
+        print("    def decode(cls, view):")
+        print("        self = cls.__new__(cls)")
+        lines = ['flags, = _SHORT.unpack_from(view, 0)', 'o = 2']
+        for f in c.fields:
+            flag = '0x%04x' % (1 << (15 - f.index),)
+            if pyType(f) == 'bit':
+                lines.append('self.%s = flags & %s != 0' % (slotName(f), flag))
+                continue
+            lines.append('if flags & %s:' % (flag,))
+            body = []
+            if pyType(f) in pythonStructFormats:
+                body.append('self.%s, = %s.unpack_from(view, o)' %
+                            (slotName(f), pythonStructName(pyType(f))))
+                body.append('o += %d' % (struct.calcsize('>' + pythonStructFormats[pyType(f)]),))
+            else:
+                genDecodeVariable(f, body)
+            lines += ['    ' + l for l in body]
+            lines.append('else:')
+            lines.append('    self.%s = None' % (slotName(f),))
+        lines.append('if o != len(view):')
+        lines.append('    raise DecodeError("%s properties: %%d bytes for %%d" %% (o, len(view)))' %
+                     (c.name,))
+        lines.append('return self')
+        printBody(lines)
+        print()
+        print("    def encode(self):")
+        lines = ['flags = 0', 'parts = [None]']
+        for f in c.fields:
+            flag = '0x%04x' % (1 << (15 - f.index),)
+            if pyType(f) == 'bit':
+                lines.append('if self.%s:' % (slotName(f),))
+                lines.append('    flags |= %s' % (flag,))
+                continue
+            lines.append('if self.%s is not None:' % (slotName(f),))
+            lines.append('    flags |= %s' % (flag,))
+            if pyType(f) in pythonStructFormats:
+                lines.append('    parts.append(%s.pack(self.%s))' %
+                             (pythonStructName(pyType(f)), slotName(f)))
+            else:
+                lines.append('    parts.append(%s)' % (encodeVariable(f),))
+        lines.append('parts[0] = _SHORT.pack(flags)')
+        lines.append("return b''.join(parts)")
+        printBody(lines)
+
+    def pythonStructName(type):
+        return '_' + type.upper()
+
+    methods = spec.allMethods()
+    classes = spec.allClasses()
+
+    print("#!/usr/bin/env python")
+    printFileHeader("##")
+    print('''
+"""AMQP %(major)d-%(minor)d-%(revision)d frame codec generated from the spec.
+
+Method and properties records are __slots__ classes with a decode(view)
+class method and an encode() method. Runs of fixed-width fields are
+unpacked with one precompiled struct.Struct each, and consecutive bit
+fields share an octet as on the wire. Decoding slices string and table
+fields out of the frame as memoryviews: they are only copied to bytes,
+or parsed into a [(name, type, value)] table, when first read.
+
+Needs Python 3.
+"""
+
+import struct
+
+PROTOCOL_VERSION = (%(major)d, %(minor)d, %(revision)d)
+PROTOCOL_PORT = %(port)d
+''' % {'major': spec.major, 'minor': spec.minor, 'revision': spec.revision,
+       'port': spec.port})
+    for (c, v, cls) in spec.constants:
+        print("%s = %s" % (erlangConstantName(c), v))
+    print('''
+
+class DecodeError(Exception):
+    pass
+
+
+_OCTET = struct.Struct('>B')
+_SHORT = struct.Struct('>H')
+_LONG = struct.Struct('>I')
+_LONGLONG = struct.Struct('>Q')
+_TIMESTAMP = _LONGLONG
+_METHOD_ID = struct.Struct('>HH')
+_FRAME_HEADER = struct.Struct('>BHI')
+_CONTENT_HEADER = struct.Struct('>HHQ')
+_FRAME_END = 206
+
+# Field table and array values, as in rabbit_binary_parser. Types are
+# named as in Erlang: (name, 'longstr', b'value').
+_TABLE_STRUCTS = {
+    ord('b'): ('byte', struct.Struct('>b')),
+    ord('B'): ('unsignedbyte', struct.Struct('>B')),
+    ord('s'): ('short', struct.Struct('>h')),
+    ord('u'): ('unsignedshort', struct.Struct('>H')),
+    ord('I'): ('signedint', struct.Struct('>i')),
+    ord('i'): ('unsignedint', struct.Struct('>I')),
+    ord('l'): ('long', struct.Struct('>q')),
+    ord('L'): ('long', struct.Struct('>q')),
+    ord('d'): ('double', struct.Struct('>d')),
+    ord('f'): ('float', struct.Struct('>f')),
+    ord('T'): ('timestamp', struct.Struct('>Q')),
+}
+_TABLE_TAGS = {
+    'longstr': b'S', 'byte': b'b', 'unsignedbyte': b'B', 'short': b's',
+    'unsignedshort': b'u', 'signedint': b'I', 'unsignedint': b'i',
+    'long': b'l', 'double': b'd', 'float': b'f', 'timestamp': b'T',
+    'bool': b't', 'decimal': b'D', 'table': b'F', 'array': b'A',
+    'binary': b'x', 'void': b'V',
+}
+_DECIMAL = struct.Struct('>BI')
+
+
+def _decode_value(view, o):
+    tag = view[o]
+    o += 1
+    if tag in _TABLE_STRUCTS:
+        type, s = _TABLE_STRUCTS[tag]
+        value, = s.unpack_from(view, o)
+        return type, value, o + s.size
+    if tag in (0x53, 0x78, 0x46, 0x41):  # S x F A
+        n, = _LONG.unpack_from(view, o)
+        value = view[o + 4:o + 4 + n]
+        if len(value) != n:
+            raise DecodeError("truncated table value")
+        o += 4 + n
+        if tag == 0x53:
+            return 'longstr', value.tobytes(), o
+        elif tag == 0x78:
+            return 'binary', value.tobytes(), o
+        elif tag == 0x46:
+            return 'table', decode_table(value), o
+        return 'array', decode_array(value), o
+    if tag == 0x74:  # t
+        return 'bool', view[o] != 0, o + 1
+    if tag == 0x44:  # D
+        return 'decimal', _DECIMAL.unpack_from(view, o), o + 5
+    if tag == 0x56:  # V
+        return 'void', None, o
+    raise DecodeError("unknown field value type %r" % (chr(tag),))
+
+
+def decode_table(view):
+    """Parses an encoded field table into [(name, type, value)]."""
+    view = memoryview(view)
+    table = []
+    o = 0
+    try:
+        while o < len(view):
+            n = view[o] + 1
+            name = view[o + 1:o + n].tobytes()
+            type, value, o = _decode_value(view, o + n)
+            table.append((name, type, value))
+    except (struct.error, IndexError):
+        raise DecodeError("truncated table")
+    return table
+
+
+def decode_array(view):
+    """Parses an encoded field array into [(type, value)]."""
+    view = memoryview(view)
+    array = []
+    o = 0
+    try:
+        while o < len(view):
+            type, value, o = _decode_value(view, o)
+            array.append((type, value))
+    except (struct.error, IndexError):
+        raise DecodeError("truncated array")
+    return array
+
+
+def _encode_value(type, value):
+    tag = _TABLE_TAGS[type]
+    if type in ('longstr', 'binary'):
+        return tag + _LONG.pack(len(value)) + value
+    elif type == 'table':
+        return tag + _longstr(encode_table(value))
+    elif type == 'array':
+        return tag + _longstr(encode_array(value))
+    elif type == 'bool':
+        return tag + (b'\\x01' if value else b'\\x00')
+    elif type == 'decimal':
+        return tag + _DECIMAL.pack(*value)
+    elif type == 'void':
+        return tag
+    return tag + _TABLE_STRUCTS[ord(tag)][1].pack(value)
+
+
+def encode_table(table):
+    return b''.join([_shortstr(name) + _encode_value(type, value)
+                     for (name, type, value) in table])
+
+
+def encode_array(array):
+    return b''.join([_encode_value(type, value) for (type, value) in array])
+
+
+def _shortstr(value):
+    if len(value) > 255:
+        raise ValueError("shortstr too long: %d bytes" % (len(value),))
+    return _OCTET.pack(len(value)) + value
+
+
+def _longstr(value):
+    return _LONG.pack(len(value)) + value
+
+
+def _table(value):
+    return _longstr(encode_table(value or []))
+
+
+def _bytes_field(slot):
+    # A string field as decoded is a memoryview of the frame; it is
+    # copied out the first time it is read.
+    def get(self):
+        value = getattr(self, slot)
+        if type(value) is memoryview:
+            value = value.tobytes()
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+    return property(get, set)
+
+
+def _table_field(slot):
+    # Likewise for tables, which are parsed when first read.
+    def get(self):
+        value = getattr(self, slot)
+        if type(value) is memoryview:
+            value = decode_table(value)
+            setattr(self, slot, value)
+        return value
+
+    def set(self, value):
+        setattr(self, slot, value)
+    return property(get, set)
+
+
+class Record(object):
+    __slots__ = ()
+    FIELDS = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \\
+            all(getattr(self, f) == getattr(other, f) for f in self.FIELDS)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(['%s=%r' % (f, getattr(self, f))
+                                      for f in self.FIELDS]))
+
+
+class Method(Record):
+    __slots__ = ()
+
+
+class Properties(Record):
+    __slots__ = ()''')
+
+    for m in methods:
+        genMethodClass(m)
+    for c in classes:
+        genPropertiesClass(c)
+
+    print()
+    print()
+    for (name, fmt) in structs:
+        print("%s = struct.Struct('%s')" % (name, fmt))
+    print()
+    print("METHODS = {")
+    for m in methods:
+        print("    (%d, %d): %s," % (m.klass.index, m.index,
+                                     pythonClassName('%s.%s' % (m.klass.name, m.name))))
+    print("}")
+    print()
+    print("PROPERTIES = {")
+    for c in classes:
+        print("    %d: %sProperties," % (c.index, pythonClassName(c.name)))
+    print("}")
+    print('''
+
+def decode_method_frame(payload):
+    """Decodes the payload of a method frame into a method record."""
+    view = memoryview(payload)
+    try:
+        class_id, method_id = _METHOD_ID.unpack_from(view, 0)
+        cls = METHODS.get((class_id, method_id))
+        if cls is None:
+            raise DecodeError("unknown method %d.%d" % (class_id, method_id))
+        return cls.decode(view[4:])
+    except (struct.error, IndexError):
+        raise DecodeError("truncated method frame")
+
+
+def decode_content_header(payload):
+    """Decodes the payload of a content header frame into
+    (class_id, body_size, properties)."""
+    view = memoryview(payload)
+    try:
+        class_id, _weight, body_size = _CONTENT_HEADER.unpack_from(view, 0)
+        cls = PROPERTIES.get(class_id)
+        if cls is None:
+            raise DecodeError("unknown class %d" % (class_id,))
+        return class_id, body_size, cls.decode(view[12:])
+    except (struct.error, IndexError):
+        raise DecodeError("truncated content header")
+
+
+def decode_frames(buf, frame_max=0):
+    """Splits buf into frames in one pass, without copying it.
+
+    Returns (frames, offset): frames is a list of (type, channel,
+    payload), where the payload of a method frame is the decoded
+    method record, that of a content header frame the result of
+    decode_content_header, and any other payload a memoryview of buf.
+    offset is where the first incomplete frame starts. A frame larger
+    than frame_max (if not 0), not terminated by a frame end octet or
+    not decodable raises DecodeError."""
+    view = memoryview(buf)
+    frames = []
+    o = 0
+    end = len(view)
+    while end - o >= 8:
+        type, channel, size = _FRAME_HEADER.unpack_from(view, o)
+        if frame_max and size + 8 > frame_max:
+            raise DecodeError("frame of %d bytes exceeds frame_max %d" % (size + 8, frame_max))
+        if end - o < size + 8:
+            break
+        if view[o + 7 + size] != _FRAME_END:
+            raise DecodeError("bad frame end on channel %d" % (channel,))
+        payload = view[o + 7:o + 7 + size]
+        if type == FRAME_METHOD:
+            payload = decode_method_frame(payload)
+        elif type == FRAME_HEADER:
+            payload = decode_content_header(payload)
+        frames.append((type, channel, payload))
+        o += size + 8
+    return frames, o
+
+
+def encode_method_frame(channel, method):
+    payload = method.encode()
+    return b''.join((_FRAME_HEADER.pack(FRAME_METHOD, channel, len(payload) + 4),
+                     _METHOD_ID.pack(method.CLASS_ID, method.METHOD_ID),
+                     payload, b'\\xce'))
+
+
+def encode_content_frames(channel, properties, body, frame_max=0):
+    """Encodes the content header and body frames of a content."""
+    props = properties.encode()
+    frames = [_FRAME_HEADER.pack(FRAME_HEADER, channel, len(props) + 12),
+              _CONTENT_HEADER.pack(properties.CLASS_ID, 0, len(body)),
+              props, b'\\xce']
+    chunk = frame_max - 8 if frame_max else max(len(body), 1)
+    for o in range(0, len(body), chunk):
+        fragment = body[o:o + chunk]
+        frames += [_FRAME_HEADER.pack(FRAME_BODY, channel, len(fragment)),
+                   fragment, b'\\xce']
+    return b''.join(frames)''')
+
+def prunedMethodNames():
+    return set([erlangize(n.strip()) for n in codegenOptions["methods"].split(',')])
+
+def checkPrunedMethodNames(spec):
+    """Rejects the --methods entries naming no class or method of spec,
+    which "all" merges from the specs of every body: an entry missing
+    from the spec of one body only is left for the others."""
+    known = set([erlangize(c.name) for c in spec.allClasses()] +
+                [methodProfileKey(m) for m in spec.allMethods()])
+    unknown = sorted([n for n in prunedMethodNames() if n not in known])
+    if unknown:
+        raise Exception("Unknown classes or methods in --methods: " + ', '.join(unknown))
+
+def loadSpec(specPath):
+    """Loads the spec, keeping only the classes and methods named by
+    --methods when it is given. A class is kept with all its methods
+    when named, and with the named methods otherwise. The methods left
+    out are listed in spec.prunedMethods, so that the framing module
+    can still refuse them cleanly. Names missing from the spec are
+    ignored, as with --overlay, so that one list can serve both
+    protocol versions; see checkPrunedMethodNames."""
+    spec = AmqpSpec(specPath)
+    spec.prunedMethods = []
+    if codegenOptions["methods"] is None:
+        return spec
+    names = prunedMethodNames()
+    classes = []
+    for c in spec.allClasses():
+        kept = []
+        for m in c.allMethods():
+            if erlangize(c.name) in names or methodProfileKey(m) in names:
+                kept.append(m)
+            else:
+                spec.prunedMethods.append(m)
+        c.methods = kept
+        if kept or erlangize(c.name) in names:
+            classes.append(c)
+    spec.classes = classes
+    return spec
+
 def generateErl(specPath):
-    genErl(AmqpSpec(specPath))
+    genErl(loadSpec(specPath))
 
 def generateHrl(specPath):
+    # The header is shared by every framing module and included all
+    # over rabbit_common, so it always has all the records.
     genHrl(AmqpSpec(specPath))
 
+def generateProfileBench(specPath):
+    genProfileBench(loadSpec(specPath))
+
+def generateBench(specPath):
+    genBench(loadSpec(specPath))
+
+def generatePython(specPath):
+    genPython(loadSpec(specPath))
+
+def codegenInputsHash(specPaths, targets):
+    inputs = [__file__, sys.modules['amqp_codegen'].__file__] + specPaths
+    for name in ["profile", "overlay", "table-schema"]:
+        if codegenOptions[name] is not None:
+            inputs.append(codegenOptions[name])
+    h = hashlib.sha256()
+    for path in inputs:
+        if path.endswith(".pyc"):
+            path = path[:-1]
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    h.update(repr((sorted(codegenOptions.items()), targets)).encode("utf-8"))
+    return h.hexdigest()
+
+def readFileIfExists(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def writeFileAtomically(path, contents):
+    # Files whose contents did not change keep their timestamp, so
+    # make does not rebuild what depends on them.
+    if readFileIfExists(path) == contents:
+        return
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmpPath, 'w') as f:
+            f.write(contents)
+        getattr(os, 'replace', os.rename)(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
+def captureOutput(fn, spec):
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        fn(spec)
+    finally:
+        sys.stdout = stdout
+    return output.getvalue()
+
+def generateAll(args):
+    """codegen.py [--name=value ...] all HEADER BODY=SPEC[,SPEC...] ...
+
+    Generates the header and every body in one process. Each body is
+    built from its own specs; the header from all of them merged in
+    order with conflicts ignored, as the header target does. Output
+    is buffered and each file replaced atomically, and nothing is
+    regenerated while --stamp holds the hash of the same inputs. The
+    stamp is touched either way: make only compares it, not the outputs,
+    with the inputs (see development.post.mk)."""
+    if len(args) < 2:
+        raise Exception("Usage: codegen.py [--name=value ...] all "
+                        "<header.hrl> <body.erl>=<spec.json>[,<spec.json>...] ...")
+    if codegenOptions["module"] is not None:
+        raise Exception("--module cannot be used with 'all'")
+    header = args[0]
+    bodies = []
+    for arg in args[1:]:
+        (path, sep, specs) = arg.partition("=")
+        if not sep or not specs:
+            raise Exception("Expected <body.erl>=<spec.json>[,...], got " + arg)
+        bodies.append((path, specs.split(",")))
+    specPaths = [p for (_, specs) in bodies for p in specs]
+
+    stamp = codegenOptions["stamp"]
+    targets = [header] + [path for (path, _) in bodies]
+    inputsHash = codegenInputsHash(specPaths, [header] + bodies)
+    if stamp is not None and readFileIfExists(stamp) == inputsHash and \
+            all(os.path.exists(t) for t in targets):
+        os.utime(stamp, None)
+        return
+
+    outputs = []
+    for (path, specs) in bodies:
+        outputs.append((path, captureOutput(genErl, loadSpec(specs))))
+    AmqpSpec.ignore_conflicts = True
+    try:
+        headerSpec = AmqpSpec(specPaths)
+    finally:
+        AmqpSpec.ignore_conflicts = False
+    if codegenOptions["methods"] is not None:
+        checkPrunedMethodNames(headerSpec)
+    outputs.append((header, captureOutput(genHrl, headerSpec)))
+
+    for (path, contents) in outputs:
+        writeFileAtomically(path, contents)
+    if stamp is not None:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(stamp))):
+            os.makedirs(os.path.dirname(os.path.abspath(stamp)))
+        writeFileAtomically(stamp, inputsHash)
+        os.utime(stamp, None)
+
 if __name__ == "__main__":
-    do_main_dict({"header": generateHrl,
-                  "body": generateErl})
+    sys.argv = extractCodegenOptions(sys.argv)
+    if len(sys.argv) > 1 and sys.argv[1] == "all":
+        generateAll(sys.argv[2:])
+    else:
+        do_main_dict({"header": generateHrl,
+                      "body": generateErl,
+                      "profile_bench": generateProfileBench,
+                      "bench": generateBench,
+                      "python": generatePython})
 
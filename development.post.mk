@@ -11,23 +11,121 @@ AMQP_SPEC_JSON_FILES_0_8   = $(CODEGEN_DIR)/amqp-rabbitmq-0.8.json
 AMQP_SPEC_JSON_FILES_0_9_1 = $(CODEGEN_DIR)/amqp-rabbitmq-0.9.1.json	\
 			     $(CODEGEN_DIR)/credit_extension.json
 
-include/rabbit_framing.hrl:: $(CODEGEN) $(CODEGEN_AMQP) \
-    $(AMQP_SPEC_JSON_FILES_0_9_1) $(AMQP_SPEC_JSON_FILES_0_8)
-	$(gen_verbose) env PYTHONPATH=$(CODEGEN_DIR) \
-	 $(PYTHON) $(CODEGEN) --ignore-conflicts header \
-	 $(AMQP_SPEC_JSON_FILES_0_9_1) $(AMQP_SPEC_JSON_FILES_0_8) $@
+# Optional method-frequency profile (a JSON object mapping method names
+# to call counts): the hottest methods get a dedicated clause group at
+# the top of the generated dispatch functions. A node running framing
+# modules built with codec counters dumps one with
+# rabbit_core_metrics:codec_profile/0.
+AMQP_METHOD_PROFILE ?=
+# Optional codegen overlay (JSON) with per-method and per-field hints:
+# clause placement, binary:copy/1 of long-lived fields, lazy tables and
+# UTF-8 checks. See loadOverlay in codegen.py for the format.
+AMQP_CODEGEN_OVERLAY ?=
+# Set to "on" to count calls and bytes per method in the generated
+# codecs, see rabbit_core_metrics:codec_stats/0.
+AMQP_CODEC_COUNTERS ?=
+# Optional comma-separated classes and methods (e.g.
+# "connection,channel,basic.publish") to build pruned framing modules
+# with; the methods left out are refused as not_implemented. Names
+# only one of the protocol versions has are ignored for the other one.
+AMQP_CODEGEN_METHODS ?=
+# Set to "on" to have the encoders of methods with table fields return
+# iodata instead of flattening the tables into the encoded binary.
+AMQP_IODATA_TABLES ?=
+# Optional JSON schema of known table keys (see loadTableSchema in
+# codegen.py), replacing the default queue and exchange arguments one.
+AMQP_TABLE_SCHEMA ?=
+CODEGEN_OPTS = $(if $(AMQP_METHOD_PROFILE),--profile=$(AMQP_METHOD_PROFILE)) \
+	       $(if $(AMQP_CODEGEN_OVERLAY),--overlay=$(AMQP_CODEGEN_OVERLAY)) \
+	       $(if $(AMQP_CODEC_COUNTERS),--codec-counters=$(AMQP_CODEC_COUNTERS)) \
+	       $(if $(AMQP_CODEGEN_METHODS),--methods=$(AMQP_CODEGEN_METHODS)) \
+	       $(if $(AMQP_TABLE_SCHEMA),--table-schema=$(AMQP_TABLE_SCHEMA)) \
+	       $(if $(AMQP_IODATA_TABLES),--iodata-tables=$(AMQP_IODATA_TABLES))
 
-src/rabbit_framing_amqp_0_9_1.erl:: $(CODEGEN) $(CODEGEN_AMQP) \
-    $(AMQP_SPEC_JSON_FILES_0_9_1)
-	$(gen_verbose) env PYTHONPATH=$(CODEGEN_DIR) \
-	 $(PYTHON) $(CODEGEN) body $(AMQP_SPEC_JSON_FILES_0_9_1) $@
+# The header and both framing modules are generated by one codegen.py
+# run, which keeps the hash of its inputs in a stamp file. Only the
+# stamp depends on the inputs: when just timestamps changed, codegen.py
+# touches the stamp and rewrites nothing, so the framing modules are not
+# recompiled and the stamp is up to date on the next build. The outputs
+# depend on the stamp alone. The static pattern rule applies to them
+# only, and regenerates them all when the output it is run for is
+# missing; codegen.py does not rewrite those whose contents are
+# unchanged.
+CODEGEN_STAMP = $(ERLANG_MK_TMP)/rabbit_framing.codegen-hash
+CODEGEN_OUTPUTS = include/rabbit_framing.hrl \
+		  src/rabbit_framing_amqp_0_9_1.erl \
+		  src/rabbit_framing_amqp_0_8.erl
 
-src/rabbit_framing_amqp_0_8.erl:: $(CODEGEN) $(CODEGEN_AMQP) \
-    $(AMQP_SPEC_JSON_FILES_0_8)
+define codegen_all
 	$(gen_verbose) env PYTHONPATH=$(CODEGEN_DIR) \
-	 $(PYTHON) $(CODEGEN) body $(AMQP_SPEC_JSON_FILES_0_8) $@
+	 $(PYTHON) $(CODEGEN) $(CODEGEN_OPTS) --stamp=$(CODEGEN_STAMP) all \
+	 include/rabbit_framing.hrl \
+	 src/rabbit_framing_amqp_0_9_1.erl=$(call comma_list,$(AMQP_SPEC_JSON_FILES_0_9_1)) \
+	 src/rabbit_framing_amqp_0_8.erl=$(call comma_list,$(AMQP_SPEC_JSON_FILES_0_8))
+endef
+
+$(CODEGEN_STAMP): $(CODEGEN) $(CODEGEN_AMQP) \
+    $(AMQP_SPEC_JSON_FILES_0_9_1) $(AMQP_SPEC_JSON_FILES_0_8) \
+    $(AMQP_METHOD_PROFILE) $(AMQP_CODEGEN_OVERLAY) $(AMQP_TABLE_SCHEMA)
+	$(codegen_all)
+
+$(CODEGEN_OUTPUTS): %: $(CODEGEN_STAMP)
+	$(if $(wildcard $@),@:,$(codegen_all))
+
+# unit_SUITE loads a copy of the 0-9-1 framing module built with codec
+# counters in place of the real one, to check what they count. It is
+# not named .erl, so that it is not compiled with the test suites.
+CODEC_COUNTERS_TEST_MODULE = \
+	$(TEST_DIR)/unit_SUITE_data/rabbit_framing_amqp_0_9_1.counted
+
+test-dir: $(CODEC_COUNTERS_TEST_MODULE)
+
+$(CODEC_COUNTERS_TEST_MODULE): $(CODEGEN_STAMP)
+	$(gen_verbose) mkdir -p $(dir $@) && env PYTHONPATH=$(CODEGEN_DIR) \
+	 $(PYTHON) $(CODEGEN) $(CODEGEN_OPTS) --codec-counters=on body \
+	 $(AMQP_SPEC_JSON_FILES_0_9_1) $@
+
+# unit_SUITE also loads 0-9-1 framing modules generated with options
+# the build does not use, under module names of their own, to check
+# what those options generate. CODEGEN_TEST_OPTS_<module> holds the
+# options of each; CODEGEN_OPTS is left out, so that the modules do not
+# depend on how the build is configured.
+CODEGEN_TEST_DATA = $(TEST_DIR)/unit_SUITE_data
+CODEGEN_TEST_MODULES = rabbit_framing_pruned_test \
+		       rabbit_framing_copy_test \
+		       rabbit_framing_overlay_test
+
+CODEGEN_TEST_OPTS_rabbit_framing_pruned_test = \
+	--methods=connection,channel,basic.publish
+CODEGEN_TEST_OPTS_rabbit_framing_copy_test = \
+	--copy-fields=queue.declare,basic.consume.consumer_tag
+CODEGEN_TEST_OPTS_rabbit_framing_overlay_test = \
+	--overlay=$(CODEGEN_TEST_DATA)/codegen_overlay.json \
+	--copy-fields=queue.declare \
+	--lazy-tables=queue.declare,exchange.declare
+
+$(CODEGEN_TEST_DATA)/rabbit_framing_overlay_test.gen: \
+	$(CODEGEN_TEST_DATA)/codegen_overlay.json
+
+test-dir: $(patsubst %,$(CODEGEN_TEST_DATA)/%.gen,$(CODEGEN_TEST_MODULES))
+
+$(CODEGEN_TEST_DATA)/%.gen: $(CODEGEN_STAMP)
+	$(gen_verbose) mkdir -p $(dir $@) && env PYTHONPATH=$(CODEGEN_DIR) \
+	 $(PYTHON) $(CODEGEN) --module=$* $(CODEGEN_TEST_OPTS_$*) body \
+	 $(AMQP_SPEC_JSON_FILES_0_9_1) $@
+
+# The Python tools built on codegen.py (the "python" target's codec,
+# analyze_frames.py and replay_frames.py) are tested by the unittest
+# modules $(TEST_DIR)/*_test.py. They find the spec files next to
+# amqp_codegen.py, and need Python 3.7.
+tests:: python-tests
+
+python-tests:
+	$(gen_verbose) env PYTHONPATH=$(CODEGEN_DIR):$(CURDIR) \
+	 $(PYTHON) -m unittest discover -s $(TEST_DIR) -p '*_test.py'
 
 clean:: clean-extra-sources
 
 clean-extra-sources:
-	$(gen_verbose) rm -f $(EXTRA_SOURCES)
+	$(gen_verbose) rm -f $(EXTRA_SOURCES) $(CODEC_COUNTERS_TEST_MODULE) \
+	 $(patsubst %,$(CODEGEN_TEST_DATA)/%.gen,$(CODEGEN_TEST_MODULES))
@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+
+##  The contents of this file are subject to the Mozilla Public License
+##  Version 1.1 (the "License"); you may not use this file except in
+##  compliance with the License. You may obtain a copy of the License
+##  at https://www.mozilla.org/MPL/
+##
+##  Software distributed under the License is distributed on an "AS IS"
+##  basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+##  the License for the specific language governing rights and
+##  limitations under the License.
+##
+##  The Original Code is RabbitMQ.
+##
+##  The Initial Developer of the Original Code is Pivotal Software, Inc.
+##  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
+##
+
+"""Replays AMQP 0-9-1 frame streams over TCP and reports latencies.
+
+    PYTHONPATH=$CODEGEN_DIR replay_frames.py serve [--listen=HOST:PORT] SPEC
+
+starts the stand-in broker: it speaks the connection handshake, answers
+synchronous methods with their -ok reply (basic.get with get-empty),
+and acks publishes on channels in confirm mode, one basic.ack with
+multiple set per channel and read. Nothing is routed or stored.
+
+    PYTHONPATH=$CODEGEN_DIR replay_frames.py replay [--connect=HOST:PORT]
+        [--connections=N] [--rate=FRAMES_PER_SEC] [--no-confirms]
+        [--synthetic=MESSAGES[:BODY_BYTES]] [--user=U] [--password=P]
+        [--vhost=V] SPEC [CAPTURE...]
+
+opens N connections, does the handshake on each and then sends either a
+capture (as analysed by analyze_frames.py: what a client sent on one
+connection; captures are shared out round-robin, and their channel 0
+frames are left out) or, with --synthetic, a channel.open followed by
+MESSAGES publishes. Each connection is paced to --rate frames per
+second, or sends as fast as the socket takes it. confirm.select is sent
+after every channel.open unless --no-confirms is given. Without
+--connect a stand-in broker is started in the same process.
+
+The report gives the frames and bytes sent per second, and latency
+percentiles from publish to confirm and from synchronous method to its
+reply.
+
+Frames are encoded and decoded with the Python codec codegen.py
+generates from SPEC (its "python" target), loaded in memory. Needs
+Python 3.7."""
+
+from __future__ import print_function
+
+import sys
+import os
+import time
+import types
+import mmap
+import struct
+import asyncio
+from collections import deque
+
+from codegen import AmqpSpec, genPython, captureOutput
+
+FRAME_HEADER = struct.Struct('>BHI')
+BODY_SIZE = struct.Struct('>Q')
+
+# Frames written per drain() when not paced.
+WRITE_BATCH = 256
+
+def loadCodec(specPaths):
+    """Generates the Python codec of the spec and loads it as a
+    module."""
+    source = captureOutput(genPython, AmqpSpec(specPaths))
+    codec = types.ModuleType('amqp_codec')
+    exec(compile(source, '<codegen.py python>', 'exec'), codec.__dict__)
+    codec.BY_NAME = dict([(cls.NAME, cls) for cls in codec.METHODS.values()])
+    codec.PROTOCOL_HEADER = b'AMQP' + bytes(bytearray([0] + list(codec.PROTOCOL_VERSION)))
+    return codec
+
+def expectsReply(method):
+    return method.SYNCHRONOUS and not getattr(method, 'nowait', False)
+
+def replyTo(codec, method):
+    """The reply the stand-in broker sends to a method, if any."""
+    if not expectsReply(method):
+        return None
+    if method.NAME == 'basic.get':
+        return codec.BY_NAME['basic.get_empty']()
+    reply = codec.BY_NAME.get(method.NAME + '_ok')
+    return reply and reply()
+
+def parseHostPort(value, defaultHost):
+    (host, _, port) = value.rpartition(':')
+    return (host or defaultHost, int(port))
+
+class FrameReader(object):
+    """Splits what is read from a stream into decoded frames."""
+
+    def __init__(self, codec, reader):
+        self.codec = codec
+        self.reader = reader
+        self.buf = b''
+
+    async def read(self):
+        data = await self.reader.read(65536)
+        if not data:
+            raise EOFError()
+        self.buf += data
+        (frames, offset) = self.codec.decode_frames(self.buf)
+        self.buf = self.buf[offset:]
+        return frames
+
+    async def readMethod(self, name):
+        while True:
+            for (type, _channel, payload) in await self.read():
+                if type == self.codec.FRAME_METHOD:
+                    if payload.NAME != name:
+                        raise Exception("expected %s, got %r" % (name, payload))
+                    return payload
+
+#----------------------------------------------------------------------------
+# Stand-in broker
+
+async def serveConnection(codec, reader, writer):
+    frames = FrameReader(codec, reader)
+    try:
+        header = await reader.readexactly(8)
+        if header != codec.PROTOCOL_HEADER:
+            writer.write(codec.PROTOCOL_HEADER)
+            return
+        writer.write(codec.encode_method_frame(0, codec.BY_NAME['connection.start'](
+            version_major = codec.PROTOCOL_VERSION[0],
+            version_minor = codec.PROTOCOL_VERSION[1],
+            mechanisms = b'PLAIN', locales = b'en_US')))
+        # Per channel: the next delivery tag when in confirm mode, and
+        # the body bytes still expected of the current publish.
+        confirms = {}
+        remaining = {}
+        while True:
+            out = []
+            acks = {}
+            for (type, channel, payload) in await frames.read():
+                if type == codec.FRAME_METHOD:
+                    name = payload.NAME
+                    if name == 'connection.start_ok':
+                        out.append(codec.encode_method_frame(0, codec.BY_NAME['connection.tune'](
+                            channel_max = 2047, frame_max = 131072, heartbeat = 0)))
+                        continue
+                    if name == 'confirm.select':
+                        confirms[channel] = 1
+                    elif name == 'channel.close':
+                        confirms.pop(channel, None)
+                    elif name == 'basic.publish':
+                        remaining[channel] = None
+                    reply = replyTo(codec, payload)
+                    if reply is not None:
+                        out.append(codec.encode_method_frame(channel, reply))
+                    if name == 'connection.close':
+                        writer.write(b''.join(out))
+                        await writer.drain()
+                        return
+                    continue
+                if type == codec.FRAME_HEADER:
+                    remaining[channel] = payload[1]
+                elif type == codec.FRAME_BODY and remaining.get(channel):
+                    remaining[channel] -= len(payload)
+                else:
+                    continue
+                if remaining[channel] == 0:
+                    del remaining[channel]
+                    if channel in confirms:
+                        acks[channel] = confirms[channel]
+                        confirms[channel] += 1
+            for (channel, tag) in acks.items():
+                out.append(codec.encode_method_frame(
+                    channel, codec.BY_NAME['basic.ack'](delivery_tag = tag, multiple = True)))
+            if out:
+                writer.write(b''.join(out))
+                await writer.drain()
+    except (EOFError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def startServer(codec, host, port):
+    return await asyncio.start_server(
+        lambda r, w: serveConnection(codec, r, w), host, port)
+
+async def serve(codec, listen):
+    (host, port) = parseHostPort(listen, '0.0.0.0')
+    server = await startServer(codec, host, port)
+    print("stand-in broker listening on %s:%d" % (host, port))
+    async with server:
+        await server.serve_forever()
+
+#----------------------------------------------------------------------------
+# Replay
+
+def captureFrames(codec, path):
+    """Yields (frame, channel, event) for the frames of a capture but
+    those on channel 0. event is 'publish' for the frame completing a
+    published message, the decoded method of a method frame and None
+    otherwise."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    view = memoryview(buf)
+    remaining = {}
+    o = 8 if buf[:4] == b'AMQP' else 0
+    while len(buf) - o >= 8:
+        (type, channel, length) = FRAME_HEADER.unpack_from(buf, o)
+        end = o + length + 8
+        if end > len(buf):
+            break
+        frame = view[o:end]
+        payload = view[o + 7:end - 1]
+        o = end
+        if channel == 0:
+            continue
+        event = None
+        if type == codec.FRAME_METHOD:
+            event = codec.decode_method_frame(payload)
+            if event.NAME == 'basic.publish':
+                remaining[channel] = None
+        elif type == codec.FRAME_HEADER and channel in remaining:
+            remaining[channel] = BODY_SIZE.unpack_from(payload, 4)[0]
+        elif type == codec.FRAME_BODY and remaining.get(channel):
+            remaining[channel] -= length
+        if remaining.get(channel, 1) == 0:
+            del remaining[channel]
+            event = 'publish'
+        yield (frame, channel, event)
+
+def syntheticFrames(codec, messages, bodySize):
+    channelOpen = codec.BY_NAME['channel.open']()
+    yield (codec.encode_method_frame(1, channelOpen), 1, channelOpen)
+    publish = codec.BY_NAME['basic.publish'](exchange = b'', routing_key = b'replay')
+    publishFrame = codec.encode_method_frame(1, publish)
+    content = codec.encode_content_frames(
+        1, codec.PROPERTIES[60](delivery_mode = 2), b'x' * bodySize)
+    headerEnd = FRAME_HEADER.unpack_from(content, 0)[2] + 8
+    (header, body) = (content[:headerEnd], content[headerEnd:])
+    for _ in range(messages):
+        yield (publishFrame, 1, publish)
+        if body:
+            yield (header, 1, None)
+            yield (body, 1, 'publish')
+        else:
+            yield (header, 1, 'publish')
+
+class Stats(object):
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.confirms = []
+        self.replies = []
+        self.nacks = 0
+
+class ReplayConnection(object):
+    def __init__(self, codec, stats, confirms):
+        self.codec = codec
+        self.stats = stats
+        self.confirmMode = confirms
+        # Per channel: the next delivery tag and the unconfirmed
+        # publishes, and the synchronous methods awaiting a reply.
+        self.nextTag = {}
+        self.unconfirmed = {}
+        self.pendingReplies = {}
+        self.closed = asyncio.Event()
+
+    async def handshake(self, reader, writer, user, password, vhost):
+        codec = self.codec
+        writer.write(codec.PROTOCOL_HEADER)
+        frames = FrameReader(codec, reader)
+        await frames.readMethod('connection.start')
+        writer.write(codec.encode_method_frame(0, codec.BY_NAME['connection.start_ok'](
+            client_properties = [(b'product', 'longstr', b'replay_frames.py')],
+            mechanism = b'PLAIN', locale = b'en_US',
+            response = b'\0' + user + b'\0' + password)))
+        tune = await frames.readMethod('connection.tune')
+        writer.write(codec.encode_method_frame(0, codec.BY_NAME['connection.tune_ok'](
+            channel_max = tune.channel_max, frame_max = tune.frame_max, heartbeat = 0)))
+        writer.write(codec.encode_method_frame(0, codec.BY_NAME['connection.open'](
+            virtual_host = vhost)))
+        await frames.readMethod('connection.open_ok')
+        return frames
+
+    def sent(self, channel, event, now):
+        if event is None:
+            return
+        if event == 'publish':
+            if channel in self.nextTag:
+                tag = self.nextTag[channel]
+                self.nextTag[channel] = tag + 1
+                self.unconfirmed[channel].append((tag, now))
+            return
+        if expectsReply(event):
+            self.pendingReplies.setdefault(channel, deque()).append(now)
+        if event.NAME == 'confirm.select' and channel not in self.nextTag:
+            self.nextTag[channel] = 1
+            self.unconfirmed[channel] = deque()
+
+    def received(self, channel, method, now):
+        name = method.NAME
+        if name in ('basic.ack', 'basic.nack'):
+            pending = self.unconfirmed.get(channel, ())
+            while pending and (pending[0][0] <= method.delivery_tag if method.multiple
+                               else pending[0][0] == method.delivery_tag):
+                (_, sentAt) = pending.popleft()
+                if name == 'basic.ack':
+                    self.stats.confirms.append(now - sentAt)
+                else:
+                    self.stats.nacks += 1
+        elif name == 'connection.close_ok':
+            self.closed.set()
+        elif name.endswith('_ok') or name == 'basic.get_empty':
+            pending = self.pendingReplies.get(channel)
+            if pending:
+                self.stats.replies.append(now - pending.popleft())
+        elif name == 'connection.close' or name == 'channel.close':
+            raise Exception("broker closed: %r" % (method,))
+
+    def outstanding(self):
+        return sum([len(p) for p in self.unconfirmed.values()]) + \
+            sum([len(p) for p in self.pendingReplies.values()])
+
+    async def readLoop(self, frames):
+        clock = time.perf_counter
+        try:
+            while True:
+                received = await frames.read()
+                now = clock()
+                for (type, channel, payload) in received:
+                    if type == self.codec.FRAME_METHOD:
+                        self.received(channel, payload, now)
+        except EOFError:
+            self.closed.set()
+
+    def withConfirms(self, source):
+        codec = self.codec
+        for (frame, channel, event) in source:
+            yield (frame, channel, event)
+            if event is not None and event != 'publish' and \
+                    event.NAME == 'channel.open' and self.confirmMode:
+                select = codec.BY_NAME['confirm.select']()
+                yield (codec.encode_method_frame(channel, select), channel, select)
+
+    async def run(self, host, port, source, rate, credentials):
+        codec = self.codec
+        (reader, writer) = await asyncio.open_connection(host, port)
+        frames = await self.handshake(reader, writer, *credentials)
+        readTask = asyncio.ensure_future(self.readLoop(frames))
+        clock = time.perf_counter
+        start = clock()
+        batch = []
+        sent = 0
+        for (frame, channel, event) in self.withConfirms(source):
+            batch.append((frame, channel, event))
+            sent += 1
+            if rate:
+                delay = start + sent / rate - clock()
+                if delay <= 0 and len(batch) < WRITE_BATCH:
+                    continue
+            elif len(batch) < WRITE_BATCH:
+                continue
+            await self.flush(writer, batch)
+            batch = []
+            if rate and delay > 0:
+                await asyncio.sleep(delay)
+        await self.flush(writer, batch)
+        while self.outstanding() and not readTask.done():
+            await asyncio.sleep(0.01)
+        writer.write(codec.encode_method_frame(0, codec.BY_NAME['connection.close'](
+            reply_code = 200, reply_text = b'replay done')))
+        await writer.drain()
+        await asyncio.wait_for(self.closed.wait(), 10)
+        readTask.cancel()
+        writer.close()
+
+    async def flush(self, writer, batch):
+        if not batch:
+            return
+        writer.write(b''.join([frame for (frame, _, _) in batch]))
+        now = time.perf_counter()
+        for (frame, channel, event) in batch:
+            self.stats.frames += 1
+            self.stats.bytes += len(frame)
+            self.sent(channel, event, now)
+        await writer.drain()
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return [(label, samples[min(len(samples) - 1, int(q * len(samples)))] * 1e6)
+            for (label, q) in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                               ('p99.9', 0.999), ('max', 1.0)]]
+
+def printReport(stats, connections, elapsed):
+    print("%d connection(s), %.2f s" % (connections, elapsed))
+    print("  %-24s %14d  (%.0f/s)" % ("frames sent", stats.frames, stats.frames / elapsed))
+    print("  %-24s %14d  (%.1f MB/s)" % ("bytes sent", stats.bytes,
+                                          stats.bytes / elapsed / 1e6))
+    for (label, samples) in [("publish -> confirm", stats.confirms),
+                             ("method -> reply", stats.replies)]:
+        if not samples:
+            continue
+        print("  %-24s %14d  %s" % (label, len(samples), '  '.join(
+            ['%s %.0fus' % p for p in percentiles(samples)])))
+    if stats.nacks:
+        print("  %-24s %14d" % ("nacked", stats.nacks))
+
+async def replay(codec, opts, captures):
+    server = None
+    if opts['connect'] is None:
+        server = await startServer(codec, '127.0.0.1', 0)
+        (host, port) = server.sockets[0].getsockname()[:2]
+    else:
+        (host, port) = parseHostPort(opts['connect'], '127.0.0.1')
+    credentials = (opts['user'].encode('utf-8'), opts['password'].encode('utf-8'),
+                   opts['vhost'].encode('utf-8'))
+    stats = Stats()
+    connections = []
+    for i in range(opts['connections']):
+        if captures:
+            source = captureFrames(codec, captures[i % len(captures)])
+        else:
+            (messages, _, bodySize) = opts['synthetic'].partition(':')
+            source = syntheticFrames(codec, int(messages), int(bodySize or 0))
+        connection = ReplayConnection(codec, stats, opts['confirms'])
+        connections.append(connection.run(host, port, source, opts['rate'], credentials))
+    start = time.perf_counter()
+    await asyncio.gather(*connections)
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    printReport(stats, len(connections), elapsed)
+    return stats
+
+def main(args):
+    opts = {'listen': '0.0.0.0:5672', 'connect': None, 'connections': 1,
+            'rate': None, 'synthetic': '100000:0', 'confirms': True,
+            'user': 'guest', 'password': 'guest', 'vhost': '/'}
+    if not args or args[0] not in ('serve', 'replay'):
+        raise Exception("Usage: replay_frames.py serve|replay [--name=value ...] "
+                        "<spec.json>[,<spec.json>...] [<capture>...]")
+    command = args.pop(0)
+    while args and args[0].startswith('--'):
+        (name, _, value) = args.pop(0)[2:].partition('=')
+        if name == 'no-confirms':
+            opts['confirms'] = False
+        elif name in ('connections',):
+            opts[name] = int(value)
+        elif name == 'rate':
+            opts[name] = float(value)
+        elif name in opts:
+            opts[name] = value
+        else:
+            raise Exception("Unknown option --" + name)
+    if not args:
+        raise Exception("No spec given")
+    codec = loadCodec(args[0].split(','))
+    if command == 'serve':
+        asyncio.run(serve(codec, opts['listen']))
+    else:
+        asyncio.run(replay(codec, opts, args[1:]))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -20,10 +20,13 @@
 
 -export([build_simple_method_frame/3,
          build_simple_content_frames/4,
+         build_content_frames_rev/5,
          build_heartbeat_frame/0]).
--export([generate_table/1]).
+-export([generate_table/1, generate_table_iolist/1, table_size/1]).
+-export([method_frame_size/2, content_frames_size/3]).
 -export([check_empty_frame_size/0]).
 -export([ensure_content_encoded/2, clear_encoded_content/1]).
+-export([patch_content_properties/3]).
 -export([map_exception/3]).
 
 %%----------------------------------------------------------------------------
@@ -38,8 +41,20 @@
         (rabbit_channel:channel_number(), rabbit_types:content(),
          non_neg_integer(), rabbit_types:protocol()) ->
             [frame()].
+-spec build_content_frames_rev
+        (rabbit_channel:channel_number(), rabbit_types:content(),
+         non_neg_integer(), rabbit_types:protocol(), [iodata()]) ->
+            [iodata()].
 -spec build_heartbeat_frame() -> frame().
 -spec generate_table(rabbit_framing:amqp_table()) -> binary().
+-spec generate_table_iolist(rabbit_framing:amqp_table()) -> iolist().
+-spec table_size(rabbit_framing:amqp_table()) -> non_neg_integer().
+-spec method_frame_size
+        (rabbit_framing:amqp_method_record(), rabbit_types:protocol()) ->
+            non_neg_integer().
+-spec content_frames_size
+        (rabbit_types:content(), non_neg_integer(), rabbit_types:protocol()) ->
+            non_neg_integer().
 -spec check_empty_frame_size() -> 'ok'.
 -spec ensure_content_encoded
         (rabbit_types:content(), rabbit_types:protocol()) ->
@@ -47,6 +62,9 @@
 -spec clear_encoded_content
         (rabbit_types:content()) ->
             rabbit_types:unencoded_content().
+-spec patch_content_properties
+        ([{atom(), any()}], rabbit_types:content(), rabbit_types:protocol()) ->
+            rabbit_types:encoded_content().
 -spec map_exception
         (rabbit_channel:channel_number(), rabbit_types:amqp_error() | any(),
          rabbit_types:protocol()) ->
@@ -55,11 +73,44 @@
 
 %%----------------------------------------------------------------------------
 
+%% The generated encoder emits the frame header, class and method ids
+%% and the end marker around the encoded fields in a single call.
 build_simple_method_frame(ChannelInt, MethodRecord, Protocol) ->
-    MethodFields = Protocol:encode_method_fields(MethodRecord),
-    MethodName = rabbit_misc:method_record_type(MethodRecord),
-    {ClassId, MethodId} = Protocol:method_id(MethodName),
-    create_frame(1, ChannelInt, [<<ClassId:16, MethodId:16>>, MethodFields]).
+    Protocol:encode_method_frame(ChannelInt, MethodRecord).
+
+%% Sizes of the frames built by build_simple_method_frame/3 and
+%% build_simple_content_frames/4, worked out from the records without
+%% encoding them.
+method_frame_size(MethodRecord, Protocol) ->
+    ?EMPTY_FRAME_SIZE + 4 + Protocol:encoded_size(MethodRecord).
+
+content_frames_size(Content = #content{payload_fragments_rev =
+                                           PayloadFragmentsRev},
+                    FrameMax, Protocol) ->
+    PropSize = properties_size(Content, Protocol),
+    BodySize = iolist_size(PayloadFragmentsRev),
+    BodyFrames = if BodySize =:= 0 -> 0;
+                    FrameMax == 0  -> 1;
+                    true           -> BodyPayloadMax = FrameMax - ?EMPTY_FRAME_SIZE,
+                                      (BodySize + BodyPayloadMax - 1) div
+                                          BodyPayloadMax
+                 end,
+    ?EMPTY_FRAME_SIZE + 12 + PropSize +
+        BodyFrames * ?EMPTY_FRAME_SIZE + BodySize.
+
+%% Properties that are not encoded for Protocol are sized from the
+%% record with the generated encoded_properties_size/1, instead of
+%% being encoded here only to be measured. Properties only encoded for
+%% the other protocol are not decoded either: the classes both
+%% protocols have carry the same properties, so the encoding has the
+%% same size.
+properties_size(#content{properties_bin = PropBin, protocol = Protocol},
+                Protocol) when PropBin =/= none ->
+    size(PropBin);
+properties_size(#content{properties = Props}, Protocol) when Props =/= none ->
+    Protocol:encoded_properties_size(Props);
+properties_size(#content{properties_bin = PropBin}, _Protocol) ->
+    size(PropBin).
 
 build_simple_content_frames(ChannelInt, Content, FrameMax, Protocol) ->
     #content{class_id = ClassId,
@@ -73,6 +124,21 @@ build_simple_content_frames(ChannelInt, Content, FrameMax, Protocol) ->
                                 ContentPropertiesBin]),
     [HeaderFrame | ContentFrames].
 
+%% As build_simple_content_frames/4, but the frames are pushed onto the
+%% reversed iolist Acc. Used by the generated encode_content_commands/2.
+build_content_frames_rev(ChannelInt, Content, FrameMax, Protocol, Acc) ->
+    #content{class_id = ClassId,
+             properties_bin = ContentPropertiesBin,
+             payload_fragments_rev = PayloadFragmentsRev} =
+        ensure_content_encoded(Content, Protocol),
+    {BodySize, ContentFrames} =
+        build_content_frames(PayloadFragmentsRev, FrameMax, ChannelInt),
+    HeaderSize = 12 + size(ContentPropertiesBin),
+    lists:reverse(ContentFrames,
+                  [?FRAME_END, ContentPropertiesBin,
+                   <<?FRAME_HEADER, ChannelInt:16, HeaderSize:32,
+                     ClassId:16, 0:16, BodySize:64>> | Acc]).
+
 build_content_frames(FragsRev, FrameMax, ChannelInt) ->
     BodyPayloadMax = if FrameMax == 0 -> iolist_size(FragsRev);
                         true          -> FrameMax - ?EMPTY_FRAME_SIZE
@@ -89,8 +155,8 @@ build_content_frames(SizeAcc, FramesAcc, _FragSizeRem, [],
 build_content_frames(SizeAcc, FramesAcc, FragSizeRem, FragAcc,
                      Frags, BodyPayloadMax, ChannelInt)
   when FragSizeRem == 0 orelse Frags == [] ->
-    Frame = create_frame(3, ChannelInt, lists:reverse(FragAcc)),
     FrameSize = BodyPayloadMax - FragSizeRem,
+    Frame = create_frame(3, ChannelInt, lists:reverse(FragAcc), FrameSize),
     build_content_frames(SizeAcc + FrameSize, [Frame | FramesAcc],
                          BodyPayloadMax, [], Frags, BodyPayloadMax, ChannelInt);
 build_content_frames(SizeAcc, FramesAcc, FragSizeRem, FragAcc,
@@ -110,8 +176,10 @@ build_heartbeat_frame() ->
     create_frame(?FRAME_HEARTBEAT, 0, <<>>).
 
 create_frame(TypeInt, ChannelInt, Payload) ->
-    [<<TypeInt:8, ChannelInt:16, (iolist_size(Payload)):32>>, Payload,
-     ?FRAME_END].
+    create_frame(TypeInt, ChannelInt, Payload, iolist_size(Payload)).
+
+create_frame(TypeInt, ChannelInt, Payload, PayloadSize) ->
+    [<<TypeInt:8, ChannelInt:16, PayloadSize:32>>, Payload, ?FRAME_END].
 
 %% table_field_to_binary supports the AMQP 0-8/0-9 standard types, S,
 %% I, D, T and F, as well as the QPid extensions b, d, f, l, s, t, x,
@@ -149,6 +217,34 @@ array_to_binary(Array) when is_list(Array) ->
 generate_table(Table) when is_list(Table) ->
     list_to_binary(generate_table_iolist(Table)).
 
+%% Size of generate_table(Table), without generating it.
+table_size(Table) when is_list(Table) ->
+    lists:foldl(fun ({FName, T, V}, Acc) ->
+                        Acc + 1 + string_length(FName) + field_value_size(T, V)
+                end, 0, Table).
+
+array_size(Array) when is_list(Array) ->
+    lists:foldl(fun ({T, V}, Acc) -> Acc + field_value_size(T, V) end,
+                0, Array).
+
+field_value_size(longstr,       V) -> 5 + string_length(V);
+field_value_size(signedint,    _V) -> 5;
+field_value_size(decimal,      _V) -> 6;
+field_value_size(timestamp,    _V) -> 9;
+field_value_size(table,         V) -> 5 + table_size(V);
+field_value_size(array,         V) -> 5 + array_size(V);
+field_value_size(byte,         _V) -> 2;
+field_value_size(double,       _V) -> 9;
+field_value_size(float,        _V) -> 5;
+field_value_size(long,         _V) -> 9;
+field_value_size(short,        _V) -> 3;
+field_value_size(bool,         _V) -> 2;
+field_value_size(binary,        V) -> 5 + string_length(V);
+field_value_size(unsignedbyte, _V) -> 2;
+field_value_size(unsignedshort,_V) -> 3;
+field_value_size(unsignedint,  _V) -> 5;
+field_value_size(void,         _V) -> 1.
+
 generate_table_iolist(Table) ->
     lists:map(fun table_field_to_binary/1, Table).
 
@@ -186,11 +282,13 @@ ensure_content_encoded(Content = #content{properties = none,
   when PropBin =/= none ->
     Props = Protocol:decode_properties(Content#content.class_id, PropBin),
     Content#content{properties = Props,
-                    properties_bin = Protocol1:encode_properties(Props),
+                    properties_bin = rabbit_properties_cache:encode(Props,
+                                                                    Protocol1),
                     protocol = Protocol1};
 ensure_content_encoded(Content = #content{properties = Props}, Protocol)
   when Props =/= none ->
-    Content#content{properties_bin = Protocol:encode_properties(Props),
+    Content#content{properties_bin = rabbit_properties_cache:encode(Props,
+                                                                    Protocol),
                     protocol = Protocol}.
 
 clear_encoded_content(Content = #content{properties_bin = none,
@@ -204,6 +302,18 @@ clear_encoded_content(Content = #content{properties = none}) ->
 clear_encoded_content(Content = #content{}) ->
     Content#content{properties_bin = none, protocol = none}.
 
+%% Sets (or, given 'undefined', clears) a few properties of the content
+%% by splicing them into the encoded properties, instead of decoding
+%% and re-encoding all of them. The decoded properties are dropped
+%% since they no longer match.
+patch_content_properties(Changes, Content, Protocol) ->
+    Content1 = #content{class_id       = ClassId,
+                        properties_bin = PropBin} =
+        ensure_content_encoded(Content, Protocol),
+    Content1#content{properties     = none,
+                     properties_bin = Protocol:patch_properties_bin(
+                                        ClassId, Changes, PropBin)}.
+
 %% NB: this function is also used by the Erlang client
 map_exception(Channel, Reason, Protocol) ->
     {SuggestedClose, ReplyCode, ReplyText, FailedMethod} =
@@ -17,9 +17,11 @@
 -module(rabbit_binary_parser).
 
 -include("rabbit.hrl").
+-include("rabbit_framing.hrl").
 
 -export([parse_table/1]).
 -export([ensure_content_decoded/1, clear_decoded_content/1]).
+-export([content_property/2]).
 -export([validate_utf8/1, assert_utf8/1]).
 
 %%----------------------------------------------------------------------------
@@ -31,6 +33,7 @@
 -spec clear_decoded_content
         (rabbit_types:content()) ->
             rabbit_types:undecoded_content().
+-spec content_property(atom(), rabbit_types:content()) -> any().
 -spec validate_utf8(binary()) -> 'ok' | 'error'.
 -spec assert_utf8(binary()) -> 'ok'.
 
@@ -155,6 +158,19 @@ ensure_content_decoded(Content = #content{properties_bin = PropBin,
     Content#content{properties = Protocol:decode_properties(
                                    Content#content.class_id, PropBin)}.
 
+%% Reads a single basic property. Undecoded content is not decoded as
+%% a whole: only the bytes up to the requested property are looked at.
+content_property(Name, #content{class_id       = ClassId,
+                                properties     = none,
+                                properties_bin = PropBin,
+                                protocol       = Protocol}) ->
+    Protocol:decode_property(ClassId, Name, PropBin);
+content_property(Name, #content{properties = Props = #'P_basic'{}}) ->
+    element(field_index(Name, record_info(fields, 'P_basic'), 2), Props).
+
+field_index(Name, [Name | _], I) -> I;
+field_index(Name, [_ | Names], I) -> field_index(Name, Names, I + 1).
+
 clear_decoded_content(Content = #content{properties = none}) ->
     Content;
 clear_decoded_content(Content = #content{properties_bin = none}) ->
@@ -18,7 +18,8 @@
 -include("rabbit_framing.hrl").
 -include("rabbit.hrl").
 
--export([analyze_frame/3, init/1, process/2]).
+-export([analyze_frame/3, analyze_channel_frame/3, init/1, process/2,
+         process_frames/2]).
 
 %%----------------------------------------------------------------------------
 
@@ -38,6 +39,8 @@
 
 -type frame() ::
         {'method',         rabbit_framing:amqp_method_name(), binary()} |
+        {'method_frame',   binary()} |
+        {'decoded_method', class_id(), method(), boolean()} |
         {'content_header', class_id(), weight(), body_size(), binary()} |
         {'content_body',   binary()}.
 
@@ -46,8 +49,16 @@
         {'content_header', method(), class_id(), protocol()} |
         {'content_body',   method(), body_size(), class_id(), protocol()}.
 
+-type channel()    :: non_neg_integer().
+-type command()    :: {'ok', method()} |
+                      {'ok', method(), content()} |
+                      {'error', rabbit_types:amqp_error()} |
+                      {'frame', frame() | 'heartbeat'}.
+
 -spec analyze_frame(frame_type(), binary(), protocol()) ->
           frame() | 'heartbeat' | 'error'.
+-spec analyze_channel_frame(frame_type(), binary(), protocol()) ->
+          frame() | 'heartbeat' | 'error'.
 
 -spec init(protocol()) -> {ok, state()}.
 -spec process(frame(), state()) ->
@@ -55,6 +66,9 @@
           {ok, method(), state()} |
           {ok, method(), content(), state()} |
           {error, rabbit_types:amqp_error()}.
+-spec process_frames([{channel(), frame() | 'heartbeat'}],
+                     #{channel() => state()}) ->
+          {[{channel(), command()}], #{channel() => state()}}.
 
 %%--------------------------------------------------------------------
 
@@ -74,18 +88,51 @@ analyze_frame(?FRAME_HEARTBEAT, <<>>, _Protocol) ->
 analyze_frame(_Type, _Body, _Protocol) ->
     error.
 
+%% For frames that are only ever handed to process/2, i.e. those not on
+%% channel 0. Method frames are left for process/2 to decode with a
+%% single call to the generated decode_method_frame/1, rather than
+%% looking up the method name here and decoding the fields there.
+analyze_channel_frame(?FRAME_METHOD,
+                      <<_ClassId:16, _MethodId:16, _/binary>> = MethodBin,
+                      _Protocol) ->
+    {method_frame, MethodBin};
+analyze_channel_frame(Type, Body, Protocol) ->
+    analyze_frame(Type, Body, Protocol).
+
 init(Protocol) -> {ok, {method, Protocol}}.
 
+process({method_frame, <<ClassId:16, MethodId:16, _/binary>> = MethodBin},
+        {method, Protocol}) ->
+    try
+        case Protocol:decode_method_frame(MethodBin) of
+            {Method, true}  -> {ok, {content_header, Method, ClassId, Protocol}};
+            {Method, false} -> {ok, Method, {method, Protocol}}
+        end
+    catch
+        exit:#amqp_error{} = Reason ->
+            {error, Reason};
+        %% analyze_frame/3 fails on these before process/2 is called,
+        %% analyze_channel_frame/3 leaves them to the decoding here.
+        exit:{unknown_method_id, {ClassId, MethodId}} ->
+            {error, rabbit_misc:amqp_error(
+                      command_invalid, "unknown method ~w.~w",
+                      [ClassId, MethodId], none)}
+    end;
 process({method, MethodName, FieldsBin}, {method, Protocol}) ->
     try
         Method = Protocol:decode_method_fields(MethodName, FieldsBin),
-        case Protocol:method_has_content(MethodName) of
-            true  -> {ClassId, _MethodId} = Protocol:method_id(MethodName),
-                     {ok, {content_header, Method, ClassId, Protocol}};
-            false -> {ok, Method, {method, Protocol}}
+        case Protocol:method_info(MethodName) of
+            {{ClassId, _MethodId}, true, _, _, _} ->
+                {ok, {content_header, Method, ClassId, Protocol}};
+            {_Id, false, _, _, _} ->
+                {ok, Method, {method, Protocol}}
         end
     catch exit:#amqp_error{} = Reason -> {error, Reason}
     end;
+process({decoded_method, ClassId, Method, true}, {method, Protocol}) ->
+    {ok, {content_header, Method, ClassId, Protocol}};
+process({decoded_method, _ClassId, Method, false}, {method, Protocol}) ->
+    {ok, Method, {method, Protocol}};
 process(_Frame, {method, _Protocol}) ->
     unexpected_frame("expected method frame, "
                      "got non method frame instead", [], none);
@@ -118,6 +165,42 @@ process(_Frame, {content_body, Method, _RemainingSize, _Content, _Protocol}) ->
     unexpected_frame("expected content body, "
                      "got non content body frame instead", [], Method).
 
+%% Runs process/2 over the frames of a whole socket read, as returned
+%% by the generated decode_frames/2. States holds the assembler state
+%% of each channel. Heartbeats, and frames on channels without a
+%% state (channel 0 among them), are handed back as {frame, Frame} in
+%% their place among the completed commands. A channel whose frame
+%% gives an {error, _} loses its state, so that its remaining frames
+%% come back untouched for the caller to handle once it has dealt with
+%% the error, instead of being run against a state the error left
+%% behind.
+process_frames(Frames, States) ->
+    process_frames(Frames, States, []).
+
+process_frames([], States, Acc) ->
+    {lists:reverse(Acc), States};
+process_frames([{Channel, heartbeat} | Frames], States, Acc) ->
+    process_frames(Frames, States, [{Channel, {frame, heartbeat}} | Acc]);
+process_frames([{Channel, Frame} | Frames], States, Acc) ->
+    case States of
+        #{Channel := State} ->
+            case process(Frame, State) of
+                {ok, State1} ->
+                    process_frames(Frames, States#{Channel := State1}, Acc);
+                {ok, Method, State1} ->
+                    process_frames(Frames, States#{Channel := State1},
+                                   [{Channel, {ok, Method}} | Acc]);
+                {ok, Method, Content, State1} ->
+                    process_frames(Frames, States#{Channel := State1},
+                                   [{Channel, {ok, Method, Content}} | Acc]);
+                {error, _} = Error ->
+                    process_frames(Frames, maps:remove(Channel, States),
+                                   [{Channel, Error} | Acc])
+            end;
+        _ ->
+            process_frames(Frames, States, [{Channel, {frame, Frame}} | Acc])
+    end.
+
 %%--------------------------------------------------------------------
 
 empty_content(ClassId, PropertiesBin, Protocol) ->
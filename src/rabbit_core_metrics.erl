@@ -56,6 +56,8 @@
 
 -export([delete/2]).
 
+-export([codec_stats/0, codec_profile/0, codec_profile/1]).
+
 %%----------------------------------------------------------------------------
 %% Types
 %%----------------------------------------------------------------------------
@@ -69,6 +71,10 @@
 			      exchange_stats | reductions).
 
 -type(activity_status() :: up | single_active | waiting | suspected_down).
+
+%% Framing modules generated with --codec-counters=on keep per-method
+%% codec call and byte counters, see codec_stats/0.
+-define(FRAMING_PROTOCOLS, [rabbit_framing_amqp_0_9_1, rabbit_framing_amqp_0_8]).
 %%----------------------------------------------------------------------------
 %% Specs
 %%----------------------------------------------------------------------------
@@ -100,6 +106,10 @@
 -spec gen_server2_deleted(pid()) -> ok.
 -spec get_gen_server2_stats(pid()) -> integer() | 'not_found'.
 -spec delete(atom(), any()) -> ok.
+-spec codec_stats() -> [{module(), [{atom(), [{atom(), non_neg_integer()}]}]}].
+-spec codec_profile() -> binary().
+-spec codec_profile([{module(), [{atom(), [{atom(), non_neg_integer()}]}]}]) ->
+          binary().
 %%----------------------------------------------------------------------------
 %% Storage of the raw metrics in RabbitMQ core. All the processing of stats
 %% is done by the management plugin.
@@ -111,6 +121,7 @@ init() ->
     _ = [ets:new(Table, [Type, public, named_table, {write_concurrency, true},
                          {read_concurrency, true}])
          || {Table, Type} <- ?CORE_TABLES ++ ?CORE_EXTRA_TABLES],
+    _ = [Protocol:init_codec_counters() || Protocol <- ?FRAMING_PROTOCOLS],
     ok.
 
 terminate() ->
@@ -217,6 +228,33 @@ delete(Table, Key) ->
     ets:delete(Table, Key),
     ok.
 
+%% Calls and bytes decoded and encoded per method and per content
+%% class ('P_basic' etc.) since boot. Empty for framing modules built
+%% without codec counters.
+codec_stats() ->
+    [{Protocol, Protocol:codec_counters()} || Protocol <- ?FRAMING_PROTOCOLS].
+
+%% The calls counted in codec_stats/0 as a method-frequency profile,
+%% the JSON object codegen.py --profile reads: method names mapped to
+%% the calls decoding and encoding them, summed over the protocols.
+codec_profile() ->
+    codec_profile(codec_stats()).
+
+codec_profile(Stats) ->
+    Profile = lists:foldl(
+                fun ({Name, Counts}, Acc) ->
+                        Calls = proplists:get_value(decode_calls, Counts) +
+                            proplists:get_value(encode_calls, Counts),
+                        maps:update_with(atom_to_binary(Name, utf8),
+                                         fun (N) -> N + Calls end, Calls, Acc)
+                end, #{},
+                [Method || {_Protocol, Methods} <- Stats,
+                           {Name, _} = Method <- Methods,
+                           %% Leaves out the content classes ('P_basic').
+                           lists:member($., atom_to_list(Name))]),
+    rabbit_json:encode(maps:filter(fun (_Name, Calls) -> Calls > 0 end,
+                                   Profile)).
+
 channel_queue_down(Id) ->
     %% Delete marker
     ets:update_element(channel_queue_metrics, Id, {9, 1}),
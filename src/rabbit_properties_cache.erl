@@ -0,0 +1,126 @@
+%% The contents of this file are subject to the Mozilla Public License
+%% Version 1.1 (the "License"); you may not use this file except in
+%% compliance with the License. You may obtain a copy of the License
+%% at https://www.mozilla.org/MPL/
+%%
+%% Software distributed under the License is distributed on an "AS IS"
+%% basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+%% the License for the specific language governing rights and
+%% limitations under the License.
+%%
+%% The Original Code is RabbitMQ.
+%%
+%% The Initial Developer of the Original Code is GoPivotal, Inc.
+%% Copyright (c) 2007-2019 Pivotal Software, Inc.  All rights reserved.
+%%
+
+-module(rabbit_properties_cache).
+
+%% A small per-process cache of encoded content properties, for
+%% processes that keep encoding the same properties (typically the
+%% ones a publisher sets on every message).
+%%
+%% Entries are keyed on the generated properties_cache_key/1 of the
+%% framing module, i.e. on the whole properties record, so a cached
+%% binary is only ever returned for a record identical to the one it
+%% was encoded from. Records that carry a table, a message id or a
+%% timestamp are encoded without going through the cache: they are
+%% too costly to key on or change with every message, and would only
+%% pay for the bookkeeping. The binaries of a record are usually
+%% sub-binaries of a socket read or of a message body, so keys are
+%% stored with copies of them, not to keep those alive for as long as
+%% the entry. The least recently used entry is evicted
+%% once the cache holds encoded_properties_cache_size entries (rabbit
+%% application environment, 0 disables the cache).
+
+-export([encode/2, stats/0, clear/0]).
+
+-define(DEFAULT_SIZE, 16).
+
+-record(cache, {max_size,
+                %% incremented on every lookup, orders the entries
+                tick = 0,
+                %% key -> {tick, encoded binary}
+                entries = #{},
+                %% tick -> key, smallest is least recently used
+                lru = gb_trees:empty(),
+                hits = 0,
+                misses = 0}).
+
+%%----------------------------------------------------------------------------
+
+-spec encode(rabbit_framing:amqp_property_record(), rabbit_types:protocol()) ->
+          binary().
+-spec stats() -> [{atom(), non_neg_integer()}].
+-spec clear() -> ok.
+
+%%----------------------------------------------------------------------------
+
+encode(Props, Protocol) ->
+    case Protocol:properties_cache_key(Props) of
+        uncacheable -> Protocol:encode_properties(Props);
+        Key         -> lookup(Key, Props, Protocol, cache())
+    end.
+
+stats() ->
+    #cache{max_size = MaxSize, entries = Entries,
+           hits = Hits, misses = Misses} = cache(),
+    [{hits, Hits}, {misses, Misses},
+     {size, map_size(Entries)}, {max_size, MaxSize}].
+
+clear() ->
+    erase(?MODULE),
+    ok.
+
+%%----------------------------------------------------------------------------
+
+cache() ->
+    case get(?MODULE) of
+        undefined -> MaxSize = application:get_env(
+                                 rabbit, encoded_properties_cache_size,
+                                 ?DEFAULT_SIZE),
+                     Cache = #cache{max_size = MaxSize},
+                     put(?MODULE, Cache),
+                     Cache;
+        Cache     -> Cache
+    end.
+
+lookup(_Key, Props, Protocol, #cache{max_size = 0}) ->
+    Protocol:encode_properties(Props);
+lookup(Key, Props, Protocol, Cache = #cache{max_size = MaxSize,
+                                            tick     = Tick,
+                                            entries  = Entries,
+                                            lru      = LRU,
+                                            hits     = Hits,
+                                            misses   = Misses}) ->
+    case Entries of
+        #{Key := {OldTick, Bin}} ->
+            LRU1 = gb_trees:insert(Tick, Key, gb_trees:delete(OldTick, LRU)),
+            put(?MODULE, Cache#cache{tick    = Tick + 1,
+                                     entries = Entries#{Key := {Tick, Bin}},
+                                     lru     = LRU1,
+                                     hits    = Hits + 1}),
+            Bin;
+        _ ->
+            Bin = Protocol:encode_properties(Props),
+            {Entries1, LRU1} = evict(Entries, LRU, MaxSize),
+            Key1 = copy_key(Key),
+            put(?MODULE, Cache#cache{tick    = Tick + 1,
+                                     entries = Entries1#{Key1 => {Tick, Bin}},
+                                     lru     = gb_trees:insert(Tick, Key1, LRU1),
+                                     misses  = Misses + 1}),
+            Bin
+    end.
+
+%% Cacheable records hold no tables, their binaries are all fields.
+copy_key({Module, Props}) ->
+    {Module, list_to_tuple([copy_field(F) || F <- tuple_to_list(Props)])}.
+
+copy_field(F) when is_binary(F) -> binary:copy(F);
+copy_field(F)                   -> F.
+
+evict(Entries, LRU, MaxSize) when map_size(Entries) < MaxSize ->
+    {Entries, LRU};
+evict(Entries, LRU, _MaxSize) ->
+    {_Tick, Key, LRU1} = gb_trees:take_smallest(LRU),
+    {maps:remove(Key, Entries), LRU1}.
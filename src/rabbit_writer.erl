@@ -66,7 +66,12 @@
     stats_timer,
     %% data pending delivery (between socket
     %% flushes)
-    pending
+    pending,
+    %% content-bearing commands queued since the last flush, in
+    %% reverse order, and not yet encoded
+    pending_content,
+    %% size in bytes of the pending data, including pending_content
+    pending_size
 }).
 
 -define(HIBERNATE_AFTER, 5000).
@@ -162,7 +167,9 @@ initial_state(Sock, Channel, FrameMax, Protocol, ReaderPid, ReaderWantsStats) ->
                   frame_max = FrameMax,
                   protocol  = Protocol,
                   reader    = ReaderPid,
-                  pending   = []},
+                  pending   = [],
+                  pending_content = [],
+                  pending_size = 0},
           #wstate.stats_timer).
 
 system_continue(Parent, Deb, State) ->
@@ -189,7 +196,7 @@ mainloop(Deb, State) ->
     end,
     done.
 
-mainloop1(Deb, State = #wstate{pending = []}) ->
+mainloop1(Deb, State = #wstate{pending = [], pending_content = []}) ->
     receive
         Message -> {Deb1, State1} = handle_message(Deb, Message, State),
                    ?MODULE:mainloop1(Deb1, State1)
@@ -327,22 +334,43 @@ internal_send_command(Sock, Channel, MethodRecord, Content, FrameMax,
                      end, ok, assemble_frames(Channel, MethodRecord,
                                               Content, FrameMax, Protocol)).
 
-internal_send_command_async(MethodRecord,
-                            State = #wstate{channel   = Channel,
-                                            protocol  = Protocol,
-                                            pending   = Pending}) ->
+internal_send_command_async(MethodRecord, State) ->
+    #wstate{channel      = Channel,
+            protocol     = Protocol,
+            pending      = Pending,
+            pending_size = PendingSize} = State1 = encode_pending_content(State),
+    Size = rabbit_binary_generator:method_frame_size(MethodRecord, Protocol),
     Frame = assemble_frame(Channel, MethodRecord, Protocol),
-    maybe_flush(State#wstate{pending = [Frame | Pending]}).
+    maybe_flush(State1#wstate{pending      = [Frame | Pending],
+                              pending_size = PendingSize + Size}).
 
+%% Content-bearing commands are only queued here. They are encoded
+%% together, by the generated encode_content_commands/2, when the
+%% writer flushes or a command without content has to go after them.
 internal_send_command_async(MethodRecord, Content,
-                            State = #wstate{channel   = Channel,
-                                            frame_max = FrameMax,
-                                            protocol  = Protocol,
-                                            pending   = Pending}) ->
-    Frames = assemble_frames(Channel, MethodRecord, Content, FrameMax,
-                             Protocol),
+                            State = #wstate{channel         = Channel,
+                                            frame_max       = FrameMax,
+                                            protocol        = Protocol,
+                                            pending_content = PendingContent,
+                                            pending_size    = PendingSize}) ->
+    Size = rabbit_binary_generator:method_frame_size(MethodRecord, Protocol) +
+        rabbit_binary_generator:content_frames_size(Content, FrameMax,
+                                                    Protocol),
     maybe_gc_large_msg(Content),
-    maybe_flush(State#wstate{pending = [Frames | Pending]}).
+    maybe_flush(State#wstate{
+                  pending_content = [{Channel, MethodRecord, Content} |
+                                     PendingContent],
+                  pending_size    = PendingSize + Size}).
+
+encode_pending_content(State = #wstate{pending_content = []}) ->
+    State;
+encode_pending_content(State = #wstate{frame_max       = FrameMax,
+                                       protocol        = Protocol,
+                                       pending         = Pending,
+                                       pending_content = PendingContent}) ->
+    Frames = Protocol:encode_content_commands(lists:reverse(PendingContent),
+                                              FrameMax),
+    State#wstate{pending = [Frames | Pending], pending_content = []}.
 
 %% When the amount of protocol method data buffered exceeds
 %% this threshold, a socket flush is performed.
@@ -353,17 +381,21 @@ internal_send_command_async(MethodRecord, Content,
 %% exceeding the MSS.
 -define(FLUSH_THRESHOLD, 1414).
 
-maybe_flush(State = #wstate{pending = Pending}) ->
-    case iolist_size(Pending) >= ?FLUSH_THRESHOLD of
+%% The size of each command is added to pending_size as it is queued,
+%% so the pending frames are not walked again on every send.
+maybe_flush(State = #wstate{pending_size = PendingSize}) ->
+    case PendingSize >= ?FLUSH_THRESHOLD of
         true  -> internal_flush(State);
         false -> State
     end.
 
-internal_flush(State = #wstate{pending = []}) ->
+internal_flush(State = #wstate{pending = [], pending_content = []}) ->
     State;
-internal_flush(State = #wstate{sock = Sock, pending = Pending}) ->
+internal_flush(State) ->
+    State1 = #wstate{sock = Sock, pending = Pending} =
+        encode_pending_content(State),
     ok = port_cmd(Sock, lists:reverse(Pending)),
-    State#wstate{pending = []}.
+    State1#wstate{pending = [], pending_size = 0}.
 
 %% gen_tcp:send/2 does a selective receive of {inet_reply, Sock,
 %% Status} to obtain the result. That is bad when it is called from
@@ -0,0 +1,130 @@
+##  The contents of this file are subject to the Mozilla Public License
+##  Version 1.1 (the "License"); you may not use this file except in
+##  compliance with the License. You may obtain a copy of the License
+##  at https://www.mozilla.org/MPL/
+##
+##  Software distributed under the License is distributed on an "AS IS"
+##  basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+##  the License for the specific language governing rights and
+##  limitations under the License.
+##
+##  The Original Code is RabbitMQ.
+##
+##  The Initial Developer of the Original Code is Pivotal Software, Inc.
+##  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
+##
+
+"""Tests of analyze_frames.py on small hand-built captures, including a
+truncated one and tables that do not parse. Run by
+"make python-tests"."""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import amqp_codegen
+import analyze_frames
+
+SPECS = [os.path.join(os.path.dirname(amqp_codegen.__file__), name)
+         for name in ['amqp-rabbitmq-0.9.1.json', 'credit_extension.json']]
+
+PROTOCOL_HEADER = b'AMQP\x00\x00\x09\x01'
+
+def frame(type, channel, payload):
+    return struct.pack('>BHI', type, channel, len(payload)) + payload + b'\xce'
+
+def longstr(value):
+    return struct.pack('>I', len(value)) + value
+
+def queueDeclare(table):
+    # ticket, queue = <<"q">>, no bits, arguments
+    return frame(1, 1, struct.pack('>HHH', 50, 10, 0) + b'\x01q' + b'\x00' + longstr(table))
+
+def basicPublish():
+    return frame(1, 1, struct.pack('>HHH', 60, 40, 0) + b'\x00' + b'\x01q' + b'\x00')
+
+def contentHeader(bodySize, headers):
+    # headers and delivery_mode = 2
+    return frame(2, 1, struct.pack('>HHQH', 60, 0, bodySize, 0x3000) +
+                 longstr(headers) + b'\x02')
+
+MAX_LENGTH = b'\x0cx-max-length' + b'I\x00\x00\x00\x0a'
+HEADERS = b'\x01a' + b'S' + longstr(b'b') + b'\x01c' + b't\x01'
+
+CAPTURE = PROTOCOL_HEADER + queueDeclare(MAX_LENGTH) + basicPublish() + \
+    contentHeader(3, HEADERS) + frame(3, 1, b'xyz') + frame(8, 0, b'')
+
+class AnalyzeFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def analyze(self, *captures):
+        paths = []
+        for (i, capture) in enumerate(captures):
+            path = os.path.join(self.dir, 'capture-%d.bin' % (i,))
+            with open(path, 'wb') as f:
+                f.write(capture)
+            paths.append(path)
+        return analyze_frames.analyze(SPECS, paths, 1)
+
+    def test_capture(self):
+        total = self.analyze(CAPTURE, CAPTURE)
+        self.assertEqual(dict(total['frames']),
+                         {'method': 4, 'header': 2, 'body': 2, 'heartbeat': 2})
+        self.assertEqual(total['frame_bytes']['body'], 2 * 11)
+        self.assertEqual(dict(total['methods']),
+                         {'queue.declare': 2, 'basic.publish': 2})
+        self.assertEqual(dict(total['content_headers']), {'basic': 2})
+        self.assertEqual(dict(total['properties']),
+                         {'basic.headers': 2, 'basic.delivery_mode': 2})
+        self.assertEqual(dict(total['table_keys']),
+                         {'queue.declare.arguments: x-max-length': 2,
+                          'basic.headers: a': 2, 'basic.headers: c': 2})
+        self.assertEqual(dict(total['errors']), {})
+
+    def test_truncated_capture(self):
+        total = self.analyze(CAPTURE[:-3], CAPTURE[:12], b'')
+        self.assertEqual(dict(total['frames']),
+                         {'method': 2, 'header': 1, 'body': 1})
+        self.assertEqual(dict(total['errors']), {'truncated': 2})
+
+    def test_bad_frame_end(self):
+        capture = bytearray(CAPTURE)
+        capture[len(PROTOCOL_HEADER) + len(queueDeclare(MAX_LENGTH)) - 1] = 0
+        total = self.analyze(bytes(capture))
+        self.assertEqual(dict(total['frames']), {})
+        self.assertEqual(dict(total['errors']), {'bad_frame_end': 1})
+
+    def test_bad_tables(self):
+        # A key running past the end of its table, an unknown value
+        # type after a good key, and a value running past the end.
+        capture = queueDeclare(b'\xc8a') + \
+            queueDeclare(MAX_LENGTH + b'\x01kZ') + \
+            contentHeader(0, b'\x01aS\x00\x00\x00\x09b')
+        total = self.analyze(capture)
+        self.assertEqual(dict(total['methods']), {'queue.declare': 2})
+        self.assertEqual(dict(total['table_keys']),
+                         {'queue.declare.arguments: x-max-length': 1})
+        self.assertEqual(dict(total['errors']), {'bad_table': 3})
+
+    def test_fields_past_the_payload(self):
+        # A table whose length runs into the next frame, and properties
+        # whose flags announce more than the header holds.
+        overlong = frame(1, 1, struct.pack('>HHH', 50, 10, 0) + b'\x01q' + b'\x00' +
+                         struct.pack('>I', 40))
+        header = frame(2, 1, struct.pack('>HHQH', 60, 0, 0, 0x2000) + b'\x00\x00')
+        total = self.analyze(overlong + header + queueDeclare(MAX_LENGTH))
+        self.assertEqual(dict(total['frames']), {'method': 2, 'header': 1})
+        self.assertEqual(dict(total['table_keys']),
+                         {'queue.declare.arguments: x-max-length': 1})
+        self.assertEqual(dict(total['errors']),
+                         {'malformed_method': 1, 'malformed_header': 1})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+##  The contents of this file are subject to the Mozilla Public License
+##  Version 1.1 (the "License"); you may not use this file except in
+##  compliance with the License. You may obtain a copy of the License
+##  at https://www.mozilla.org/MPL/
+##
+##  Software distributed under the License is distributed on an "AS IS"
+##  basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+##  the License for the specific language governing rights and
+##  limitations under the License.
+##
+##  The Original Code is RabbitMQ.
+##
+##  The Initial Developer of the Original Code is Pivotal Software, Inc.
+##  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
+##
+
+"""Tests of the codegen.py options that change what the framing
+modules are generated from. Run by "make python-tests"."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import json
+
+import amqp_codegen
+import codegen
+
+CODEGEN_DIR = os.path.dirname(amqp_codegen.__file__)
+SPECS_0_9_1 = [os.path.join(CODEGEN_DIR, name)
+               for name in ['amqp-rabbitmq-0.9.1.json', 'credit_extension.json']]
+SPECS_0_8 = [os.path.join(CODEGEN_DIR, 'amqp-rabbitmq-0.8.json')]
+
+# Also used to generate the overlay test module of unit_SUITE.
+OVERLAY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'unit_SUITE_data', 'codegen_overlay.json')
+
+class CodegenOptionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.options = dict(codegen.codegenOptions)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        codegen.codegenOptions.clear()
+        codegen.codegenOptions.update(self.options)
+        codegen.loadedOverlay = None
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def generateAll(self, *options):
+        args = codegen.extractCodegenOptions(
+            list(options) +
+            [self.path('rabbit_framing.hrl'),
+             self.path('rabbit_framing_amqp_0_9_1.erl') + '=' + ','.join(SPECS_0_9_1),
+             self.path('rabbit_framing_amqp_0_8.erl') + '=' + ','.join(SPECS_0_8)])
+        codegen.generateAll(args)
+
+    def writeOverlay(self, overlay):
+        path = self.path('overlay.json')
+        with open(path, 'w') as f:
+            json.dump(overlay, f)
+        return path
+
+    def method(self, spec, name):
+        [m] = [m for m in spec.allMethods() if codegen.methodProfileKey(m) == name]
+        return m
+
+    def field(self, m, name):
+        [f] = [f for f in m.arguments if codegen.erlangize(f.name) == name]
+        return f
+
+    def test_methods_missing_from_one_spec(self):
+        codegen.extractCodegenOptions(['--methods=confirm'])
+        spec = codegen.loadSpec(SPECS_0_8)
+        self.assertEqual(spec.allClasses(), [])
+        self.assertIn("lookup_class_name(ClassId) ->",
+                      codegen.captureOutput(codegen.genErl, spec))
+        spec = codegen.loadSpec(SPECS_0_9_1)
+        self.assertEqual([c.name for c in spec.allClasses()], ['confirm'])
+        self.generateAll('--methods=connection,channel,confirm,basic.publish')
+        with open(self.path('rabbit_framing_amqp_0_8.erl')) as f:
+            source = f.read()
+        self.assertIn("-> unknown_method('basic.qos')", source)
+        self.assertNotIn("-> unknown_method('basic.publish')", source)
+
+    def test_unknown_methods(self):
+        with self.assertRaisesRegex(Exception, 'basic.publsh, nope'):
+            self.generateAll('--methods=connection,basic.publsh,nope')
+        self.assertFalse(os.path.exists(self.path('rabbit_framing.hrl')))
+
+    def test_overlay(self):
+        overlay = codegen.loadOverlay(self.writeOverlay(
+            {"overlay-version": 1,
+             "methods": {"connection.start-ok":
+                         {"fields": {"mechanism": {"assert-utf8": False}}}}}))
+        self.assertEqual(overlay, {'connection.start_ok':
+                                   {'fields': {'mechanism': {'assert-utf8': False}}}})
+        overlay = codegen.loadOverlay(OVERLAY)
+        self.assertEqual(sorted(overlay), ['basic.consume', 'basic.publish',
+                                           'confirm.select', 'queue.declare'])
+        self.assertEqual(overlay['confirm.select'], {'placement': 'cold', 'fields': {}})
+        self.assertEqual(overlay['queue.declare']['fields'],
+                         {'queue': {'assert-utf8': False, 'copy': False}})
+
+    def test_bad_overlays(self):
+        for (overlay, error) in [
+                ({"overlay-version": 2}, 'Unsupported overlay version 2'),
+                ({"methods": {}}, 'Unsupported overlay version None'),
+                ({"overlay-version": 1,
+                  "methods": {"basic.publish": {"inline": True}}},
+                 'Unknown overlay hint inline for basic.publish'),
+                ({"overlay-version": 1,
+                  "methods": {"basic.publish": {"placement": "warm"}}},
+                 'Bad value warm of overlay hint placement for basic.publish'),
+                ({"overlay-version": 1,
+                  "methods": {"basic.publish":
+                              {"fields": {"exchange": {"tables": "lazy"}}}}},
+                 'Unknown overlay hint tables for basic.publish.exchange'),
+                ({"overlay-version": 1,
+                  "methods": {"basic.publish":
+                              {"fields": {"exchange": {"copy": "yes"}}}}},
+                 'Bad value yes of overlay hint copy for basic.publish.exchange')]:
+            with self.assertRaisesRegex(Exception, error):
+                codegen.loadOverlay(self.writeOverlay(overlay))
+
+    def test_overlay_precedence(self):
+        codegen.extractCodegenOptions(['--overlay=' + OVERLAY,
+                                       '--copy-fields=queue.declare',
+                                       '--lazy-tables=queue.declare,exchange.declare'])
+        spec = codegen.loadSpec(SPECS_0_9_1)
+        declare = self.method(spec, 'queue.declare')
+        consume = self.method(spec, 'basic.consume')
+        publish = self.method(spec, 'basic.publish')
+        # The overlay makes the queue.declare tables eager and leaves
+        # its queue uncopied, whatever the command line says.
+        self.assertFalse(codegen.isLazyTableMethod(declare))
+        self.assertTrue(codegen.isLazyTableMethod(self.method(spec, 'exchange.declare')))
+        self.assertEqual(codegen.copiedFieldNames(declare),
+                         [codegen.erlangize(f.name) for f in declare.arguments
+                          if f.name != 'queue'])
+        self.assertEqual(codegen.copiedFieldNames(consume), ['consumer_tag'])
+        self.assertEqual(codegen.copiedFieldNames(publish), [])
+        for (m, name, check) in [(declare, 'queue', False),
+                                 (consume, 'queue', True),
+                                 (publish, 'routing_key', True),
+                                 (publish, 'exchange', False)]:
+            self.assertEqual(codegen.assertsUtf8(m, self.field(m, name)), check)
+
+    def test_overlay_methods_missing_from_one_spec(self):
+        # confirm.select is not in 0-8.
+        self.generateAll('--overlay=' + OVERLAY)
+        with open(self.path('rabbit_framing_amqp_0_8.erl')) as f:
+            source = f.read()
+        self.assertNotIn("'confirm.select'", source)
+        self.assertIn("decode_method_fields('basic.publish'", source)
+        with open(self.path('rabbit_framing_amqp_0_9_1.erl')) as f:
+            source = f.read()
+        self.assertIn("decode_method_fields('confirm.select'", source)
+
+if __name__ == '__main__':
+    unittest.main()
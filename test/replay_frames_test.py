@@ -0,0 +1,104 @@
+##  The contents of this file are subject to the Mozilla Public License
+##  Version 1.1 (the "License"); you may not use this file except in
+##  compliance with the License. You may obtain a copy of the License
+##  at https://www.mozilla.org/MPL/
+##
+##  Software distributed under the License is distributed on an "AS IS"
+##  basis, WITHOUT WARRANTY OF ANY KIND, either express or implied. See
+##  the License for the specific language governing rights and
+##  limitations under the License.
+##
+##  The Original Code is RabbitMQ.
+##
+##  The Initial Developer of the Original Code is Pivotal Software, Inc.
+##  Copyright (c) 2007-2015 Pivotal Software, Inc.  All rights reserved.
+##
+
+"""Tests of replay_frames.py: synthetic traffic and a capture replayed
+against the stand-in broker started in the same process. Run by
+"make python-tests"."""
+
+import io
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+import contextlib
+
+import amqp_codegen
+import replay_frames
+
+SPECS = [os.path.join(os.path.dirname(amqp_codegen.__file__), name)
+         for name in ['amqp-rabbitmq-0.9.1.json', 'credit_extension.json']]
+
+codec = replay_frames.loadCodec(SPECS)
+B = codec.BY_NAME
+
+class ReplayFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def replay(self, captures = [], **opts):
+        options = {'connect': None, 'connections': 1, 'rate': None,
+                   'synthetic': '10:0', 'confirms': True,
+                   'user': 'guest', 'password': 'guest', 'vhost': '/'}
+        options.update(opts)
+        report = io.StringIO()
+        with contextlib.redirect_stdout(report):
+            stats = asyncio.run(asyncio.wait_for(
+                replay_frames.replay(codec, options, captures), 30))
+        self.assertIn("frames sent", report.getvalue())
+        return stats
+
+    def test_replies(self):
+        self.assertEqual(replay_frames.replyTo(codec, B['queue.declare']()),
+                         B['queue.declare_ok']())
+        self.assertEqual(replay_frames.replyTo(codec, B['basic.get']()),
+                         B['basic.get_empty']())
+        self.assertEqual(replay_frames.replyTo(codec, B['queue.declare'](nowait = True)),
+                         None)
+        self.assertEqual(replay_frames.replyTo(codec, B['basic.publish']()), None)
+
+    def test_synthetic(self):
+        stats = self.replay(connections = 2, synthetic = '50:10')
+        # channel.open, confirm.select, then publish, header and body
+        self.assertEqual(stats.frames, 2 * (2 + 50 * 3))
+        self.assertEqual(len(stats.confirms), 100)
+        self.assertEqual(len(stats.replies), 4)
+        self.assertEqual(stats.nacks, 0)
+
+    def test_synthetic_without_confirms(self):
+        stats = self.replay(synthetic = '20', confirms = False, rate = 2000.0)
+        self.assertEqual(stats.frames, 1 + 20 * 2)
+        self.assertEqual(stats.confirms, [])
+        self.assertEqual(len(stats.replies), 1)
+
+    def test_capture(self):
+        frames = [codec.PROTOCOL_HEADER,
+                  codec.encode_method_frame(0, B['connection.start_ok']()),
+                  codec.encode_method_frame(1, B['channel.open']()),
+                  codec.encode_method_frame(1, B['queue.declare'](queue = b'q')),
+                  codec.encode_method_frame(1, B['queue.declare'](queue = b'r', nowait = True)),
+                  codec.encode_method_frame(1, B['basic.publish'](routing_key = b'q')),
+                  codec.encode_content_frames(1, codec.PROPERTIES[60](), b'hello', 11),
+                  codec.encode_method_frame(1, B['basic.get'](queue = b'q')),
+                  codec.encode_method_frame(1, B['channel.close']())]
+        path = os.path.join(self.dir, 'capture.bin')
+        with open(path, 'wb') as f:
+            f.write(b''.join(frames))
+        stats = self.replay([path, path], connections = 2)
+        # Channel 0 is left out, confirm.select is added after
+        # channel.open and the body is split in two frames.
+        self.assertEqual(stats.frames, 2 * 10)
+        self.assertEqual(len(stats.confirms), 2)
+        # channel.open, confirm.select, queue.declare, basic.get and
+        # channel.close
+        self.assertEqual(len(stats.replies), 2 * 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,12 +22,14 @@
 
 -include("rabbit_memory.hrl").
 -include("rabbit.hrl").
+-include("rabbit_framing.hrl").
 
 -compile(export_all).
 
 all() ->
     [
         {group, parallel_tests},
+        {group, codec_counters},
         {group, parse_mem_limit},
         {group, gen_server2}
     ].
@@ -45,8 +47,28 @@ groups() ->
             pid_decompose_compose,
             platform_and_version,
             frame_encoding_does_not_fail_with_empty_binary_payload,
+            method_frame_encoding,
+            content_properties_encoding,
+            content_property_decoding,
+            content_properties_patching,
+            method_table_field_access,
+            method_frame_assembly,
+            batch_frame_assembly,
+            content_commands_encoding,
+            encoded_sizes,
+            properties_cache,
+            envelope_decoding,
+            table_schema_decoding,
+            method_info,
+            pruned_methods,
+            copied_fields,
+            overlay_hints,
             amqp_table_conversion
         ]},
+        %% Swaps the 0-9-1 framing module for a copy with counters.
+        {codec_counters, [], [
+            codec_counters
+        ]},
         {parse_mem_limit, [parallel], [
             parse_mem_limit_relative_exactly_max,
             parse_mem_relative_above_max,
@@ -413,6 +435,553 @@ frame_encoding_does_not_fail_with_empty_binary_payload(_Config) ->
                     ]],
     ok.
 
+method_frame_encoding(_Config) ->
+    [begin
+         Fields = iolist_to_binary(Protocol:encode_method_fields(Method)),
+         {ClassId, MethodId} = Protocol:method_id(element(1, Method)),
+         Size = size(Fields) + 4,
+         ?assertEqual(<<1, 0, 7, Size:32, ClassId:16, MethodId:16,
+                        Fields/binary, 206>>,
+                      iolist_to_binary(
+                        rabbit_binary_generator:build_simple_method_frame(
+                          7, Method, Protocol)))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1],
+            Method <- [#'basic.deliver'{consumer_tag = <<"ctag">>,
+                                        delivery_tag = 42,
+                                        redelivered  = true,
+                                        exchange     = <<"amq.direct">>,
+                                        routing_key  = <<"key">>},
+                       #'queue.declare'{queue     = <<"q">>,
+                                        arguments = [{<<"x-max-length">>,
+                                                      long, 10}]},
+                       #'channel.close_ok'{}]],
+    ok.
+
+content_properties_encoding(_Config) ->
+    Headers = [{<<"x-death">>, array, [{longstr, <<"q">>}]}],
+    [begin
+         Bin = Protocol:encode_properties(Props),
+         ?assert(is_binary(Bin)),
+         ?assertEqual(Props, Protocol:decode_properties(60, Bin))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1],
+            Props <- [#'P_basic'{},
+                      #'P_basic'{delivery_mode = 2},
+                      #'P_basic'{content_type = <<"text/plain">>,
+                                 delivery_mode = 1},
+                      #'P_basic'{content_type = <<"text/plain">>,
+                                 delivery_mode = 2,
+                                 headers = Headers},
+                      #'P_basic'{content_type = <<"application/json">>,
+                                 headers = Headers,
+                                 priority = 5,
+                                 expiration = <<"60000">>,
+                                 timestamp = 1500000000,
+                                 app_id = <<"app">>}]],
+    ?assertEqual(<<16#10, 0, 2>>,
+                 rabbit_framing_amqp_0_9_1:encode_properties(
+                   #'P_basic'{delivery_mode = 2})),
+    ok.
+
+content_property_decoding(_Config) ->
+    Props = #'P_basic'{content_type = <<"text/plain">>,
+                       headers      = [{<<"k">>, longstr, <<"v">>}],
+                       delivery_mode = 2,
+                       expiration   = <<"1000">>,
+                       timestamp    = 1500000000},
+    Names = record_info(fields, 'P_basic'),
+    [begin
+         Bin = Protocol:encode_properties(Props),
+         Undecoded = #content{class_id = 60, properties = none,
+                              properties_bin = Bin, protocol = Protocol,
+                              payload_fragments_rev = []},
+         Decoded = rabbit_binary_parser:ensure_content_decoded(Undecoded),
+         [begin
+              Expected = element(I + 1, Props),
+              ?assertEqual(Expected, Protocol:decode_property(60, Name, Bin)),
+              ?assertEqual(Expected,
+                           rabbit_binary_parser:content_property(
+                             Name, Undecoded)),
+              ?assertEqual(Expected,
+                           rabbit_binary_parser:content_property(
+                             Name, Decoded))
+          end || {I, Name} <- lists:zip(lists:seq(1, length(Names)), Names)]
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+content_properties_patching(_Config) ->
+    Props = #'P_basic'{content_type  = <<"text/plain">>,
+                       headers       = [{<<"k">>, longstr, <<"v">>}],
+                       delivery_mode = 2,
+                       message_id    = <<"id">>},
+    [begin
+         Bin = Protocol:encode_properties(Props),
+         ?assertEqual({2, 11}, element(1, Protocol:property_offsets(60, Bin))),
+         ?assertEqual(undefined,
+                      element(8, Protocol:property_offsets(60, Bin))),
+         [?assertEqual(Protocol:encode_properties(Expected),
+                       Protocol:patch_properties_bin(60, Changes, Bin))
+          || {Changes, Expected} <-
+                 [{[], Props},
+                  {[{expiration, <<"5000">>}],
+                   Props#'P_basic'{expiration = <<"5000">>}},
+                  {[{content_type, <<"application/json">>}],
+                   Props#'P_basic'{content_type = <<"application/json">>}},
+                  {[{headers, undefined}, {priority, 9}],
+                   Props#'P_basic'{headers = undefined, priority = 9}},
+                  {[{cluster_id, <<"c">>}, {content_type, undefined}],
+                   Props#'P_basic'{cluster_id = <<"c">>,
+                                   content_type = undefined}},
+                  {[{message_id, undefined}, {expiration, <<"5000">>},
+                    {content_encoding, <<"gzip">>}, {delivery_mode, 1}],
+                   Props#'P_basic'{message_id = undefined,
+                                   expiration = <<"5000">>,
+                                   content_encoding = <<"gzip">>,
+                                   delivery_mode = 1}},
+                  {[{priority, 1}, {priority, 9}],
+                   Props#'P_basic'{priority = 9}}]],
+         Content = #content{class_id = 60, properties = Props,
+                            properties_bin = none, protocol = none,
+                            payload_fragments_rev = []},
+         #content{properties = none, properties_bin = PatchedBin} =
+             rabbit_binary_generator:patch_content_properties(
+               [{delivery_mode, 1}], Content, Protocol),
+         ?assertEqual(Props#'P_basic'{delivery_mode = 1},
+                      Protocol:decode_properties(60, PatchedBin))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+method_table_field_access(_Config) ->
+    Args = [{<<"x-queue-type">>, longstr, <<"quorum">>}],
+    [begin
+         Bin = iolist_to_binary(
+                 Protocol:encode_method_fields(
+                   #'queue.declare'{queue = <<"q">>, arguments = Args})),
+         Method = Protocol:decode_method_fields('queue.declare', Bin),
+         ?assertEqual(Args, Protocol:table_field(arguments, Method))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+method_frame_assembly(_Config) ->
+    Publish = #'basic.publish'{exchange = <<"x">>, routing_key = <<"rk">>},
+    Ack = #'basic.ack'{delivery_tag = 7, multiple = true},
+    [begin
+         {ok, State} = rabbit_command_assembler:init(Protocol),
+         AnalyzeMethod =
+             fun (Method) ->
+                     [_Header, Id, Fields, _End] =
+                         Protocol:encode_method_frame(1, Method),
+                     rabbit_command_assembler:analyze_channel_frame(
+                       1, iolist_to_binary([Id, Fields]), Protocol)
+             end,
+         ?assertEqual({ok, Ack, State},
+                      rabbit_command_assembler:process(AnalyzeMethod(Ack),
+                                                       State)),
+         ?assertEqual({ok, {content_header, Publish, 60, Protocol}},
+                      rabbit_command_assembler:process(
+                        AnalyzeMethod(Publish), State)),
+         ?assertMatch({error, #amqp_error{name = frame_error}},
+                      rabbit_command_assembler:process(
+                        {method_frame, <<60:16, 80:16, 1>>}, State)),
+         ?assertMatch({error, #amqp_error{name = command_invalid}},
+                      rabbit_command_assembler:process(
+                        rabbit_command_assembler:analyze_channel_frame(
+                          1, <<60:16, 1000:16>>, Protocol), State)),
+         ?assertEqual(error, rabbit_command_assembler:analyze_channel_frame(
+                               1, <<60:16>>, Protocol))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+batch_frame_assembly(_Config) ->
+    Publish = #'basic.publish'{exchange = <<"x">>, routing_key = <<"rk">>},
+    Ack = #'basic.ack'{delivery_tag = 7},
+    Props = #'P_basic'{delivery_mode = 2},
+    [begin
+         Content = rabbit_basic_common:build_content(Props, [<<"payload">>]),
+         Frames = [rabbit_binary_generator:build_simple_method_frame(
+                     1, Publish, Protocol),
+                   rabbit_binary_generator:build_simple_content_frames(
+                     1, Content, 0, Protocol),
+                   rabbit_binary_generator:build_heartbeat_frame(),
+                   rabbit_binary_generator:build_simple_method_frame(
+                     0, #'connection.close_ok'{}, Protocol),
+                   rabbit_binary_generator:build_simple_method_frame(
+                     2, Ack, Protocol)],
+         Partial = binary:part(iolist_to_binary(
+                                 rabbit_binary_generator:build_simple_method_frame(
+                                   1, Ack, Protocol)), 0, 10),
+         Buffer = iolist_to_binary([Frames, Partial]),
+         {Decoded, Partial} = Protocol:decode_frames(Buffer, 0),
+         {ok, State} = rabbit_command_assembler:init(Protocol),
+         {Commands, _States} = rabbit_command_assembler:process_frames(
+                                 Decoded, #{1 => State, 2 => State}),
+         ?assertMatch([{1, {ok, Publish, #content{class_id = 60}}},
+                       {0, {frame, heartbeat}},
+                       {0, {frame, {method, 'connection.close_ok', <<>>}}},
+                       {2, {ok, Ack}}], Commands),
+         {1, {ok, Publish, Assembled}} = hd(Commands),
+         ?assertEqual(Props, rabbit_binary_parser:ensure_content_decoded(
+                               Assembled)#content.properties),
+         %% Frames larger than FrameMax are left for the caller.
+         ?assertEqual({[], Buffer}, Protocol:decode_frames(Buffer, 16)),
+         %% So are method frames too short to hold a method id.
+         AckFrame = iolist_to_binary(
+                      rabbit_binary_generator:build_simple_method_frame(
+                        2, Ack, Protocol)),
+         [begin
+              Truncated = <<1:8, 1:16, Size:32,
+                            (binary:part(<<60:16, 80:16>>, 0, Size))/binary,
+                            206:8>>,
+              ?assertEqual({[{2, {decoded_method, 60, Ack, false}}], Truncated},
+                           Protocol:decode_frames(
+                             <<AckFrame/binary, Truncated/binary>>, 0))
+          end || Size <- [0, 2, 3]]
+         %% After an error, the remaining frames of its channel are
+         %% handed back untouched, and the other channels go on.
+         ErrorFrames = [rabbit_binary_generator:build_simple_content_frames(
+                          1, Content, 0, Protocol),
+                        rabbit_binary_generator:build_simple_method_frame(
+                          1, Publish, Protocol),
+                        rabbit_binary_generator:build_simple_method_frame(
+                          2, Ack, Protocol)],
+         {ErrorDecoded, <<>>} =
+             Protocol:decode_frames(iolist_to_binary(ErrorFrames), 0),
+         {ErrorCommands, ErrorStates} =
+             rabbit_command_assembler:process_frames(
+               ErrorDecoded, #{1 => State, 2 => State}),
+         ?assertMatch([{1, {error, #amqp_error{name = unexpected_frame}}},
+                       {1, {frame, {content_body, <<"payload">>}}},
+                       {1, {frame, {decoded_method, 60, Publish, true}}},
+                       {2, {ok, Ack}}], ErrorCommands),
+         ?assertEqual(#{2 => State}, ErrorStates)
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+content_commands_encoding(_Config) ->
+    Deliver = #'basic.deliver'{consumer_tag = <<"ctag">>, delivery_tag = 1,
+                               exchange = <<"x">>, routing_key = <<"rk">>},
+    Publish = #'basic.publish'{exchange = <<"x">>, routing_key = <<"rk">>},
+    Content = rabbit_basic_common:build_content(
+                #'P_basic'{delivery_mode = 2}, [<<0:200/unit:8>>]),
+    Commands = [{1, Deliver, Content}, {2, Publish, Content},
+                {1, Deliver#'basic.deliver'{delivery_tag = 2}, Content}],
+    [[begin
+          Expected = [[rabbit_binary_generator:build_simple_method_frame(
+                         Ch, Method, Protocol),
+                       rabbit_binary_generator:build_simple_content_frames(
+                         Ch, C, FrameMax, Protocol)]
+                      || {Ch, Method, C} <- Commands],
+          ?assertEqual(iolist_to_binary(Expected),
+                       iolist_to_binary(Protocol:encode_content_commands(
+                                          Commands, FrameMax)))
+      end || FrameMax <- [0, 64]]
+     || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ?assertExit({unknown_content_method, 'basic.ack'},
+                rabbit_framing_amqp_0_9_1:encode_content_commands(
+                  [{1, #'basic.ack'{}, Content}], 0)),
+    ok.
+
+properties_cache(_Config) ->
+    Props = #'P_basic'{content_type = <<"text/plain">>, delivery_mode = 2},
+    Headers = Props#'P_basic'{headers = [{<<"k">>, longstr, <<"v">>}]},
+    [begin
+         ok = rabbit_properties_cache:clear(),
+         Bin = Protocol:encode_properties(Props),
+         ?assertEqual(Bin, rabbit_properties_cache:encode(Props, Protocol)),
+         ?assertEqual(Bin, rabbit_properties_cache:encode(Props, Protocol)),
+         ?assertEqual(Protocol:encode_properties(Headers),
+                      rabbit_properties_cache:encode(Headers, Protocol)),
+         [?assertEqual(Protocol:encode_properties(PerMessage),
+                       rabbit_properties_cache:encode(PerMessage, Protocol))
+          || PerMessage <- [Props#'P_basic'{message_id = <<"m1">>},
+                            Props#'P_basic'{timestamp = 1}]],
+         Stats = rabbit_properties_cache:stats(),
+         ?assertEqual(1, proplists:get_value(hits, Stats)),
+         ?assertEqual(1, proplists:get_value(misses, Stats)),
+         ?assertEqual(1, proplists:get_value(size, Stats)),
+         %% the least recently used entry goes once the cache is full
+         MaxSize = proplists:get_value(max_size, Stats),
+         [rabbit_properties_cache:encode(Props#'P_basic'{priority = N},
+                                         Protocol)
+          || N <- lists:seq(1, MaxSize)],
+         ?assertEqual(MaxSize, proplists:get_value(
+                                 size, rabbit_properties_cache:stats())),
+         rabbit_properties_cache:encode(Props, Protocol),
+         ?assertEqual(1, proplists:get_value(
+                           hits, rabbit_properties_cache:stats())),
+         %% keys do not keep the binaries of the record alive
+         ok = rabbit_properties_cache:clear(),
+         <<ContentType:10/binary, _/binary>> = <<"text/plain", 0:1000/unit:8>>,
+         Sub = Props#'P_basic'{content_type = ContentType},
+         ?assertEqual(Bin, rabbit_properties_cache:encode(Sub, Protocol)),
+         %% the entries map of the cache record
+         [{Protocol, Cached}] =
+             maps:keys(element(4, get(rabbit_properties_cache))),
+         ?assertEqual(Props, Cached),
+         ?assertEqual(10, binary:referenced_byte_size(
+                            Cached#'P_basic'.content_type)),
+         ?assertEqual(Bin, rabbit_properties_cache:encode(Sub, Protocol))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+envelope_decoding(_Config) ->
+    Publish = #'basic.publish'{ticket = 7, exchange = <<"x">>,
+                               routing_key = <<"rk">>, mandatory = true,
+                               immediate = false},
+    Ack = #'basic.ack'{delivery_tag = 42, multiple = true},
+    [begin
+         ?assertEqual({<<"x">>, <<"rk">>, true},
+                      Protocol:decode_publish_envelope(
+                        Protocol:encode_method_fields(Publish))),
+         ?assertEqual({42, true},
+                      Protocol:decode_ack_envelope(
+                        Protocol:encode_method_fields(Ack))),
+         ?assertExit(#amqp_error{name = frame_error},
+                     Protocol:decode_publish_envelope(<<0:16, 5:8, "x">>))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    Nack = #'basic.nack'{delivery_tag = 42, multiple = false, requeue = true},
+    ?assertEqual({42, false, true},
+                 rabbit_framing_amqp_0_9_1:decode_nack_envelope(
+                   rabbit_framing_amqp_0_9_1:encode_method_fields(Nack))),
+    ok.
+
+table_schema_decoding(_Config) ->
+    Args = [{<<"x-queue-type">>, longstr, <<"quorum">>},
+            {<<"x-custom">>, longstr, <<"a">>},
+            {<<"x-max-length">>, signedint, 10},
+            {<<"x-max-length">>, long, 20},
+            %% Dropped like the one above, although of a bad type.
+            {<<"x-max-length">>, longstr, <<"30">>},
+            {<<"x-other">>, bool, true},
+            {<<"x-custom">>, longstr, <<"b">>}],
+    [begin
+         Expected = {ok, #{<<"x-queue-type">> => {longstr, <<"quorum">>},
+                           <<"x-max-length">> => {signedint, 10}},
+                     [{<<"x-custom">>, longstr, <<"a">>},
+                      {<<"x-other">>, bool, true},
+                      {<<"x-custom">>, longstr, <<"b">>}]},
+         ?assertEqual(Expected, Protocol:decode_schema_queue_arguments(Args)),
+         ?assertEqual(Expected,
+                      Protocol:decode_schema_queue_arguments(
+                        rabbit_binary_generator:generate_table(Args))),
+         ?assertEqual({error, {invalid_type, <<"x-message-ttl">>, longstr}},
+                      Protocol:decode_schema_queue_arguments(
+                        [{<<"x-message-ttl">>, longstr, <<"1">>}])),
+         ?assertEqual({ok, #{}, []},
+                      Protocol:decode_schema_exchange_arguments([]))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+method_info(_Config) ->
+    [begin
+         ?assertMatch({{60, 40}, true, false,
+                       [ticket, exchange, routing_key, mandatory, immediate],
+                       #'basic.publish'{}},
+                      Protocol:method_info('basic.publish')),
+         [?assertEqual({Protocol:method_id(Name),
+                        Protocol:method_has_content(Name),
+                        Protocol:is_method_synchronous(
+                          Protocol:method_record(Name)),
+                        Protocol:method_fieldnames(Name),
+                        Protocol:method_record(Name)},
+                       Protocol:method_info(Name))
+          || Name <- ['connection.start_ok', 'channel.open', 'basic.ack',
+                      'basic.deliver']],
+         ?assertExit({unknown_method_name, 'basic.nope'},
+                     Protocol:method_info('basic.nope')),
+         ?assertEqual('basic', Protocol:lookup_class_name(60)),
+         ?assertEqual('connection', Protocol:lookup_class_name(10)),
+         ?assertExit({unknown_class_id, 15}, Protocol:lookup_class_name(15)),
+         ?assertExit({unknown_class_id, 1000},
+                     Protocol:lookup_class_name(1000)),
+         ?assertEqual(not_found, Protocol:amqp_exception(404)),
+         ?assertEqual(internal_error, Protocol:amqp_exception(541)),
+         ?assertEqual(frame_method, Protocol:amqp_exception(1)),
+         ?assertEqual(undefined, Protocol:amqp_exception(407)),
+         ?assertEqual(undefined, Protocol:amqp_exception(404.0))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
+codec_counters(Config) ->
+    Module = load_generated_module(Config, "rabbit_framing_amqp_0_9_1.counted"),
+    try
+        ok = Module:init_codec_counters(),
+        Qos = #'basic.qos'{prefetch_count = 10},
+        Before = codec_stats(Module, 'basic.qos'),
+        Bin = iolist_to_binary(Module:encode_method_fields(Qos)),
+        Qos = Module:decode_method_fields('basic.qos', Bin),
+        After = codec_stats(Module, 'basic.qos'),
+        [?assertEqual(proplists:get_value(Name, Before) + Delta,
+                      proplists:get_value(Name, After))
+         || {Name, Delta} <- [{encode_calls, 1}, {encode_bytes, size(Bin)},
+                              {decode_calls, 1}, {decode_bytes, size(Bin)}]],
+        Profile = rabbit_json:decode(
+                    rabbit_core_metrics:codec_profile(
+                      [{Module, Module:codec_counters()}])),
+        %% The module stands in for the real one, so other tests may
+        %% have counted calls since.
+        ?assert(maps:get(<<"basic.qos">>, Profile) >=
+                    proplists:get_value(decode_calls, After) +
+                    proplists:get_value(encode_calls, After)),
+        ?assertNot(maps:is_key(<<"P_basic">>, Profile))
+    after
+        code:purge(Module),
+        {module, Module} = code:load_file(Module)
+    end,
+    ok.
+
+%% Compiles and loads a framing module generated into the data
+%% directory (see development.post.mk).
+load_generated_module(Config, File) ->
+    Src = filename:join(?config(data_dir, Config), File),
+    {ok, Forms} = epp:parse_file(
+                    Src, [{includes, [code:lib_dir(rabbit_common, include)]}]),
+    {ok, Module, Bin} = compile:forms(Forms, []),
+    code:purge(Module),
+    {module, Module} = code:load_binary(Module, Src, Bin),
+    Module.
+
+pruned_methods(Config) ->
+    Module = load_generated_module(Config, "rabbit_framing_pruned_test.gen"),
+    Qos = #'basic.qos'{prefetch_count = 10},
+    Publish = #'basic.publish'{exchange = <<"x">>, routing_key = <<"rk">>},
+    {ok, State} = rabbit_command_assembler:init(Module),
+    [begin
+         [_Header, Id, Fields, _End] =
+             rabbit_framing_amqp_0_9_1:encode_method_frame(1, Method),
+         Payload = iolist_to_binary([Id, Fields]),
+         Frame = rabbit_command_assembler:analyze_frame(
+                   ?FRAME_METHOD, Payload, Module),
+         ?assertMatch({method, Name, _}, Frame),
+         ?assertEqual(Result, rabbit_command_assembler:process(Frame, State)),
+         ?assertEqual(Result, rabbit_command_assembler:process(
+                                {method_frame, Payload}, State))
+     end || {Method, Name, Result} <-
+                [{Publish, 'basic.publish',
+                  {ok, {content_header, Publish, 60, Module}}},
+                 {Qos, 'basic.qos',
+                  {error, rabbit_misc:amqp_error(
+                            not_implemented, "method ~w is not supported",
+                            ['basic.qos'], none)}}]],
+    ?assertEqual('basic.qos', Module:lookup_method_name({60, 10})),
+    ?assertExit({unknown_method_id, {60, 1000}},
+                Module:lookup_method_name({60, 1000})),
+    ok.
+
+copied_fields(Config) ->
+    Module = load_generated_module(Config, "rabbit_framing_copy_test.gen"),
+    %% Large enough for the frames to be refc binaries.
+    Args = [{<<"x-padding">>, longstr, <<0:100/unit:8>>}],
+    Declare = #'queue.declare'{queue = <<"q">>, arguments = Args},
+    Consume = #'basic.consume'{queue = <<"q">>, consumer_tag = <<"ctag">>,
+                               arguments = Args},
+    Publish = #'basic.publish'{exchange = binary:copy(<<"x">>, 100),
+                               routing_key = <<"rk">>},
+    Copied = fun (Bin) ->
+                     binary:referenced_byte_size(Bin) =:= byte_size(Bin)
+             end,
+    [begin
+         Name = element(1, Method),
+         {ClassId, MethodId} = Module:method_id(Name),
+         FieldsBin = iolist_to_binary(Module:encode_method_fields(Method)),
+         Decoded = Module:decode_method_fields(Name, FieldsBin),
+         {Decoded, false} = Module:decode_method_frame(
+                              <<ClassId:16, MethodId:16, FieldsBin/binary>>),
+         ?assertEqual(Method, Decoded),
+         [?assertEqual({Name, Field, Copy},
+                       {Name, Field, Copied(element(Pos, Decoded))})
+          || {Field, Pos, Copy} <- Fields]
+     end || {Method, Fields} <-
+                [{Declare, [{queue, #'queue.declare'.queue, true}]},
+                 {Consume, [{consumer_tag, #'basic.consume'.consumer_tag, true},
+                            {queue, #'basic.consume'.queue, false}]}]],
+    {Exchange, RoutingKey, false} =
+        Module:decode_publish_envelope(
+          iolist_to_binary(Module:encode_method_fields(Publish))),
+    ?assertEqual(Publish#'basic.publish'.exchange, Exchange),
+    ?assertNot(Copied(Exchange)),
+    ?assertNot(Copied(RoutingKey)),
+    ok.
+
+%% The module is generated with test/unit_SUITE_data/codegen_overlay.json,
+%% whose hints override --copy-fields and --lazy-tables.
+overlay_hints(Config) ->
+    Module = load_generated_module(Config, "rabbit_framing_overlay_test.gen"),
+    Args = [{<<"x-padding">>, longstr, <<0:100/unit:8>>}],
+    Decode = fun (Method) ->
+                     Module:decode_method_fields(
+                       element(1, Method),
+                       iolist_to_binary(Module:encode_method_fields(Method)))
+             end,
+    Copied = fun (Bin) ->
+                     binary:referenced_byte_size(Bin) =:= byte_size(Bin)
+             end,
+    %% UTF-8 is checked in the routing key of basic.publish, and not in
+    %% the queue of queue.declare.
+    BadUtf8 = <<255>>,
+    ?assertExit(#amqp_error{name = frame_error},
+                Decode(#'basic.publish'{routing_key = BadUtf8})),
+    #'basic.publish'{exchange = BadUtf8} =
+        Decode(#'basic.publish'{exchange = BadUtf8}),
+    Declare = #'queue.declare'{queue = BadUtf8, arguments = Args},
+    #'queue.declare'{queue = Queue, arguments = Args} = Decode(Declare),
+    ?assertNot(Copied(Queue)),
+    #'exchange.declare'{arguments = {lazy_table, _}} =
+        Decode(#'exchange.declare'{arguments = Args}),
+    #'basic.consume'{queue = ConsumeQueue, consumer_tag = ConsumerTag} =
+        Decode(#'basic.consume'{queue = <<"q">>, consumer_tag = <<"ctag">>,
+                                arguments = Args}),
+    ?assert(Copied(ConsumerTag)),
+    ?assertNot(Copied(ConsumeQueue)),
+    ok.
+
+codec_stats(Module, Method) ->
+    Stats = proplists:get_value(Module, rabbit_core_metrics:codec_stats()),
+    proplists:get_value(Method, Stats).
+
+encoded_sizes(_Config) ->
+    Table = [{<<"a">>, longstr, <<"b">>},
+             {<<"n">>, array, [{signedint, 1}, {bool, true}, {void, undefined}]},
+             {<<"t">>, table, [{<<"d">>, decimal, {1, 2}},
+                               {<<"f">>, double, 1.0}]}],
+    Methods = [#'basic.publish'{exchange = <<"x">>, routing_key = <<"rk">>},
+               #'basic.ack'{delivery_tag = 1},
+               #'connection.close_ok'{},
+               #'queue.declare'{queue = <<"q">>, arguments = Table}],
+    Props = [#'P_basic'{},
+             #'P_basic'{delivery_mode = 2, content_type = <<"text/plain">>},
+             #'P_basic'{headers = Table, timestamp = 1, user_id = <<"u">>}],
+    ?assertEqual(size(rabbit_binary_generator:generate_table(Table)),
+                 rabbit_binary_generator:table_size(Table)),
+    [begin
+         [?assertEqual(iolist_size(Protocol:encode_method_fields(M)),
+                       Protocol:encoded_size(M)) || M <- Methods],
+         [?assertEqual(size(Protocol:encode_properties(P)),
+                       Protocol:encoded_properties_size(P)) || P <- Props],
+         Content = #content{class_id              = 60,
+                            properties            = lists:last(Props),
+                            properties_bin        = none,
+                            protocol              = none,
+                            payload_fragments_rev = [<<0:300/unit:8>>,
+                                                     <<"body">>]},
+         [?assertEqual(
+             iolist_size(rabbit_binary_generator:build_simple_content_frames(
+                           1, Content, FrameMax, Protocol)),
+             rabbit_binary_generator:content_frames_size(Content, FrameMax,
+                                                         Protocol))
+          || FrameMax <- [0, 100, 4096]],
+         %% Properties encoded for the other protocol only.
+         [Other] = [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1] --
+             [Protocol],
+         Encoded = rabbit_binary_generator:ensure_content_encoded(
+                     Content, Other),
+         Foreign = Encoded#content{properties = none},
+         ?assertEqual(
+            iolist_size(rabbit_binary_generator:build_simple_content_frames(
+                          1, Foreign, 0, Protocol)),
+            rabbit_binary_generator:content_frames_size(Foreign, 0, Protocol))
+     end || Protocol <- [rabbit_framing_amqp_0_8, rabbit_framing_amqp_0_9_1]],
+    ok.
+
 amqp_table_conversion(_Config) ->
     assert_table(#{}, []),
     assert_table(#{<<"x-expires">> => 1000},